@@ -0,0 +1,79 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import atexit
+import json
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+# logger name -> QueueListener writing its records
+_listeners = {}
+
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler for a listener thread of the same process.
+
+    The default prepare formats the message (and drops the arguments) before
+    enqueuing the record, so that it can be pickled. Here the record is
+    enqueued as it is: the message is formatted by the listener thread, off
+    the evaluation loop. The arguments of the log calls must not be modified
+    after the call.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonlFormatter(logging.Formatter):
+    """One json object per record.
+
+    Records logged with extra={"event": name, "data": dict} are written as
+    {"time", "level", "event", **data}, without formatting their message.
+    The other records are written as {"time", "level", "event": "message",
+    "message"}.
+    """
+
+    def format(self, record):
+        obj = {
+            "time": record.created,
+            "level": record.levelname,
+            "event": getattr(record, "event", "message"),
+        }
+        if hasattr(record, "event"):
+            obj.update(getattr(record, "data", {}))
+        else:
+            obj["message"] = record.getMessage()
+        return json.dumps(obj, default=str)
+
+
+def start_async_logging(logger, handlers):
+    """Replace the handlers of logger with a queue consumed by a background
+    thread that formats the records and writes them to handlers."""
+    stop_async_logging(logger)
+    log_queue = queue.Queue(-1)
+    logger.addHandler(LazyQueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners[logger.name] = listener
+
+
+def stop_async_logging(logger):
+    """Write the queued records, then remove and close the handlers of logger."""
+    listener = _listeners.pop(logger.name, None)
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+
+@atexit.register
+def _stop_all():
+    for name in list(_listeners):
+        stop_async_logging(logging.getLogger(name))
@@ -4,13 +4,17 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
+import os
+import array
 import pickle as pkl
+import numpy as np
 from tqdm import tqdm
 try:
     import ujson as json
 except ImportError:
     import json
 import collections
+import itertools
 import torch
 from lama.modules import build_model_by_name
 
@@ -22,6 +26,238 @@ from lama.modules import build_model_by_name
 EncodedSentence = collections.namedtuple('EncodedSentence',
                                          'embedding, length, tokens')
 
+# A batch of encoded sentences padded by collate_encoded_sentences:
+#   embeddings: tensor with shape (batch_size, max_length, embedding_dim),
+#               zeros after the end of each sentence.
+#   mask: bool tensor with shape (batch_size, max_length), True for tokens.
+#   lengths: long tensor with shape (batch_size).
+#   tokens: list of the token lists of the sentences.
+EncodedBatch = collections.namedtuple('EncodedBatch',
+                                      'embeddings, mask, lengths, tokens')
+
+# On-disk format of an encoded dataset (a directory):
+#   meta.json                   dtype, embedding_dim, number of sentences
+#   embeddings.bin              all the embeddings, one contiguous
+#                               [num_vectors, embedding_dim] matrix
+#   offsets.npy                 [num_sentences + 1] first row of each sentence
+#   lengths.npy                 [num_sentences] length of each sentence
+#   tokens.bin                  utf-8 bytes of all the tokens
+#   token_offsets.npy           [num_tokens + 1] first byte of each token
+#   sentence_tokens.npy         [num_sentences + 1] first token of each sentence
+# A sharded dataset is a directory with shards in this format, listed in
+# shards.json, and optionally index.npy: [num_sentences] position in the
+# shards of each sentence, when they are not written in input order.
+FORMAT_VERSION = 1
+DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+class EncodedDatasetWriter(object):
+    """Write an encoded dataset sentence by sentence, without keeping the
+    embeddings in memory.
+
+    Parameters:
+    path (string): output directory
+    dtype (string): "float32" or "float16"
+    """
+
+    def __init__(self, path, dtype="float32"):
+        if dtype not in DTYPES:
+            raise ValueError("dtype should be one of {}".format(list(DTYPES)))
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dtype = dtype
+        self.embedding_dim = None
+        self._embeddings_file = open(os.path.join(path, "embeddings.bin"), "wb")
+        self._tokens_file = open(os.path.join(path, "tokens.bin"), "wb")
+        self._offsets = array.array("q", [0])
+        self._lengths = array.array("q")
+        self._token_offsets = array.array("q", [0])
+        self._sentence_tokens = array.array("q", [0])
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def add(self, embedding, length, tokens):
+        embedding = embedding.detach().cpu().numpy().astype(DTYPES[self.dtype], copy=False)
+        if self.embedding_dim is None:
+            self.embedding_dim = embedding.shape[1]
+        elif embedding.shape[1] != self.embedding_dim:
+            raise ValueError(
+                "embedding dim {} != {}".format(embedding.shape[1], self.embedding_dim)
+            )
+        self._embeddings_file.write(np.ascontiguousarray(embedding).tobytes())
+        self._offsets.append(self._offsets[-1] + embedding.shape[0])
+        self._lengths.append(length)
+        for token in tokens:
+            self._tokens_file.write(token.encode("utf-8"))
+            self._token_offsets.append(self._tokens_file.tell())
+        self._sentence_tokens.append(len(self._token_offsets) - 1)
+
+    def close(self):
+        self._embeddings_file.close()
+        self._tokens_file.close()
+        for name, values in [
+            ("offsets", self._offsets),
+            ("lengths", self._lengths),
+            ("token_offsets", self._token_offsets),
+            ("sentence_tokens", self._sentence_tokens),
+        ]:
+            np.save(os.path.join(self.path, name + ".npy"), np.array(values, dtype=np.int64))
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({
+                "version": FORMAT_VERSION,
+                "dtype": self.dtype,
+                "embedding_dim": self.embedding_dim or 0,
+                "num_sentences": len(self._lengths),
+                "num_vectors": self._offsets[-1],
+            }, f)
+
+
+class ShardedEncodedDatasetWriter(object):
+    """Write an encoded dataset as a sequence of shards of at most
+    shard_size sentences (shard_00000, shard_00001, ... in the format of
+    EncodedDatasetWriter), listed in path/shards.json. Only the sentence
+    being written is kept in memory.
+
+    Sentences may be added out of order: close(index) then stores the
+    position in the shards of each sentence, so that the dataset is read
+    back in input order.
+    """
+
+    def __init__(self, path, shard_size=100000, dtype="float32"):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.shard_size = shard_size
+        self.dtype = dtype
+        self.shards = []
+        self.num_sentences = 0
+        self._writer = None
+
+    def __len__(self):
+        return self.num_sentences
+
+    def add(self, embedding, length, tokens):
+        if self._writer is None or len(self._writer) >= self.shard_size:
+            self._close_shard()
+            name = "shard_{:05d}".format(len(self.shards))
+            self._writer = EncodedDatasetWriter(os.path.join(self.path, name), dtype=self.dtype)
+            self.shards.append(name)
+        self._writer.add(embedding, length, tokens)
+        self.num_sentences += 1
+
+    def _close_shard(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def close(self, index=None):
+        self._close_shard()
+        if index is not None:
+            if len(index) != self.num_sentences:
+                raise ValueError(
+                    "index of {} sentences, {} written".format(len(index), self.num_sentences)
+                )
+            np.save(os.path.join(self.path, "index.npy"), np.asarray(index, dtype=np.int64))
+        with open(os.path.join(self.path, "shards.json"), "w") as f:
+            json.dump({
+                "version": FORMAT_VERSION,
+                "shards": self.shards,
+                "num_sentences": self.num_sentences,
+                "index": index is not None,
+            }, f)
+
+
+class _MemoryMappedEncodings(object):
+    """Read-only view of an encoded dataset directory. Pickles as its path,
+    so that DataLoader workers map the same files instead of copying them."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        num_vectors = self.meta["num_vectors"]
+        if num_vectors > 0:
+            # copy-on-write: the arrays are writable (as torch.from_numpy
+            # expects) but nothing is ever written back to the file
+            self.embeddings = np.memmap(
+                os.path.join(path, "embeddings.bin"),
+                dtype=DTYPES[self.meta["dtype"]],
+                mode="c",
+                shape=(num_vectors, self.meta["embedding_dim"]),
+            )
+        else:
+            self.embeddings = np.zeros((0, self.meta["embedding_dim"]), dtype=DTYPES[self.meta["dtype"]])
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode="r")
+        self.token_offsets = np.load(os.path.join(path, "token_offsets.npy"), mmap_mode="r")
+        self.sentence_tokens = np.load(os.path.join(path, "sentence_tokens.npy"), mmap_mode="r")
+        if os.path.getsize(os.path.join(path, "tokens.bin")) > 0:
+            self.tokens = np.memmap(os.path.join(path, "tokens.bin"), dtype=np.uint8, mode="r")
+        else:
+            self.tokens = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("index {} out of range".format(idx))
+        embedding = torch.from_numpy(self.embeddings[self.offsets[idx]:self.offsets[idx + 1]])
+        tokens = []
+        for t in range(self.sentence_tokens[idx], self.sentence_tokens[idx + 1]):
+            start, end = self.token_offsets[t], self.token_offsets[t + 1]
+            tokens.append(self.tokens[start:end].tobytes().decode("utf-8"))
+        return embedding, int(self.lengths[idx]), tokens
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+class _ShardedEncodings(object):
+    """Read-only view of the shards written by ShardedEncodedDatasetWriter."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "shards.json"), "r") as f:
+            meta = json.load(f)
+        self.shards = [_MemoryMappedEncodings(os.path.join(path, name)) for name in meta["shards"]]
+        # first index of each shard
+        self.starts = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self.index = None
+        if meta.get("index", False):
+            self.index = np.load(os.path.join(path, "index.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("index {} out of range".format(idx))
+        if self.index is not None:
+            idx = int(self.index[idx])
+        shard = int(np.searchsorted(self.starts, idx, side="right")) - 1
+        return self.shards[shard][idx - int(self.starts[shard])]
+
+    @property
+    def lengths(self):
+        lengths = np.concatenate([np.asarray(shard.lengths) for shard in self.shards])
+        if self.index is not None:
+            lengths = lengths[np.asarray(self.index)]
+        return lengths
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
 
 class EncodedDataset(torch.utils.data.Dataset):
 
@@ -34,7 +270,7 @@ class EncodedDataset(torch.utils.data.Dataset):
             assert isinstance(sample[0], torch.Tensor)
             self._encodings = encoded_sentences
         else:
-            self._embeddings = []
+            self._encodings = []
 
     def __len__(self):
         return len(self._encodings)
@@ -45,17 +281,43 @@ class EncodedDataset(torch.utils.data.Dataset):
 
         return EncodedSentence(embedding=embedding, length=sent_length, tokens=tokens)
 
-    def save(self, path):
-        with open(path, 'wb') as f:
-            pkl.dump(self._encodings, f)
+    def get_lengths(self):
+        """Returns the length of each sentence, without reading the
+        embeddings of the memory-mapped formats."""
+        if isinstance(self._encodings, (_MemoryMappedEncodings, _ShardedEncodings)):
+            return np.asarray(self._encodings.lengths, dtype=np.int64)
+        return np.array([encoding[1] for encoding in self._encodings], dtype=np.int64)
+
+    def save(self, path, dtype="float32"):
+        """ Write the dataset to path
+
+        :param path: a directory (memory-mappable format, see
+                     EncodedDatasetWriter), or a .pkl file (pickle)
+        :param dtype: "float32" or "float16" (directory format only)
+        """
+        if path.endswith(".pkl"):
+            with open(path, 'wb') as f:
+                pkl.dump([self._encodings[i] for i in range(len(self))], f)
+            return
+        writer = EncodedDatasetWriter(path, dtype=dtype)
+        for i in range(len(self)):
+            writer.add(*self._encodings[i])
+        writer.close()
 
     def load(self, path):
         """ Read precomputed contextual embeddings from file
 
-        :param path: path to the embedding file (in npz format)
+        :param path: a directory written by save or by encode with an
+                     output_dir (memory-mapped: the embeddings are views of
+                     the files, loaded lazily) or a .pkl file
         """
-        with open(path, 'rb') as f:
-            self._encodings = pkl.load(f)
+        if os.path.isfile(os.path.join(path, "shards.json")):
+            self._encodings = _ShardedEncodings(path)
+        elif os.path.isdir(path):
+            self._encodings = _MemoryMappedEncodings(path)
+        else:
+            with open(path, 'rb') as f:
+                self._encodings = pkl.load(f)
 
 
 def load_encoded_dataset(path):
@@ -64,48 +326,181 @@ def load_encoded_dataset(path):
     return dataset
 
 
+def collate_encoded_sentences(batch):
+    """collate_fn for a DataLoader over an EncodedDataset: pads the
+    embeddings of a list of EncodedSentence into an EncodedBatch."""
+    lengths = torch.tensor([sentence.embedding.shape[0] for sentence in batch], dtype=torch.long)
+    first = batch[0].embedding
+    max_length = int(lengths.max())
+    embeddings = torch.zeros(len(batch), max_length, first.shape[1], dtype=first.dtype)
+    for i, sentence in enumerate(batch):
+        embeddings[i, :sentence.embedding.shape[0]] = sentence.embedding
+    mask = torch.arange(max_length).unsqueeze(0) < lengths.unsqueeze(1)
+    return EncodedBatch(
+        embeddings=embeddings,
+        mask=mask,
+        lengths=lengths,
+        tokens=[sentence.tokens for sentence in batch],
+    )
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """Batch sampler that puts sentences of similar length in the same
+    batch, to reduce padding.
+
+    The indices are shuffled and split into buckets of bucket_size; each
+    bucket is sorted by length and split into batches of batch_size, and
+    the batches are shuffled. Call set_epoch at each epoch for a different
+    order, as with DistributedSampler.
+
+    Usage:
+        loader = DataLoader(dataset, batch_sampler=LengthBucketSampler(dataset.get_lengths(), 32),
+                            collate_fn=collate_encoded_sentences, num_workers=4)
+
+    Parameters:
+    lengths (list[int]): length of each sentence, e.g. dataset.get_lengths()
+    bucket_size (int): 100 batches by default; the whole dataset is
+                       sorted if it is at least len(lengths)
+    shuffle (bool): if false, the batches follow the order of the lengths
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=None, shuffle=True,
+                 drop_last=False, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size or 100 * batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+        indices = np.arange(len(self.lengths))
+        if self.shuffle:
+            indices = rng.permutation(indices)
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = indices[start:start + self.bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            for batch_start in range(0, len(bucket), self.batch_size):
+                batches.append(bucket[batch_start:batch_start + self.batch_size])
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            full_batches = 0
+            for start in range(0, len(self.lengths), self.bucket_size):
+                full_batches += min(self.bucket_size, len(self.lengths) - start) // self.batch_size
+            return full_batches
+        return sum(
+            -(-min(self.bucket_size, len(self.lengths) - start) // self.batch_size)
+            for start in range(0, len(self.lengths), self.bucket_size)
+        )
+
+
 def _batchify(sentences, batch_size):
-    start = 0
-    while start < len(sentences):
-        yield sentences[start:start + batch_size]
-        start += batch_size
+    # works with any iterable, e.g. a generator over a large corpus
+    sentences = iter(sentences)
+    while True:
+        batch = list(itertools.islice(sentences, batch_size))
+        if not batch:
+            return
+        yield batch
 
 
-def _aggregate_layers(embeddings):
-    """ Average over all layers """
-    new_embed = torch.stack(embeddings, 0)  # [#layers, #batchsize, #max_sent_len, #dim]
-    agg_embed = torch.mean(new_embed, 0)  # [#batchsize, #max_sent_len, #dim]
-    return agg_embed
+def _num_padding_tokens(lengths, batch_size):
+    return sum(
+        max(batch) * len(batch) - sum(batch) for batch in _batchify(lengths, batch_size)
+    )
 
 
-def encode(args, sentences, sort_input=False):
+def encode(args, sentences, sort_input=False, output_dir=None, shard_size=100000, dtype="float32",
+           layers=None):
     """Create an EncodedDataset from a list of sentences
 
     Parameters:
     sentences (list[list[string]]): list of elements. Each element is a list
                                     that contains either a single sentence
                                     or two sentences
-    sort_input (bool): if true, sort sentences by number of tokens in them
+    sort_input (bool): if true, batch together sentences with a similar
+                       number of tokens (as counted by the model tokenizer)
+                       to reduce padding. The dataset is still in the order
+                       of sentences, which is read into memory.
+    output_dir (string): if set, the embeddings of each batch are written to
+                         shards of shard_size sentences in output_dir
+                         (float32 or float16, see dtype) instead of being kept
+                         in memory, and sentences can be any iterable
+                         (e.g., a generator over a large corpus)
+    layers (int or list[int]): layers averaged into the embeddings (the last
+                               k layers, or a list of layer indices), all
+                               the layers by default
 
     Returns:
     dataset (EncodedDataset): an object that contains the contextual
-                              representations of the input sentences
+                              representations of the input sentences (memory
+                              mapped from output_dir if it is set)
     """
     print("Language Models: {}".format(args.lm))
     model = build_model_by_name(args.lm, args)
 
     # sort sentences by number of tokens in them to make sure that in all
     # batches there are sentence with a similar numbers of tokens
+    order = None
     if sort_input:
-        sorted(sentences, key=lambda k: len(" ".join(k).split()) )
+        sentences = list(sentences)
+        lengths = model.get_input_lengths(sentences)
+        order = sorted(range(len(sentences)), key=lambda i: lengths[i])
+        padding = _num_padding_tokens(lengths, args.batch_size)
+        sorted_padding = _num_padding_tokens([lengths[i] for i in order], args.batch_size)
+        print(
+            "padding tokens: {} in sorted batches, {} in input order ({} saved)".format(
+                sorted_padding, padding, padding - sorted_padding
+            )
+        )
+        sentences = [sentences[i] for i in order]
+
+    writer = None
+    if output_dir is not None:
+        writer = ShardedEncodedDatasetWriter(output_dir, shard_size=shard_size, dtype=dtype)
 
     encoded_sents = []
     for current_batch in tqdm(_batchify(sentences, args.batch_size)):
-        embeddings, sent_lens, tokenized_sents = model.get_contextual_embeddings(current_batch)
+        # average over the layers, computed by the model before the copy to
+        # the cpu
+        embeddings, sent_lens, tokenized_sents = model.get_contextual_embeddings(
+            current_batch, layers=layers, pooling="mean"
+        )
 
-        agg_embeddings = _aggregate_layers(embeddings)  # [#batchsize, #max_sent_len, #dim]
+        agg_embeddings = embeddings[0]  # [#batchsize, #max_sent_len, #dim]
         sent_embeddings = [agg_embeddings[i, :l] for i, l in enumerate(sent_lens)]
-        encoded_sents.extend(list(zip(sent_embeddings, sent_lens, tokenized_sents)))
+        if writer is not None:
+            for encoded_sent in zip(sent_embeddings, sent_lens, tokenized_sents):
+                writer.add(*encoded_sent)
+        else:
+            encoded_sents.extend(list(zip(sent_embeddings, sent_lens, tokenized_sents)))
+
+    # position of each input sentence among the encoded ones
+    index = None
+    if order is not None:
+        index = [0] * len(order)
+        for position, i in enumerate(order):
+            index[i] = position
+
+    if writer is not None:
+        writer.close(index)
+        return load_encoded_dataset(output_dir)
+
+    if index is not None:
+        encoded_sents = [encoded_sents[position] for position in index]
 
     dataset = EncodedDataset(encoded_sents)
     return dataset
\ No newline at end of file
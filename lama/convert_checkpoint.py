@@ -0,0 +1,53 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Convert the checkpoint of a model to the flat format of
+lama/modules/flat_checkpoint.py, e.g.
+
+    python lama/convert_checkpoint.py --lm bert --bmn bert-base-cased \\
+        --output-dir pre-trained_language_models/flat/bert-base-cased
+
+The model is then loaded by mapping its weights, with the model directory
+option of the connector: --bert-model-dir, --gpt-model-dir,
+--transformerxl-model-dir or --roberta-model-dir. ELMo weights are already
+read from HDF5 and are not converted.
+"""
+import time
+from lama.modules import build_model_by_name
+import lama.options as options
+
+
+def main(args):
+    if len(args.models_names) != 1:
+        raise ValueError("convert one model at a time, got {}".format(args.models_names))
+    [lm] = args.models_names
+    if args.quantize:
+        raise ValueError("convert the float model: --quantize applies when the model is loaded")
+
+    model = build_model_by_name(lm, args)
+    model.save_flat_checkpoint(args.output_dir)
+    print("{} written to {}".format(lm, args.output_dir))
+
+    # load it back
+    model_dir_option = {
+        "bert": "bert_model_dir",
+        "gpt": "gpt_model_dir",
+        "transformerxl": "transformerxl_model_dir",
+        "roberta": "roberta_model_dir",
+    }[lm]
+    setattr(args, model_dir_option, args.output_dir)
+    start = time.perf_counter()
+    build_model_by_name(lm, args, verbose=False)
+    print("loaded from the flat checkpoint in {:.2f}s (--{})".format(
+        time.perf_counter() - start, model_dir_option.replace("_", "-")))
+
+
+if __name__ == '__main__':
+    parser = options.get_general_parser()
+    parser.add_argument('--output-dir', required=True,
+                        help='directory of the flat checkpoint')
+    args = options.parse_args(parser)
+    main(args)
@@ -0,0 +1,356 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Nearest-neighbour search over the sentences of an encoded dataset (see
+build_encoded_dataset.py), each represented by the mean of its token
+embeddings:
+
+    index = build_index("encoded_corpus", kind="ivfpq", metric="cosine")
+    scores, ids = index.search(probe_embeddings, k=10)
+
+ExactIndex scores the queries against all the vectors, a chunk at a time.
+IVFPQIndex (inverted file with product quantization, in numpy) only scores
+the vectors of the nprobe lists closest to each query, from compressed
+codes of m bytes per vector.
+
+Scores are larger for closer vectors: the inner product for "ip", the
+cosine similarity for "cosine" and minus the squared distance for "l2".
+"""
+import numpy as np
+import torch
+from lama.build_encoded_dataset import (
+    load_encoded_dataset,
+    _MemoryMappedEncodings,
+    _ShardedEncodings,
+)
+
+METRICS = ["ip", "cosine", "l2"]
+
+
+def _check_metric(metric):
+    if metric not in METRICS:
+        raise ValueError("metric should be one of {}, got {}".format(METRICS, metric))
+
+
+def _normalize(x):
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def _as_queries(queries, metric):
+    if isinstance(queries, torch.Tensor):
+        queries = queries.detach().cpu().numpy()
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    if metric == "cosine":
+        queries = _normalize(queries)
+    return queries
+
+
+def _mapped_sentence_means(encodings, chunk_size):
+    """Mean of the token embeddings of each sentence of a
+    _MemoryMappedEncodings, computed on the mapped matrix."""
+    offsets = np.asarray(encodings.offsets)
+    num_sentences = len(offsets) - 1
+    means = np.zeros((num_sentences, encodings.meta["embedding_dim"]), dtype=np.float32)
+    for start in range(0, num_sentences, chunk_size):
+        end = min(start + chunk_size, num_sentences)
+        rows = encodings.embeddings[offsets[start]:offsets[end]].astype(np.float32)
+        starts = offsets[start:end] - offsets[start]
+        lengths = offsets[start + 1:end + 1] - offsets[start:end]
+        nonempty = lengths > 0
+        if rows.shape[0] > 0:
+            # reduceat needs valid (and not empty) segments
+            means[start:end][nonempty] = np.add.reduceat(rows, starts[nonempty], axis=0)
+        means[start:end][nonempty] /= lengths[nonempty, None]
+    return means
+
+
+def sentence_embeddings(dataset, chunk_size=4096):
+    """Returns the mean of the token embeddings of each sentence of dataset
+    (an EncodedDataset or the path of a saved one), [num_sentences, dim]
+    float32, in the order of the dataset. Sentences without tokens get a
+    vector of zeros (not NaN).
+
+    For the memory-mapped formats the means are computed from the mapped
+    embedding matrix, chunk_size sentences at a time.
+    """
+    if isinstance(dataset, str):
+        dataset = load_encoded_dataset(dataset)
+    encodings = dataset._encodings
+    if isinstance(encodings, _MemoryMappedEncodings):
+        return _mapped_sentence_means(encodings, chunk_size)
+    if isinstance(encodings, _ShardedEncodings):
+        means = np.concatenate(
+            [_mapped_sentence_means(shard, chunk_size) for shard in encodings.shards]
+        )
+        if encodings.index is not None:
+            means = means[np.asarray(encodings.index)]
+        return means
+    if len(dataset) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([_sentence_mean(dataset[i].embedding) for i in range(len(dataset))])
+
+
+def _sentence_mean(embedding):
+    """Mean of the token embeddings [num_tokens, dim] of a sentence, zeros
+    for a sentence without tokens (as _mapped_sentence_means)."""
+    embedding = embedding.float()
+    if embedding.shape[0] == 0:
+        return np.zeros(embedding.shape[-1], dtype=np.float32)
+    return embedding.mean(dim=0).numpy()
+
+
+class ExactIndex(object):
+    """Exact search: queries are scored against chunk_size vectors at a
+    time with a matrix multiplication, keeping the running top-k.
+
+    Parameters:
+    vectors (array [num_vectors, dim]): e.g. from sentence_embeddings, or a
+                                        memory-mapped matrix (not copied
+                                        unless metric is "cosine")
+    metric (string): "ip", "cosine" or "l2"
+    """
+
+    def __init__(self, vectors, metric="cosine", chunk_size=65536):
+        _check_metric(metric)
+        self.metric = metric
+        self.chunk_size = chunk_size
+        if metric == "cosine":
+            vectors = _normalize(np.asarray(vectors, dtype=np.float32))
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k=10):
+        """Returns (scores, ids), [num_queries, k] each, best first. If the
+        index has fewer than k vectors, the missing ids are -1."""
+        queries = torch.from_numpy(_as_queries(queries, self.metric))
+        num_queries = queries.shape[0]
+        best_scores = torch.full((num_queries, k), float("-inf"))
+        best_ids = torch.full((num_queries, k), -1, dtype=torch.long)
+        for start in range(0, len(self.vectors), self.chunk_size):
+            chunk = torch.from_numpy(
+                np.asarray(self.vectors[start:start + self.chunk_size], dtype=np.float32)
+            )
+            scores = queries @ chunk.t()
+            if self.metric == "l2":
+                # -|q - x|^2 = 2 q.x - |x|^2 - |q|^2
+                scores.mul_(2).sub_((chunk * chunk).sum(dim=1)).sub_(
+                    (queries * queries).sum(dim=1, keepdim=True)
+                )
+            chunk_k = min(k, chunk.shape[0])
+            chunk_scores, chunk_ids = scores.topk(chunk_k, dim=1)
+            best_scores, position = torch.cat((best_scores, chunk_scores), dim=1).topk(k, dim=1)
+            best_ids = torch.cat((best_ids, chunk_ids + start), dim=1).gather(1, position)
+        return best_scores.numpy(), best_ids.numpy()
+
+
+def kmeans(x, num_clusters, num_iterations=20, seed=0, chunk_size=65536):
+    """Lloyd's algorithm, initialized with random points of x. Returns the
+    centroids [num_clusters, dim] and the cluster of each point."""
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) < num_clusters:
+        raise ValueError(
+            "{} points are not enough for {} clusters".format(len(x), num_clusters)
+        )
+    rng = np.random.RandomState(seed)
+    centroids = x[rng.choice(len(x), num_clusters, replace=False)].copy()
+    assignment = None
+    for _ in range(num_iterations):
+        assignment = _assign(x, centroids, chunk_size)
+        counts = np.bincount(assignment, minlength=num_clusters)
+        nonempty = counts > 0
+        # sum of the points of each cluster, from the points sorted by cluster
+        order = np.argsort(assignment, kind="stable")
+        starts = np.cumsum(counts) - counts
+        sums = np.add.reduceat(x[order], starts[nonempty], axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # empty clusters restart from random points
+        empty = np.flatnonzero(~nonempty)
+        if len(empty) > 0:
+            centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    assignment = _assign(x, centroids, chunk_size)
+    return centroids, assignment
+
+
+def _assign(x, centroids, chunk_size=65536):
+    """Index of the closest centroid (l2) of each point."""
+    centroid_norms = (centroids * centroids).sum(axis=1)
+    assignment = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start:start + chunk_size]
+        # |x - c|^2 up to |x|^2, constant for each point
+        distances = centroid_norms - 2 * chunk @ centroids.T
+        assignment[start:start + chunk_size] = distances.argmin(axis=1)
+    return assignment
+
+
+class IVFPQIndex(object):
+    """Approximate search: the vectors are partitioned by a coarse k-means
+    into num_lists inverted lists, and the residual of each vector (vector
+    minus its centroid) is product-quantized: split into m sub-vectors, each
+    stored as the id of the closest of 2^nbits centroids of its subspace.
+    A query is only scored against the vectors of the nprobe closest lists,
+    from lookup tables of the query and the sub-centroids.
+
+    train must be called before add and search.
+
+    Parameters:
+    dim (int): dimension of the vectors, a multiple of m
+    num_lists (int): number of inverted lists (coarse centroids)
+    m (int): number of sub-vectors (bytes per vector)
+    nbits (int): bits per sub-vector code, at most 8
+    metric (string): "ip", "cosine" or "l2"
+    """
+
+    def __init__(self, dim, num_lists=256, m=8, nbits=8, metric="cosine", seed=0):
+        _check_metric(metric)
+        if dim % m != 0:
+            raise ValueError("dim {} is not a multiple of m {}".format(dim, m))
+        if not 1 <= nbits <= 8:
+            raise ValueError("nbits should be between 1 and 8, got {}".format(nbits))
+        self.dim = dim
+        self.num_lists = num_lists
+        self.m = m
+        self.num_codes = 2 ** nbits
+        self.metric = metric
+        self.seed = seed
+        self.centroids = None  # [num_lists, dim]
+        self.codebooks = None  # [m, num_codes, dim / m]
+        self._list_ids = [[] for _ in range(num_lists)]
+        self._list_codes = [[] for _ in range(num_lists)]
+        self.num_vectors = 0
+
+    def __len__(self):
+        return self.num_vectors
+
+    def _prepare(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.metric == "cosine":
+            x = _normalize(x)
+        return x
+
+    def _split(self, x):
+        # [n, dim] -> [m, n, dim / m]
+        return x.reshape(len(x), self.m, -1).transpose(1, 0, 2)
+
+    def train(self, x, num_iterations=20):
+        x = self._prepare(x)
+        self.centroids, assignment = kmeans(x, self.num_lists, num_iterations, self.seed)
+        residuals = self._split(x - self.centroids[assignment])
+        self.codebooks = np.stack([
+            kmeans(residuals[j], self.num_codes, num_iterations, self.seed + 1 + j)[0]
+            for j in range(self.m)
+        ])
+
+    def add(self, x, chunk_size=65536):
+        """Add x, numbered from len(self) on."""
+        if self.centroids is None:
+            raise RuntimeError("the index must be trained before adding vectors")
+        for start in range(0, len(x), chunk_size):
+            chunk = self._prepare(x[start:start + chunk_size])
+            assignment = _assign(chunk, self.centroids)
+            residuals = self._split(chunk - self.centroids[assignment])
+            codes = np.stack(
+                [_assign(residuals[j], self.codebooks[j]) for j in range(self.m)], axis=1
+            ).astype(np.uint8)
+            ids = np.arange(len(chunk), dtype=np.int64) + self.num_vectors
+            order = np.argsort(assignment, kind="stable")
+            lists, list_starts = np.unique(assignment[order], return_index=True)
+            for list_id, group in zip(lists, np.split(order, list_starts[1:])):
+                self._list_ids[list_id].append(ids[group])
+                self._list_codes[list_id].append(codes[group])
+            self.num_vectors += len(chunk)
+
+    def _get_list(self, list_id):
+        # concatenate what was added since the last search
+        if len(self._list_ids[list_id]) > 1:
+            self._list_ids[list_id] = [np.concatenate(self._list_ids[list_id])]
+            self._list_codes[list_id] = [np.concatenate(self._list_codes[list_id])]
+        if not self._list_ids[list_id]:
+            return None, None
+        return self._list_ids[list_id][0], self._list_codes[list_id][0]
+
+    def search(self, queries, k=10, nprobe=8, max_table_size=2 ** 22):
+        """Returns (scores, ids), [num_queries, k] each, best first. The
+        scores are computed from the quantized vectors. Missing ids are -1.
+
+        Each inverted list is scored at once for all the queries that probe
+        it, max_table_size gathered floats at a time.
+        """
+        queries = self._prepare(_as_queries(queries, "ip"))
+        num_queries = len(queries)
+        nprobe = min(nprobe, self.num_lists)
+        if self.metric == "l2":
+            coarse = 2 * queries @ self.centroids.T - (self.centroids ** 2).sum(axis=1)
+        else:
+            coarse = queries @ self.centroids.T
+        probes = np.argsort(-coarse, axis=1)[:, :nprobe]
+
+        sub_queries = queries.reshape(num_queries, self.m, 1, -1)
+        if self.metric != "l2":
+            # q.(c + r) = q.c + sum_j q_j.r_j: the tables do not depend on the list
+            tables = (sub_queries * self.codebooks).sum(axis=3)  # [num_queries, m, num_codes]
+        else:
+            codebook_norms = (self.codebooks ** 2).sum(axis=2)  # [m, num_codes]
+
+        best_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        best_ids = np.full((num_queries, k), -1, dtype=np.int64)
+        columns = np.arange(self.m)
+        for list_id in np.unique(probes):
+            ids, codes = self._get_list(list_id)
+            if ids is None:
+                continue
+            list_queries = np.flatnonzero((probes == list_id).any(axis=1))
+            step = max(1, max_table_size // (len(ids) * self.m))
+            for start in range(0, len(list_queries), step):
+                qs = list_queries[start:start + step]
+                if self.metric == "l2":
+                    # -|q - c - r|^2 = sum_j (2 (q - c)_j.r_j - |r_j|^2) - |q - c|^2
+                    sub_residuals = sub_queries[qs] - self.centroids[list_id].reshape(self.m, 1, -1)
+                    table = 2 * (sub_residuals * self.codebooks).sum(axis=3) - codebook_norms
+                    offset = -(sub_residuals ** 2).sum(axis=(1, 2, 3))
+                else:
+                    table = tables[qs]
+                    offset = coarse[qs, list_id]
+                # [len(qs), len(ids), m] -> [len(qs), len(ids)]
+                scores = table[:, columns, codes].sum(axis=2) + offset[:, None]
+                candidate_ids = np.broadcast_to(ids, scores.shape)
+                if scores.shape[1] > k:
+                    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                    scores = np.take_along_axis(scores, top, axis=1)
+                    candidate_ids = np.take_along_axis(candidate_ids, top, axis=1)
+                scores = np.concatenate((best_scores[qs], scores), axis=1)
+                candidate_ids = np.concatenate((best_ids[qs], candidate_ids), axis=1)
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                best_scores[qs] = np.take_along_axis(scores, top, axis=1)
+                best_ids[qs] = np.take_along_axis(candidate_ids, top, axis=1)
+
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+
+def build_index(dataset, kind="exact", metric="cosine", train_size=100000, seed=0, **kwargs):
+    """Index the sentences of dataset (an EncodedDataset or the path of a
+    saved one, see sentence_embeddings).
+
+    kind is "exact" (ExactIndex) or "ivfpq" (IVFPQIndex, trained on at most
+    train_size random sentences); kwargs are passed to the index.
+    """
+    vectors = sentence_embeddings(dataset)
+    if kind == "exact":
+        return ExactIndex(vectors, metric=metric, **kwargs)
+    if kind != "ivfpq":
+        raise ValueError("kind should be exact or ivfpq, got {}".format(kind))
+    index = IVFPQIndex(vectors.shape[1], metric=metric, seed=seed, **kwargs)
+    rng = np.random.RandomState(seed)
+    sample = vectors
+    if len(vectors) > train_size:
+        sample = vectors[rng.choice(len(vectors), train_size, replace=False)]
+    index.train(sample)
+    index.add(vectors)
+    return index
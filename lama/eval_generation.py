@@ -4,7 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
-from lama.modules import build_model_by_name
+from lama.modules import get_model_pool
 from lama.utils import print_sentence_predictions, load_vocab
 import lama.options as options
 import lama.evaluation_metrics as evaluation_metrics
@@ -25,9 +25,9 @@ def main(args):
 
     print("Language Models: {}".format(args.models_names))
 
-    models = {}
-    for lm in args.models_names:
-        models[lm] = build_model_by_name(lm, args)
+    # the models are loaded once and kept in the pool within its budget
+    pool = get_model_pool()
+    pool.set_max_memory(options.get_models_memory(args))
 
     vocab_subset = None
     if args.common_vocab_filename is not None:
@@ -35,6 +35,12 @@ def main(args):
         print("common vocabulary size: {}".format(len(common_vocab)))
         vocab_subset = [x for x in common_vocab]
 
+    nlp = None
+    if args.split_sentence:
+        import spacy
+        # use spacy to tokenize input sentence (loaded once, not for each input)
+        nlp = spacy.load(args.spacy_model)
+
     while stopping_condition:
         if args.text:
             text = args.text
@@ -42,10 +48,7 @@ def main(args):
         else:
             text = input("insert text:")
 
-        if args.split_sentence:
-            import spacy
-            # use spacy to tokenize input sentence
-            nlp = spacy.load(args.spacy_model)
+        if nlp is not None:
             tokens = nlp(text)
             print(tokens)
             sentences = []
@@ -59,24 +62,25 @@ def main(args):
             print("WARNING: only the first two sentences in the text will be considered!")
             sentences = sentences[:2]
 
-        for model_name, model in models.items():
-            print("\n{}:".format(model_name))
-            original_log_probs_list, [token_ids], [masked_indices] = model.get_batch_generation([sentences], try_cuda=False)
+        for model_name in args.models_names:
+            with pool.model(model_name, args) as model:
+                print("\n{}:".format(model_name))
+                original_log_probs_list, [token_ids], [masked_indices] = model.get_batch_generation([sentences], try_cuda=False)
 
-            index_list = None
-            if vocab_subset is not None:
-                # filter log_probs
-                filter_logprob_indices, index_list = model.init_indices_for_filter_logprobs(vocab_subset)
-                filtered_log_probs_list = model.filter_logprobs(original_log_probs_list, filter_logprob_indices)
-            else:
-                filtered_log_probs_list = original_log_probs_list
+                index_list = None
+                if vocab_subset is not None:
+                    # filter log_probs
+                    filter_logprob_indices, index_list = model.init_indices_for_filter_logprobs(vocab_subset)
+                    filtered_log_probs_list = model.filter_logprobs(original_log_probs_list, filter_logprob_indices)
+                else:
+                    filtered_log_probs_list = original_log_probs_list
 
-            # rank over the subset of the vocab (if defined) for the SINGLE masked tokens
-            if masked_indices and len(masked_indices) > 0:
-                evaluation_metrics.get_ranking(filtered_log_probs_list[0], masked_indices, model.vocab, index_list=index_list)
+                # rank over the subset of the vocab (if defined) for the SINGLE masked tokens
+                if masked_indices and len(masked_indices) > 0:
+                    evaluation_metrics.get_ranking(filtered_log_probs_list[0], masked_indices, model.vocab, index_list=index_list)
 
-            # prediction and perplexity for the whole softmax
-            print_sentence_predictions(original_log_probs_list[0], token_ids, model.vocab, masked_indices=masked_indices)
+                # prediction and perplexity for the whole softmax
+                print_sentence_predictions(original_log_probs_list[0], token_ids, model.vocab, masked_indices=masked_indices)
 
 
 def main_too(args):
@@ -92,9 +96,9 @@ def main_too(args):
 
     print("Language Models: {}".format(args.models_names))
 
-    models = {}
-    for lm in args.models_names:
-        models[lm] = build_model_by_name(lm, args)
+    # the models are loaded once and kept in the pool within its budget
+    pool = get_model_pool()
+    pool.set_max_memory(options.get_models_memory(args))
 
     vocab_subset = None
     if args.common_vocab_filename is not None:
@@ -156,45 +160,46 @@ def main_too(args):
                         print("WARNING: only the first two sentences in the text will be considered!")
                         sentences = sentences[:2]
 
-                    for model_name, model in models.items():
-                        print("\n{}:".format(model_name))
-                        original_log_probs_list, [token_ids], [masked_indices] = model.get_batch_generation([sentences], try_cuda=False)
-
-                        index_list = None
-                        if vocab_subset is not None:
-                            # filter log_probs
-                            filter_logprob_indices, index_list = model.init_indices_for_filter_logprobs(vocab_subset)
-                            filtered_log_probs_list = model.filter_logprobs(original_log_probs_list, filter_logprob_indices)
-                        else:
-                            filtered_log_probs_list = original_log_probs_list
-
-                        # rank over the subset of the vocab (if defined) for the SINGLE masked tokens
-                        if masked_indices and len(masked_indices) > 0:
-                            evaluation_metrics.get_ranking(filtered_log_probs_list[0], masked_indices, model.vocab, index_list=index_list)
-
-                        msg_pre = "\n"
-                        msg_pre += 'Subject: {}\n'.format(sub_label)
-                        msg_pre += 'Gold Object: {}\n'.format(obj_label)
-                        msg_pre += 'Prompt: {}\n'.format(prompt)
-
-                        # prediction and perplexity for the whole softmax
-                        perp, msg_post, pred_obj = print_sentence_predictions(original_log_probs_list[0], token_ids, model.vocab, masked_indices=masked_indices)
-
-                        msg_pre += 'Pred Object: {}\n'.format(pred_obj)
-
-                        # Keep track of accuracy
-                        if obj_label == pred_obj:
-                            num_correct += 1
-                        num_samples += 1
-
-                        # Skip samples where predicted object matches gold object
-                        # if obj_label != pred_obj:
-                        # Make directories in path if they don't exist
-                        filepath = os.path.join(out_dir, rel_name + '.txt')
-                        os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                        with open(filepath, 'a+') as f_out:
-                            f_out.write(msg_pre + msg_post + '\n')
-                        count += 1
+                    for model_name in args.models_names:
+                        with pool.model(model_name, args) as model:
+                            print("\n{}:".format(model_name))
+                            original_log_probs_list, [token_ids], [masked_indices] = model.get_batch_generation([sentences], try_cuda=False)
+
+                            index_list = None
+                            if vocab_subset is not None:
+                                # filter log_probs
+                                filter_logprob_indices, index_list = model.init_indices_for_filter_logprobs(vocab_subset)
+                                filtered_log_probs_list = model.filter_logprobs(original_log_probs_list, filter_logprob_indices)
+                            else:
+                                filtered_log_probs_list = original_log_probs_list
+
+                            # rank over the subset of the vocab (if defined) for the SINGLE masked tokens
+                            if masked_indices and len(masked_indices) > 0:
+                                evaluation_metrics.get_ranking(filtered_log_probs_list[0], masked_indices, model.vocab, index_list=index_list)
+
+                            msg_pre = "\n"
+                            msg_pre += 'Subject: {}\n'.format(sub_label)
+                            msg_pre += 'Gold Object: {}\n'.format(obj_label)
+                            msg_pre += 'Prompt: {}\n'.format(prompt)
+
+                            # prediction and perplexity for the whole softmax
+                            perp, msg_post, pred_obj = print_sentence_predictions(original_log_probs_list[0], token_ids, model.vocab, masked_indices=masked_indices)
+
+                            msg_pre += 'Pred Object: {}\n'.format(pred_obj)
+
+                            # Keep track of accuracy
+                            if obj_label == pred_obj:
+                                num_correct += 1
+                            num_samples += 1
+
+                            # Skip samples where predicted object matches gold object
+                            # if obj_label != pred_obj:
+                            # Make directories in path if they don't exist
+                            filepath = os.path.join(out_dir, rel_name + '.txt')
+                            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                            with open(filepath, 'a+') as f_out:
+                                f_out.write(msg_pre + msg_post + '\n')
+                            count += 1
 
                     # Move on to next relation once we hit 10 samples for a relation
                     if count >= num_samples_per_rel:
@@ -24,9 +24,21 @@ def __max_probs_values_indices(masked_indices, log_probs, topk=1000):
     return log_probs, index_max_probs, value_max_probs
 
 
-def __print_top_k(value_max_probs, index_max_probs, vocab, mask_topk, index_list, max_printouts = 10):
-    result = []
+def format_top_k(result_masked_topk, max_printouts = 10):
+    """The message of the first max_printouts predictions of the topk list
+    of get_ranking."""
     msg = "\n| Top{} predictions\n".format(max_printouts)
+    for element in result_masked_topk[:max_printouts]:
+        msg += "{:<8d}{:<20s}{:<12.3f}\n".format(
+            element['i'],
+            element['token_word_form'],
+            element['log_prob']
+        )
+    return msg
+
+
+def __print_top_k(value_max_probs, index_max_probs, vocab, mask_topk, index_list, max_printouts = 10, format_msg=True):
+    result = []
     for i in range(mask_topk):
         filtered_idx = index_max_probs[i].item()
 
@@ -40,23 +52,22 @@ def __print_top_k(value_max_probs, index_max_probs, vocab, mask_topk, index_list
         log_prob = value_max_probs[i].item()
         word_form = vocab[idx]
 
-        if i < max_printouts:
-            msg += "{:<8d}{:<20s}{:<12.3f}\n".format(
-                i,
-                word_form,
-                log_prob
-            )
         element = {'i' : i, 'token_idx': idx, 'log_prob': log_prob, 'token_word_form': word_form}
         result.append(element)
+    msg = format_top_k(result, max_printouts) if format_msg else ""
     return result, msg
 
 
-def get_ranking(log_probs, masked_indices, vocab, label_index = None, index_list = None, topk = 1000, P_AT = 10, print_generation=True):
+def get_ranking(log_probs, masked_indices, vocab, label_index = None, index_list = None, topk = 1000, P_AT = 10, print_generation=True, format_msg=True):
+    # with format_msg False (and no print_generation) the returned message
+    # is empty: format_top_k(experiment_result['topk']) builds it on demand
 
     experiment_result = {}
 
     log_probs, index_max_probs, value_max_probs = __max_probs_values_indices(masked_indices, log_probs, topk=topk)
-    result_masked_topk, return_msg = __print_top_k(value_max_probs, index_max_probs, vocab, topk, index_list)
+    result_masked_topk, return_msg = __print_top_k(
+        value_max_probs, index_max_probs, vocab, topk, index_list, format_msg=format_msg or print_generation
+    )
     experiment_result['topk'] = result_masked_topk
 
     if print_generation:
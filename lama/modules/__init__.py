@@ -4,28 +4,54 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
-from .bert_connector import Bert
-from .elmo_connector import Elmo
-from .gpt_connector import GPT
-from .transformerxl_connector import TransformerXL
-from .roberta_connector import Roberta
+import importlib
+from .model_pool import ModelPool, get_model_pool
 
+# model name -> (connector module, connector class). The modules are only
+# imported when the model is built: each one pulls in its backend
+# (pytorch_pretrained_bert, allennlp or fairseq), which is slow and may not be
+# installed.
+MODEL_NAME_TO_CLASS = dict(
+    elmo=(".elmo_connector", "Elmo"),
+    bert=(".bert_connector", "Bert"),
+    gpt=(".gpt_connector", "GPT"),
+    transformerxl=(".transformerxl_connector", "TransformerXL"),
+    roberta=(".roberta_connector", "Roberta"),
+)
 
-def build_model_by_name(lm, args, verbose=True):
+_CLASS_TO_MODULE = {name: module for module, name in MODEL_NAME_TO_CLASS.values()}
+
+
+def get_connector_class(lm):
+    """Import and return the connector class of a model name."""
+    if lm not in MODEL_NAME_TO_CLASS:
+        raise ValueError("Unrecognized Language Model: %s." % lm)
+    module, name = MODEL_NAME_TO_CLASS[lm]
+    return getattr(importlib.import_module(module, __name__), name)
+
+
+def __getattr__(name):
+    # from lama.modules import Bert, ... (PEP 562)
+    if name in _CLASS_TO_MODULE:
+        return getattr(importlib.import_module(_CLASS_TO_MODULE[name], __name__), name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_CLASS_TO_MODULE))
+
+
+def build_model_by_name(lm, args, verbose=True, background_weights=False):
     """Load a model by name and args.
 
     Note, args.lm is not used for model selection. args are only passed to the
     model's initializator.
+
+    If background_weights is True, the model is returned as soon as its
+    tokenizer and vocabulary are loaded, and its weights are loaded in a
+    background thread (see Base_Connector.load_weights).
     """
-    MODEL_NAME_TO_CLASS = dict(
-        elmo=Elmo,
-        bert=Bert,
-        gpt=GPT,
-        transformerxl=TransformerXL,
-        roberta=Roberta
-    )
-    if lm not in MODEL_NAME_TO_CLASS:
-        raise ValueError("Unrecognized Language Model: %s." % lm)
+    model_class = get_connector_class(lm)
     if verbose:
         print("Loading %s model..." % lm)
-    return MODEL_NAME_TO_CLASS[lm](args)
+    return model_class(args, background_weights=background_weights)
@@ -5,6 +5,7 @@
 # LICENSE file in the root directory of this source tree.
 #
 import re
+import threading
 import torch
 
 MASK = "[MASK]"
@@ -66,6 +67,134 @@ def default_tokenizer(line):
     return result
 
 
+def pool_layers(encoder_layers, attention_mask=None, layers=None, pooling=None):
+    """Select and pool the layers returned by a model, on the device of the
+    model, and move the result to the cpu.
+
+    Args:
+        encoder_layers: list of tensors [batch_size, sequence_length, hidden_size]
+        attention_mask: [batch_size, sequence_length] 1 for tokens, 0 for
+            padding (only used by "mean_tokens")
+        layers: None (all the layers), an int k (the last k layers) or a
+            list of layer indices
+        pooling: None (the selected layers), "mean" (average of the
+            selected layers), a list of one weight per selected layer
+            (scalar mix: sum of the layers weighted by the softmax of the
+            weights) or "mean_tokens" (average of the selected layers and of
+            the tokens that are not padding)
+
+    Returns:
+        A list of tensors on the cpu: the selected layers, or a single
+        pooled tensor [batch_size, sequence_length, hidden_size]
+        ([batch_size, hidden_size] for "mean_tokens").
+    """
+    if layers is not None:
+        if isinstance(layers, int):
+            if layers <= 0:
+                raise ValueError("layers should be positive, got {}".format(layers))
+            encoder_layers = encoder_layers[-layers:]
+        else:
+            encoder_layers = [encoder_layers[i] for i in layers]
+
+    if pooling is None:
+        return [layer.cpu() for layer in encoder_layers]
+
+    if isinstance(pooling, str):
+        if pooling not in ("mean", "mean_tokens"):
+            raise ValueError("unknown pooling {}".format(pooling))
+        pooled = encoder_layers[0].clone()
+        for layer in encoder_layers[1:]:
+            pooled.add_(layer)
+        pooled.div_(len(encoder_layers))
+    else:
+        if len(pooling) != len(encoder_layers):
+            raise ValueError(
+                "{} weights for {} layers".format(len(pooling), len(encoder_layers))
+            )
+        weights = torch.softmax(torch.as_tensor(pooling, dtype=torch.float), dim=0)
+        pooled = encoder_layers[0] * weights[0].item()
+        for weight, layer in zip(weights[1:], encoder_layers[1:]):
+            pooled.add_(layer, alpha=weight.item())
+
+    if pooling == "mean_tokens":
+        if attention_mask is None:
+            mask = torch.ones(pooled.shape[:2], dtype=pooled.dtype, device=pooled.device)
+        else:
+            mask = attention_mask.to(device=pooled.device, dtype=pooled.dtype)
+        mask = mask[:, :pooled.shape[1]].unsqueeze(-1)
+        pooled = (pooled * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+    return [pooled.cpu()]
+
+
+def quantize_linear_layers(module):
+    """Dynamic int8 quantization of the torch.nn.Linear layers of module, for
+    CPU inference: their weights are stored in int8 and the activations are
+    quantized on the fly at each matmul. Returns the quantized module (the
+    layers are replaced in place, except for a module that is itself a
+    Linear layer)."""
+    if not hasattr(torch, "quantization") or not hasattr(torch.quantization, "quantize_dynamic"):
+        raise RuntimeError("dynamic quantization requires torch >= 1.3")
+    if isinstance(module, torch.nn.Linear):
+        return quantize_linear_layers(torch.nn.Sequential(module))[0]
+    return torch.quantization.quantize_dynamic(
+        module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
+
+
+def truncate_around_mask(sentences_tokens, is_mask, max_tokens):
+    """Truncate the tokens of the sentences of an input to at most max_tokens
+    in total, keeping a window centered on the masks.
+
+    The sentences that contain a mask (the template of a context probe) are
+    always kept whole, so that the window can be longer than max_tokens; the
+    other sentences (the context) lose the tokens that are farthest from the
+    masks.
+
+    Args:
+        sentences_tokens: list of the token lists of each sentence
+        is_mask: function of a token, True for a mask
+        max_tokens: maximum number of tokens (None: no truncation)
+
+    Returns:
+        The truncated token lists (empty for a sentence that is entirely
+        outside of the window) and the number of removed tokens.
+    """
+    length = sum(len(tokens) for tokens in sentences_tokens)
+    if max_tokens is None or length <= max_tokens:
+        return sentences_tokens, 0
+
+    # positions of the masks and of the sentences that contain them
+    masks = []
+    kept_start, kept_end = length, 0
+    offset = 0
+    for tokens in sentences_tokens:
+        sentence_masks = [offset + i for i, token in enumerate(tokens) if is_mask(token)]
+        if sentence_masks:
+            masks.extend(sentence_masks)
+            kept_start = min(kept_start, offset)
+            kept_end = max(kept_end, offset + len(tokens))
+        offset += len(tokens)
+    if not masks:
+        # nothing to center on: keep the beginning
+        masks = [0]
+        kept_start, kept_end = 0, 0
+
+    window = max(max_tokens, kept_end - kept_start)
+    center = (masks[0] + masks[-1]) // 2
+    start = min(max(center - window // 2, 0), length - window)
+    # shifted to contain the kept sentences
+    start = max(min(start, kept_start), kept_end - window)
+    end = start + window
+
+    truncated = []
+    offset = 0
+    for tokens in sentences_tokens:
+        truncated.append(tokens[max(start - offset, 0):max(end - offset, 0)])
+        offset += len(tokens)
+    return truncated, length - window
+
+
 class Base_Connector():
 
     def __init__(self):
@@ -76,6 +205,60 @@ class Base_Connector():
         # This defines where the device where the model is. Changed by try_cuda.
         self._model_device = 'cpu'
 
+        # int8 Linear layers (--quantize), set by load_weights
+        self.quantized = False
+
+        # inputs truncated by _truncate_around_mask (--max-context-tokens)
+        self.truncation_stats = {"inputs": 0, "truncated_inputs": 0, "removed_tokens": 0}
+
+    def _load_weights(self, args):
+        """Load the weights of the model. Called by load_weights, once the
+        tokenizer and the vocabulary are ready."""
+        pass
+
+    def load_weights(self, args, background=False):
+        """Load the weights of the model, in a background thread if
+        background is True: get_id, the vocabulary and the tokenizer can be
+        used meanwhile (e.g., to read and filter the data), and the methods
+        that use the weights (get_batch_generation, get_contextual_embeddings,
+        try_cuda, _torch_modules, ...) call wait_for_weights first.
+
+        With args.quantize, _load_weights quantizes the Linear layers of the
+        model (see _quantize)."""
+        self.quantized = getattr(args, "quantize", False)
+        if not background:
+            self._load_weights(args)
+            return
+        self._weights_error = None
+
+        def load():
+            try:
+                self._load_weights(args)
+            except BaseException as e:
+                self._weights_error = e
+
+        self._weights_thread = threading.Thread(target=load, name="load_weights", daemon=True)
+        self._weights_thread.start()
+
+    def _quantize(self, module):
+        """module with its Linear layers quantized if the model is quantized,
+        module otherwise."""
+        if not self.quantized:
+            return module
+        return quantize_linear_layers(module)
+
+    def wait_for_weights(self):
+        """Wait for the weights loaded in the background, if any, and raise
+        the error of their loading."""
+        thread = getattr(self, "_weights_thread", None)
+        if thread is None:
+            return
+        thread.join()
+        self._weights_thread = None
+        if self._weights_error is not None:
+            error, self._weights_error = self._weights_error, None
+            raise error
+
     def optimize_top_layer(self, vocab_subset):
         """
         optimization for some LM
@@ -87,7 +270,10 @@ class Base_Connector():
 
     def try_cuda(self):
         """Move model to GPU if one is available."""
-        if torch.cuda.is_available():
+        self.wait_for_weights()
+        if self.quantized:
+            print('Quantized model: staying on CPU')
+        elif torch.cuda.is_available():
             if self._model_device != 'cuda':
                 print('Moving model to CUDA')
                 self._cuda()
@@ -99,6 +285,27 @@ class Base_Connector():
         """Move model to GPU."""
         raise NotImplementedError
 
+    def _torch_modules(self):
+        """Return the torch modules that contain the weights of the model."""
+        raise NotImplementedError
+
+    def save_flat_checkpoint(self, path):
+        """Write the weights, config and vocabulary of the model to the
+        directory path, in the format of flat_checkpoint.py. The model
+        directory option of the connector (e.g. --bert-model-dir) then maps
+        the weights from path instead of unpickling a checkpoint."""
+        raise NotImplementedError()
+
+    def share_memory(self):
+        """Move the weights of the model to shared memory.
+
+        Processes forked after this call map the same weights instead of
+        holding a private copy, so N CPU workers cost roughly the memory of a
+        single model.
+        """
+        for module in self._torch_modules():
+            module.share_memory()
+
     def init_indices_for_filter_logprobs(self, vocab_subset, logger=None):
         index_list = []
         new_vocab_subset = []
@@ -122,6 +329,21 @@ class Base_Connector():
         new_log_probs = log_probs.index_select(dim=2 , index=indices)
         return new_log_probs
 
+    def _truncate_around_mask(self, sentences_tokens, is_mask, max_tokens, count=True):
+        """truncate_around_mask, counted in truncation_stats if count."""
+        sentences_tokens, removed_tokens = truncate_around_mask(sentences_tokens, is_mask, max_tokens)
+        if count:
+            self.truncation_stats["inputs"] += 1
+            self.truncation_stats["truncated_inputs"] += removed_tokens > 0
+            self.truncation_stats["removed_tokens"] += removed_tokens
+        return sentences_tokens
+
+    def pop_truncation_stats(self):
+        """The truncation_stats since the last call."""
+        stats = self.truncation_stats
+        self.truncation_stats = {key: 0 for key in stats}
+        return stats
+
     def get_id(self, string):
         raise NotImplementedError()
 
@@ -133,20 +355,32 @@ class Base_Connector():
     def get_batch_generation(self, sentences_list, logger= None, try_cuda=True):
         raise NotImplementedError()
 
-    def get_contextual_embeddings(self, sentences):
+    def get_input_lengths(self, sentences_list):
+        """Number of input tokens of each element of sentences_list (see
+        get_contextual_embeddings), used to batch inputs of similar length.
+
+        This default counts whitespace separated words: connectors with a
+        subword tokenizer return the lengths of their actual inputs.
+        """
+        return [len(" ".join(sentences).split()) for sentences in sentences_list]
+
+    def get_contextual_embeddings(self, sentences, try_cuda=True, layers=None, pooling=None):
         """Compute the contextual embeddings of a list of sentences
 
         Parameters:
         sentences (list[list[string]]): list of elements. Each element is a list
                                         that contains either a single sentence
                                         or two sentences
+        layers, pooling: select and pool the layers before they are moved
+                         to the cpu, see pool_layers
 
         Returns:
         encoder_layers (list(Tensor)): a list of the full sequences of encoded-hidden-states
                             at the end of each attention block (e.g., 12 full
                             sequences for BERT-base,), each encoded-hidden-state
                             is a torch.FloatTensor of size [batch_size,
-                            sequence_length, hidden_size]
+                            sequence_length, hidden_size]. A single tensor
+                            if pooling is set.
         sentence_lengths (list[int]): list of lenghts for the sentences in the
                                       batch
         tokenized_text_list: (list[list[string]]): tokenized text for the sentences
@@ -4,13 +4,21 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
+import os
 import torch
 import pytorch_pretrained_bert.tokenization as btok
-from pytorch_pretrained_bert import BertTokenizer, BertForMaskedLM, BasicTokenizer, BertModel
+from pytorch_pretrained_bert import BertTokenizer, BertForMaskedLM, BasicTokenizer, BertModel, BertConfig
 import numpy as np
 from lama.modules.base_connector import *
+from lama.modules.flat_checkpoint import (
+    is_flat_checkpoint, save_flat_checkpoint, load_flat_config, load_flat_model
+)
 import torch.nn.functional as F
 
+# with --bert-jit, the inputs are padded to a multiple of this length, so
+# that the traced models are shared by inputs of similar length
+JIT_LENGTH_BUCKET = 8
+
 
 class CustomBaseTokenizer(BasicTokenizer):
 
@@ -48,7 +56,7 @@ class CustomBaseTokenizer(BasicTokenizer):
 
 class Bert(Base_Connector):
 
-    def __init__(self, args, vocab_subset = None):
+    def __init__(self, args, vocab_subset = None, background_weights=False):
         super().__init__()
 
         bert_model_name = args.bert_model_name
@@ -69,6 +77,14 @@ class Bert(Base_Connector):
         if 'uncased' in bert_model_name:
             do_lower_case=True
 
+        self.flat_config = None
+        if is_flat_checkpoint(args.bert_model_dir):
+            # written by lama/convert_checkpoint.py
+            self.flat_config = load_flat_config(args.bert_model_dir)
+            do_lower_case = self.flat_config.pop("do_lower_case", do_lower_case)
+        self.vocab_name = args.bert_vocab_name
+        self.bert_model_name = bert_model_name
+
         # Load pre-trained model tokenizer (vocabulary)
         self.tokenizer = BertTokenizer.from_pretrained(dict_file)
 
@@ -81,18 +97,37 @@ class Bert(Base_Connector):
         custom_basic_tokenizer = CustomBaseTokenizer(do_lower_case = do_lower_case)
         self.tokenizer.basic_tokenizer = custom_basic_tokenizer
 
+        self.pad_id = self.inverse_vocab[BERT_PAD]
+
+        self.unk_index = self.inverse_vocab[BERT_UNK]
+
+        # (batch size, padded length, device) -> traced masked_bert_model
+        self.jit = getattr(args, "bert_jit", False)
+        self.__traced_models = {}
+        # with --bert-pack-length, several inputs share a row of the masked LM forward
+        self.pack_length = getattr(args, "bert_pack_length", None)
+        # with --max-context-tokens, the inputs are truncated around the mask
+        self.max_context_tokens = getattr(args, "max_context_tokens", None)
+
+        self.load_weights(args, background=background_weights)
+
+    def _load_weights(self, args):
         # Load pre-trained model (weights)
         # ... to get prediction/generation
-        self.masked_bert_model = BertForMaskedLM.from_pretrained(bert_model_name)
+        if self.flat_config is not None:
+            # map the weights instead of unpickling them
+            masked_bert_model = load_flat_model(
+                lambda: BertForMaskedLM(BertConfig.from_dict(self.flat_config)), args.bert_model_dir
+            )
+        else:
+            masked_bert_model = BertForMaskedLM.from_pretrained(self.bert_model_name)
 
-        self.masked_bert_model.eval()
+        masked_bert_model.eval()
+        masked_bert_model = self._quantize(masked_bert_model)
 
         # ... to get hidden states
-        self.bert_model = self.masked_bert_model.bert
-
-        self.pad_id = self.inverse_vocab[BERT_PAD]
-
-        self.unk_index = self.inverse_vocab[BERT_UNK]
+        self.bert_model = masked_bert_model.bert
+        self.masked_bert_model = masked_bert_model
 
     def get_id(self, string):
         tokenized_text = self.tokenizer.tokenize(string)
@@ -157,7 +192,9 @@ class Bert(Base_Connector):
             print(sentences)
             raise ValueError("BERT accepts maximum two sentences in input for each data point")
 
-        first_tokenized_sentence = self.tokenizer.tokenize(sentences[0])
+        tokenized_sentences = self.__tokenize(sentences)
+
+        first_tokenized_sentence = tokenized_sentences[0]
         first_segment_id = np.zeros(len(first_tokenized_sentence), dtype=int).tolist()
 
         # add [SEP] token at the end
@@ -165,7 +202,7 @@ class Bert(Base_Connector):
         first_segment_id.append(0)
 
         if len(sentences)>1 :
-            second_tokenized_sentece = self.tokenizer.tokenize(sentences[1])
+            second_tokenized_sentece = tokenized_sentences[1]
             second_segment_id = np.full(len(second_tokenized_sentece),1, dtype=int).tolist()
 
             # add [SEP] token at the end
@@ -197,6 +234,24 @@ class Bert(Base_Connector):
 
         return tokens_tensor, segments_tensors, masked_indices, tokenized_text
 
+    def __tokenize(self, sentences, count=True):
+        """The tokens of each sentence, truncated around the mask to
+        max_context_tokens tokens in total with [CLS] and the [SEP]s."""
+        tokenized_sentences = [self.tokenizer.tokenize(sentence) for sentence in sentences]
+        if self.max_context_tokens is None:
+            return tokenized_sentences
+        return self._truncate_around_mask(
+            tokenized_sentences, lambda token: token == MASK,
+            self.max_context_tokens - 1 - len(sentences), count=count,
+        )
+
+    def get_input_lengths(self, sentences_list):
+        # [CLS] + one [SEP] after each sentence, as in __get_input_tensors
+        return [
+            1 + sum(len(tokens) + 1 for tokens in self.__tokenize(sentences, count=False))
+            for sentences in sentences_list
+        ]
+
     def __get_token_ids_from_tensor(self, indexed_string):
         token_ids = []
         if self.map_indices is not None:
@@ -210,8 +265,22 @@ class Bert(Base_Connector):
     def _cuda(self):
         self.masked_bert_model.cuda()
 
+    def _torch_modules(self):
+        self.wait_for_weights()
+        return [self.masked_bert_model]
+
+    def save_flat_checkpoint(self, path):
+        self.wait_for_weights()
+        config = self.masked_bert_model.config.to_dict()
+        config["do_lower_case"] = self.tokenizer.basic_tokenizer.do_lower_case
+        save_flat_checkpoint(path, self.masked_bert_model.state_dict(), config)
+        with open(os.path.join(path, self.vocab_name), "w", encoding="utf-8") as f:
+            for token, _ in sorted(self.tokenizer.vocab.items(), key=lambda x: x[1]):
+                f.write(token + "\n")
+
     def get_batch_generation(self, sentences_list, logger= None,
                              try_cuda=True):
+        self.wait_for_weights()
         if not sentences_list:
             return None
         if try_cuda:
@@ -221,14 +290,19 @@ class Bert(Base_Connector):
         # print('SEGMENTS:', segments_tensor)
 
         if logger is not None:
-            logger.debug("\n{}\n".format(tokenized_text_list))
+            logger.debug("\n%s\n", tokenized_text_list)
 
         with torch.no_grad():
-            logits = self.masked_bert_model(
-                input_ids=tokens_tensor.to(self._model_device),
-                token_type_ids=segments_tensor.to(self._model_device),
-                attention_mask=attention_mask_tensor.to(self._model_device),
-            )
+            if self.pack_length:
+                logits = self.__packed_forward(tokens_tensor, segments_tensor, attention_mask_tensor)
+            elif self.jit:
+                logits = self.__traced_forward(tokens_tensor, segments_tensor, attention_mask_tensor)
+            else:
+                logits = self.masked_bert_model(
+                    input_ids=tokens_tensor.to(self._model_device),
+                    token_type_ids=segments_tensor.to(self._model_device),
+                    attention_mask=attention_mask_tensor.to(self._model_device),
+                )
 
             log_probs = F.log_softmax(logits, dim=-1).cpu()
 
@@ -238,7 +312,115 @@ class Bert(Base_Connector):
 
         return log_probs, token_ids_list, masked_indices_list
 
-    def get_contextual_embeddings(self, sentences_list, try_cuda=True):
+    def __pack(self, lengths):
+        """Rows of at most pack_length tokens (first fit, longest inputs
+        first), as lists of (input index, offset in the row)."""
+        rows = []
+        row_lengths = []
+        for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+            for row, row_length in enumerate(row_lengths):
+                if row_length + lengths[i] <= self.pack_length:
+                    break
+            else:
+                # an input longer than pack_length gets a row of its own
+                row = len(rows)
+                rows.append([])
+                row_lengths.append(0)
+            rows[row].append((i, row_lengths[row]))
+            row_lengths[row] += lengths[i]
+        return rows, max(row_lengths)
+
+    def __packed_forward(self, tokens_tensor, segments_tensor, attention_mask_tensor):
+        """The logits of masked_bert_model, computed with the inputs packed
+        into rows of at most pack_length tokens. Each input of a row attends
+        only to itself (block-diagonal attention mask) and its positions start
+        at 0, so that its logits are the ones of the unpacked forward; the
+        logits of the padding are 0."""
+        lengths = attention_mask_tensor.sum(dim=1).tolist()
+        rows, row_length = self.__pack(lengths)
+
+        packed_tokens = torch.full([len(rows), row_length], self.pad_id, dtype=torch.long)
+        packed_segments = torch.zeros_like(packed_tokens)
+        packed_positions = torch.zeros_like(packed_tokens)
+        # index of the input of each token in its row, -1 for the padding
+        packed_inputs = torch.full_like(packed_tokens, -1)
+        for row, inputs in enumerate(rows):
+            for i, offset in inputs:
+                span = slice(offset, offset + lengths[i])
+                packed_tokens[row, span] = tokens_tensor[i, :lengths[i]]
+                packed_segments[row, span] = segments_tensor[i, :lengths[i]]
+                packed_positions[row, span] = torch.arange(lengths[i])
+                packed_inputs[row, span] = i
+        attention_mask = (packed_inputs.unsqueeze(2) == packed_inputs.unsqueeze(1)) & (packed_inputs >= 0).unsqueeze(1)
+
+        bert = self.masked_bert_model.bert
+        embeddings = bert.embeddings
+        # as BertModel.forward, with the positions and the attention mask of the packed rows
+        extended_attention_mask = attention_mask.unsqueeze(1).to(
+            device=self._model_device, dtype=next(bert.parameters()).dtype)
+        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        embedding_output = embeddings.LayerNorm(
+            embeddings.word_embeddings(packed_tokens.to(self._model_device))
+            + embeddings.position_embeddings(packed_positions.to(self._model_device))
+            + embeddings.token_type_embeddings(packed_segments.to(self._model_device))
+        )
+        embedding_output = embeddings.dropout(embedding_output)
+        sequence_output = bert.encoder(
+            embedding_output, extended_attention_mask, output_all_encoded_layers=False)[-1]
+        packed_logits = self.masked_bert_model.cls(sequence_output)
+
+        # unpack: one row of the padded batch per input
+        logits = packed_logits.new_zeros(tokens_tensor.shape + packed_logits.shape[-1:])
+        for row, inputs in enumerate(rows):
+            for i, offset in inputs:
+                logits[i, :lengths[i]] = packed_logits[row, offset:offset + lengths[i]]
+        return logits
+
+    def __traced_model(self, tokens_tensor, segments_tensor, attention_mask_tensor):
+        key = tuple(tokens_tensor.shape) + (self._model_device,)
+        if key not in self.__traced_models:
+            # the traced model shares the parameters of masked_bert_model
+            self.__traced_models[key] = torch.jit.trace(
+                self.masked_bert_model,
+                (tokens_tensor, segments_tensor, attention_mask_tensor),
+                check_trace=False,
+            )
+        return self.__traced_models[key]
+
+    def __traced_forward(self, tokens_tensor, segments_tensor, attention_mask_tensor):
+        """The logits of masked_bert_model, computed by the model traced for
+        the shape of the inputs padded to a multiple of JIT_LENGTH_BUCKET."""
+        length = tokens_tensor.shape[1]
+        padding = -length % JIT_LENGTH_BUCKET
+        # padded positions are masked out: the logits of the others do not change
+        tokens_tensor = F.pad(tokens_tensor, (0, padding), value=self.pad_id)
+        segments_tensor = F.pad(segments_tensor, (0, padding))
+        attention_mask_tensor = F.pad(attention_mask_tensor, (0, padding))
+        inputs = [
+            tensor.to(self._model_device)
+            for tensor in (tokens_tensor, segments_tensor, attention_mask_tensor)
+        ]
+        logits = self.__traced_model(*inputs)(*inputs)
+        return logits[:, :length]
+
+    def trace(self, batch_sizes, lengths):
+        """Build the traced models (--bert-jit) of these input shapes now,
+        instead of at their first use."""
+        self.wait_for_weights()
+        for batch_size in batch_sizes:
+            for length in lengths:
+                length += -length % JIT_LENGTH_BUCKET
+                tokens_tensor = torch.full([batch_size, length], self.pad_id, dtype=torch.long)
+                zeros = torch.zeros_like(tokens_tensor)
+                with torch.no_grad():
+                    self.__traced_model(
+                        tokens_tensor.to(self._model_device),
+                        zeros.to(self._model_device),
+                        torch.ones_like(tokens_tensor).to(self._model_device),
+                    )
+
+    def get_contextual_embeddings(self, sentences_list, try_cuda=True, layers=None, pooling=None):
+        self.wait_for_weights()
 
         # assume in input 1 or 2 sentences - in general, it considers only the first 2 sentences
         if not sentences_list:
@@ -251,9 +433,11 @@ class Bert(Base_Connector):
         with torch.no_grad():
             all_encoder_layers, _ = self.bert_model(
                 tokens_tensor.to(self._model_device),
-                segments_tensor.to(self._model_device))
+                segments_tensor.to(self._model_device),
+                attention_mask=attention_mask_tensor.to(self._model_device))
 
-        all_encoder_layers = [layer.cpu() for layer in all_encoder_layers]
+            all_encoder_layers = pool_layers(
+                all_encoder_layers, attention_mask_tensor, layers=layers, pooling=pooling)
 
         sentence_lengths = [len(x) for x in tokenized_text_list]
 
@@ -20,7 +20,7 @@ def get_text(sentences):
 
 class Elmo(Base_Connector):
 
-    def __init__(self, args):
+    def __init__(self, args, background_weights=False):
         super().__init__()
 
         options_file = args.elmo_model_dir + "/" + args.elmo_model_name + "_options.json"
@@ -30,31 +30,35 @@ class Elmo(Base_Connector):
         self.hidden_size = data['lstm']['projection_dim']
 
         # 1. Vocabulary
-        vocab_to_cache = None
-
         # use vocabulary that was used for training to initialize top layer
         self.softmax_file = args.elmo_model_dir + "/" + args.elmo_model_name + "_softmax_weights.hdf5"
         self.dict_file = args.elmo_model_dir + "/" + args.elmo_vocab_name
         self.__init_vocab(self.dict_file)
 
+        self.unk_index = self.inverse_vocab[ELMO_UNK]
+        
+        self.warm_up_cycles = args.elmo_warm_up_cycles
+
+        self.options_file = options_file
+        self.weight_file = weight_file
+        self.load_weights(args, background=background_weights)
+
+    def _load_weights(self, args):
         # Note The Elmo class in allennlp.modules.elmo will weight together all
         # of the layers and when initialized will just average them together.
         # _ElmoBiLm is used to have access to all the layers.
 
         # 2. ELMo model
-        self.elmo_lstm = _ElmoBiLm(
-            options_file = options_file,
-            weight_file = weight_file,
-            vocab_to_cache=vocab_to_cache
+        elmo_lstm = _ElmoBiLm(
+            options_file = self.options_file,
+            weight_file = self.weight_file,
+            vocab_to_cache=None
         )
 
         # 3. Top Layer
         # use pre-trained top layer
         self.__init_top_layer(softmax_file = self.softmax_file)
-
-        self.unk_index = self.inverse_vocab[ELMO_UNK]
-        
-        self.warm_up_cycles = args.elmo_warm_up_cycles
+        self.elmo_lstm = elmo_lstm
 
     def __init_vocab(self, dict_file):
         with open(dict_file, "r") as f:
@@ -76,11 +80,14 @@ class Elmo(Base_Connector):
                     raise ValueError("word: {} not in original ELMo vocab".format(word))
             output_weights = np.take(output_weights, indices, axis=0)
             output_bias = np.take(output_bias, indices, axis=0)
-        self.output_layer = torch.nn.Linear(self.hidden_size, len(self.vocab), bias=True)
-        self.output_layer.weight = torch.nn.Parameter(torch.from_numpy(output_weights))
-        self.output_layer.bias = torch.nn.Parameter(torch.from_numpy(output_bias))
+        output_layer = torch.nn.Linear(self.hidden_size, len(self.vocab), bias=True)
+        output_layer.weight = torch.nn.Parameter(torch.from_numpy(output_weights))
+        output_layer.bias = torch.nn.Parameter(torch.from_numpy(output_bias))
+        self.output_layer = self._quantize(output_layer)
 
     def optimize_top_layer(self, vocab_subset):
+        # the top layer is built from the vocabulary changed here
+        self.wait_for_weights()
 
         for symbol in SPECIAL_SYMBOLS:
             if symbol in self.vocab and symbol not in vocab_subset:
@@ -120,8 +127,13 @@ class Elmo(Base_Connector):
         """Move model to GPU."""
         self.elmo_lstm.cuda()
 
+    def _torch_modules(self):
+        self.wait_for_weights()
+        return [self.elmo_lstm, self.output_layer]
+
     def get_batch_generation(self, sentences_list, logger= None,
                              try_cuda=True):
+        self.wait_for_weights()
         
         if not sentences_list:
             return None
@@ -133,7 +145,7 @@ class Elmo(Base_Connector):
             tokenized_text_list.append(get_text(sentences))
 
         if logger is not None:
-            logger.debug("\n{}\n".format(tokenized_text_list))
+            logger.debug("\n%s\n", tokenized_text_list)
 
         # look for masked indices
         masked_indices_list = []
@@ -192,7 +204,11 @@ class Elmo(Base_Connector):
 
         return avg_log_probs, token_ids_list, masked_indices_list
 
-    def get_contextual_embeddings(self, sentences_list, try_cuda=True):
+    def get_input_lengths(self, sentences_list):
+        return [len(get_text(sentences)) for sentences in sentences_list]
+
+    def get_contextual_embeddings(self, sentences_list, try_cuda=True, layers=None, pooling=None):
+        self.wait_for_weights()
         if not sentences_list:
             return None
         if try_cuda:
@@ -205,7 +221,8 @@ class Elmo(Base_Connector):
 
         with torch.no_grad():
             bilm_output = self.elmo_lstm(character_ids.to(self._model_device))
-            activations = [act.cpu() for act in bilm_output['activations']]
+            activations = pool_layers(
+                bilm_output['activations'], bilm_output['mask'], layers=layers, pooling=pooling)
 
         sentence_lengths = [len(x) for x in tokenized_text_list]
 
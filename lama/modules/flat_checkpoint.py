@@ -0,0 +1,155 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Flat checkpoint format: the weights of a model mapped from one file, with
+no unpickling and no archive to extract (see lama/convert_checkpoint.py).
+
+A flat checkpoint is a directory with:
+  weights.bin      the raw bytes of all the tensors, each at an offset
+                   aligned to ALIGNMENT bytes
+  weights.json     name -> dtype, shape and offset of each tensor; tied
+                   tensors (e.g., input and output embeddings) are stored
+                   once, the other names are aliases
+  config.json      the configuration of the model
+and the vocabulary files of the connector.
+
+The tensors are copy-on-write views of the mapped file: loading a model only
+reads the pages of the weights it actually uses, and processes loading the
+same checkpoint share the page cache.
+"""
+import os
+import json
+import collections
+import numpy as np
+import torch
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+WEIGHTS_NAME = "weights.bin"
+INDEX_NAME = "weights.json"
+CONFIG_NAME = "config.json"
+
+
+def is_flat_checkpoint(path):
+    return path is not None and os.path.isfile(os.path.join(str(path), INDEX_NAME))
+
+
+def save_flat_checkpoint(path, state_dict, config=None):
+    """Write the tensors of state_dict (and the config dictionary) to the
+    directory path."""
+    os.makedirs(path, exist_ok=True)
+    tensors = collections.OrderedDict()
+    aliases = {}
+    # storage pointer of the tensors already written -> name
+    written = {}
+    offset = 0
+    with open(os.path.join(path, WEIGHTS_NAME), "wb") as f:
+        for name, tensor in state_dict.items():
+            tensor = tensor.detach().cpu()
+            key = (tensor.data_ptr(), tuple(tensor.shape), tuple(tensor.stride()), str(tensor.dtype))
+            if tensor.numel() > 0 and key in written:
+                aliases[name] = written[key]
+                continue
+            array = tensor.contiguous().numpy()
+            padding = -offset % ALIGNMENT
+            f.write(b"\0" * padding)
+            offset += padding
+            tensors[name] = {
+                "dtype": array.dtype.name,
+                "shape": list(array.shape),
+                "offset": offset,
+            }
+            f.write(array.tobytes())
+            offset += array.nbytes
+            if tensor.numel() > 0:
+                written[key] = name
+    with open(os.path.join(path, INDEX_NAME), "w") as f:
+        json.dump({"version": FORMAT_VERSION, "tensors": tensors, "aliases": aliases}, f)
+    if config is not None:
+        with open(os.path.join(path, CONFIG_NAME), "w") as f:
+            json.dump(config, f, indent=2, sort_keys=True)
+
+
+def load_flat_config(path):
+    with open(os.path.join(path, CONFIG_NAME), "r") as f:
+        return json.load(f)
+
+
+def load_flat_state_dict(path):
+    """Returns an OrderedDict name -> tensor, views of the mapped weights."""
+    with open(os.path.join(path, INDEX_NAME), "r") as f:
+        index = json.load(f)
+    filename = os.path.join(path, WEIGHTS_NAME)
+    # copy-on-write: the tensors are writable (as torch.from_numpy expects)
+    # but nothing is ever written back to the file
+    if os.path.getsize(filename) > 0:
+        data = np.memmap(filename, dtype=np.uint8, mode="c")
+    else:
+        data = np.zeros(0, dtype=np.uint8)
+    state_dict = collections.OrderedDict()
+    for name, info in index["tensors"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        array = data[info["offset"]:info["offset"] + count * dtype.itemsize]
+        state_dict[name] = torch.from_numpy(array.view(dtype).reshape(info["shape"]))
+    for name, target in index["aliases"].items():
+        state_dict[name] = state_dict[target]
+    return state_dict
+
+
+def map_flat_weights(module, path):
+    """Replace the parameters and buffers of module with the tensors of the
+    flat checkpoint path, without copying them. The module may be on the
+    meta device (see load_flat_model). Raises ValueError if the names or the
+    shapes do not match."""
+    state_dict = load_flat_state_dict(path)
+    own_state = module.state_dict(keep_vars=True)
+    missing = [name for name in own_state if name not in state_dict]
+    unexpected = [name for name in state_dict if name not in own_state]
+    if missing or unexpected:
+        raise ValueError(
+            "flat checkpoint {} does not match the model: missing {}, unexpected {}".format(
+                path, missing, unexpected
+            )
+        )
+    for name, tensor in own_state.items():
+        mapped = state_dict[name]
+        if mapped.shape != tensor.shape:
+            raise ValueError(
+                "{}: shape {} in {}, {} in the model".format(
+                    name, tuple(mapped.shape), path, tuple(tensor.shape)
+                )
+            )
+
+    # id of a replaced tensor -> its replacement: tied parameters are the
+    # same object, they stay tied
+    replaced = {}
+    for prefix, submodule in module.named_modules():
+        for tensors in [submodule._parameters, submodule._buffers]:
+            for name, tensor in tensors.items():
+                if tensor is None:
+                    continue
+                if id(tensor) not in replaced:
+                    mapped = state_dict[prefix + "." + name if prefix else name].to(tensor.dtype)
+                    if isinstance(tensor, torch.nn.Parameter):
+                        mapped = torch.nn.Parameter(mapped, requires_grad=tensor.requires_grad)
+                    replaced[id(tensor)] = mapped
+                tensors[name] = replaced[id(tensor)]
+    return module
+
+
+def load_flat_model(build_model, path):
+    """build_model() on the meta device, then map its weights from the flat
+    checkpoint path.
+
+    On the meta device the weights are neither allocated nor randomly
+    initialized (most of the time of building a model). The device is only
+    the default of the calling thread: models built at the same time by
+    other threads are not affected.
+    """
+    with torch.device("meta"):
+        module = build_model()
+    return map_flat_weights(module, path)
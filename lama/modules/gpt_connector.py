@@ -4,14 +4,34 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
-from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+import os
+import json
+from pytorch_pretrained_bert import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer, OpenAIGPTConfig
+from pytorch_pretrained_bert.modeling_openai import Conv1D
 import numpy as np
 from lama.modules.base_connector import *
+from lama.modules.flat_checkpoint import (
+    is_flat_checkpoint, save_flat_checkpoint, load_flat_config, load_flat_model
+)
+
+
+def _conv1d_to_linear(module):
+    """Replace the Conv1D layers of module (x W + b, the GPT layout of a
+    Linear layer) with the equivalent torch.nn.Linear layers."""
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            nx, nf = child.weight.shape
+            linear = torch.nn.Linear(nx, nf)
+            linear.weight = torch.nn.Parameter(child.weight.data.t().contiguous())
+            linear.bias = child.bias
+            setattr(module, name, linear)
+        else:
+            _conv1d_to_linear(child)
 
 
 class GPT(Base_Connector):
 
-    def __init__(self, args):
+    def __init__(self, args, background_weights=False):
         super().__init__()
 
         if args.gpt_model_dir is not None:
@@ -51,21 +71,50 @@ class GPT(Base_Connector):
         unk_index = self.inverse_vocab[OPENAI_UNK]
         self.unk_symbol = self.tokenizer.decoder[unk_index]
 
+        self.eos_id = self.inverse_vocab[OPENAI_EOS]
+        self.model_vocab = self.vocab
+
+        self.gpt_model_name = gpt_model_name
+        self.load_weights(args, background=background_weights)
+
+    def _load_weights(self, args):
         # Load pre-trained model (weights)
-        self.gpt_model = OpenAIGPTLMHeadModel.from_pretrained(gpt_model_name)
-        self.gpt_model.eval()
-        print(self.gpt_model.config)
+        if is_flat_checkpoint(args.gpt_model_dir):
+            # written by lama/convert_checkpoint.py: map the weights
+            config = OpenAIGPTConfig.from_dict(load_flat_config(args.gpt_model_dir))
+            gpt_model = load_flat_model(lambda: OpenAIGPTLMHeadModel(config), args.gpt_model_dir)
+        else:
+            gpt_model = OpenAIGPTLMHeadModel.from_pretrained(self.gpt_model_name)
+        gpt_model.eval()
+        if self.quantized:
+            _conv1d_to_linear(gpt_model)
+        gpt_model = self._quantize(gpt_model)
+        print(gpt_model.config)
 
         # Sanity check.
-        assert len(self.vocab) == self.gpt_model.config.vocab_size
-        assert 0 == self.gpt_model.config.n_special
+        assert len(self.vocab) == gpt_model.config.vocab_size
+        assert 0 == gpt_model.config.n_special
 
-        self.eos_id = self.inverse_vocab[OPENAI_EOS]
-        self.model_vocab = self.vocab
+        self.gpt_model = gpt_model
 
     def _cuda(self):
         self.gpt_model.cuda()
 
+    def _torch_modules(self):
+        self.wait_for_weights()
+        return [self.gpt_model]
+
+    def save_flat_checkpoint(self, path):
+        self.wait_for_weights()
+        save_flat_checkpoint(path, self.gpt_model.state_dict(), self.gpt_model.config.to_dict())
+        # vocab.json and merges.txt, as read by OpenAIGPTTokenizer.from_pretrained
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump(self.tokenizer.encoder, f)
+        with open(os.path.join(path, "merges.txt"), "w", encoding="utf-8") as f:
+            f.write("#version: 0.2\n")
+            for merge, _ in sorted(self.tokenizer.bpe_ranks.items(), key=lambda x: x[1]):
+                f.write(" ".join(merge) + "\n")
+
     def get_id(self, string):
         tokenized_text = self.tokenizer.tokenize(string)
         indexed_string = self.tokenizer.convert_tokens_to_ids(tokenized_text)
@@ -110,7 +159,13 @@ class GPT(Base_Connector):
 
         return src_tensor, dst_tensor, masked_indices, tokenized_text
 
+    def get_input_lengths(self, sentences_list):
+        return [
+            len(self.__get_input_tensors(sentences)[3]) + 1 for sentences in sentences_list
+        ]
+
     def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+        self.wait_for_weights()
         if try_cuda:
             self.try_cuda()
         src_tensor_list, dst_tensor_list, masked_indices_list, _ = zip(*[
@@ -138,24 +193,43 @@ class GPT(Base_Connector):
 
         return log_probs, token_ids_list, masked_indices_list
 
-    def get_contextual_embeddings(self, sentences_list, try_cuda=True):
-
+    def get_contextual_embeddings(self, sentences_list, try_cuda=True, layers=None, pooling=None):
+        self.wait_for_weights()
+        if not sentences_list:
+            return None
         if try_cuda:
             self.try_cuda()
 
-        src_tensor_list, dst_tensor_list, masked_indices_list, _ = zip(*[
-            self.__get_input_tensors(sentences) for sentences in sentences_list
-        ])
-
-        src_tensor_batch = torch.nn.utils.rnn.pad_sequence(
-            src_tensor_list, batch_first=True)
-
-        with torch.no_grad():
-            output = self.gpt_model.transformer(src_tensor_batch.to(self._model_device))
-
-        # TODO
-        sentence_lengths = None
-        tokenized_text_list = None
-
-        # As we only return the last layer, [] to have the same format as other models
-        return [output], sentence_lengths, tokenized_text_list
+        # the whole input, i.e. EOS followed by all the tokens
+        tensor_list = []
+        tokenized_text_list = []
+        for sentences in sentences_list:
+            src_tensor, dst_tensor, _, tokenized_text = self.__get_input_tensors(sentences)
+            tensor_list.append(torch.cat((src_tensor[:1], dst_tensor)))
+            tokenized_text_list.append([OPENAI_EOS] + tokenized_text)
+        sentence_lengths = [len(x) for x in tokenized_text_list]
+
+        # the attention is causal: padding at the end does not change the
+        # representation of the tokens before it
+        tensor_batch = torch.nn.utils.rnn.pad_sequence(tensor_list, batch_first=True)
+        attention_mask = torch.zeros(tensor_batch.shape, dtype=torch.long)
+        for i, length in enumerate(sentence_lengths):
+            attention_mask[i, :length] = 1
+
+        # OpenAIGPTModel only returns the last layer: collect the output of
+        # each block
+        all_layers = []
+        hooks = [
+            block.register_forward_hook(lambda module, input, output: all_layers.append(output))
+            for block in self.gpt_model.transformer.h
+        ]
+        try:
+            with torch.no_grad():
+                self.gpt_model.transformer(tensor_batch.to(self._model_device))
+                all_layers = pool_layers(
+                    all_layers, attention_mask, layers=layers, pooling=pooling)
+        finally:
+            for hook in hooks:
+                hook.remove()
+
+        return all_layers, sentence_lengths, tokenized_text_list
@@ -0,0 +1,192 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Process-wide pool of loaded connectors.
+
+    pool = get_model_pool()
+    with pool.model("bert", args) as model:
+        model.get_batch_generation(...)
+
+The same (lm, connector args) returns the model already loaded. Models in use
+(acquired and not released) are never evicted; the others are kept for reuse
+until the memory of the loaded models exceeds the budget of the pool, then
+the least recently used ones are dropped.
+"""
+import gc
+import sys
+import threading
+import contextlib
+import collections
+
+# args read by a connector other than the ones named after it (<lm>_*)
+EXTRA_KEY_ARGS = {
+    "bert": ["max_context_tokens"],
+    "roberta": ["max_sentence_length", "max_context_tokens"],
+}
+# args read by all the connectors
+COMMON_KEY_ARGS = ["quantize"]
+
+_Entry = collections.namedtuple("_Entry", "model size refs")
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def model_key(lm, args):
+    """The key of the connector built by build_model_by_name(lm, args): the
+    args that connector reads."""
+    prefix = lm + "_"
+    extra = EXTRA_KEY_ARGS.get(lm, []) + COMMON_KEY_ARGS
+    return (lm,) + tuple(
+        sorted(
+            (name, _freeze(value))
+            for name, value in vars(args).items()
+            if name.startswith(prefix) or name in extra
+        )
+    )
+
+
+def model_memory_size(model):
+    """Bytes of the weights (parameters and buffers) of a connector, tied
+    weights counted once; 0 if the connector does not expose its modules."""
+    try:
+        modules = model._torch_modules()
+    except NotImplementedError:
+        return 0
+    seen = set()
+    size = 0
+    for module in modules:
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            if tensor.data_ptr() in seen:
+                continue
+            seen.add(tensor.data_ptr())
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+class ModelPool(object):
+    """Loaded connectors, keyed by model_key, with LRU eviction of the
+    models not in use once their memory exceeds max_memory bytes (None: no
+    limit)."""
+
+    def __init__(self, max_memory=None, build_model=None):
+        self.max_memory = max_memory
+        # default: build_model_by_name
+        self._build_model = build_model
+        # key -> _Entry, least recently used first
+        self._entries = collections.OrderedDict()
+        # id(model) -> key
+        self._keys = {}
+        # key -> memory size of the model, kept after its eviction
+        self._sizes = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def memory_in_use(self):
+        return sum(entry.size for entry in self._entries.values())
+
+    def acquire(self, lm, args):
+        """Return the model for (lm, args), loading it if it is not in the
+        pool. It is not evicted until release(model) is called."""
+        key = model_key(lm, args)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # make room before loading: a model loaded before has the
+                # same size, a new one is assumed as large as the largest one
+                expected = self._sizes.get(key, max(self._sizes.values(), default=0))
+                self._evict(expected)
+                build_model = self._build_model
+                if build_model is None:
+                    from lama.modules import build_model_by_name as build_model
+                model = build_model(lm, args)
+                entry = _Entry(model, model_memory_size(model), 0)
+                self._sizes[key] = entry.size
+                self._keys[id(model)] = key
+            entry = entry._replace(refs=entry.refs + 1)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self._evict(0)
+            if self.max_memory is not None and self.memory_in_use > self.max_memory:
+                print(
+                    "WARNING: the models in use take {:.2f}GB, over the {:.2f}GB of the pool".format(
+                        self.memory_in_use / 1e9, self.max_memory / 1e9
+                    )
+                )
+            return entry.model
+
+    def release(self, model):
+        """Mark one acquire of model as done."""
+        with self._lock:
+            key = self._keys.get(id(model))
+            entry = self._entries.get(key)
+            if entry is None or entry.model is not model or entry.refs == 0:
+                raise ValueError("model not acquired from this pool")
+            self._entries[key] = entry._replace(refs=entry.refs - 1)
+            self._evict(0)
+
+    @contextlib.contextmanager
+    def model(self, lm, args):
+        """acquire and release the model in a with statement."""
+        model = self.acquire(lm, args)
+        try:
+            yield model
+        finally:
+            self.release(model)
+
+    def set_max_memory(self, max_memory):
+        """Set the budget (bytes, None: no limit) and drop the least
+        recently used models not in use that are over it."""
+        with self._lock:
+            self.max_memory = max_memory
+            self._evict(0)
+
+    def clear(self):
+        """Drop all the models not in use."""
+        with self._lock:
+            self._evict(0, all_unused=True)
+
+    def _evict(self, expected, all_unused=False):
+        """Drop least recently used models not in use until the models in
+        the pool, plus expected bytes, fit in max_memory."""
+        if self.max_memory is None and not all_unused:
+            return
+        evicted = False
+        for key in list(self._entries):
+            if not all_unused and self.memory_in_use + expected <= self.max_memory:
+                break
+            entry = self._entries[key]
+            if entry.refs > 0:
+                continue
+            del self._entries[key]
+            del self._keys[id(entry.model)]
+            evicted = True
+        if evicted:
+            gc.collect()
+            torch = sys.modules.get("torch")
+            if torch is not None and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+_model_pool = ModelPool()
+
+
+def get_model_pool():
+    """The pool of this process. Its budget is set by the entry point of the
+    process (see ModelPool.set_max_memory); code that needs another budget
+    uses a ModelPool of its own."""
+    return _model_pool
@@ -4,10 +4,18 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
-from fairseq.models.roberta import RobertaModel
-from fairseq import utils
+import os
+import json
+import shutil
+import argparse
+from fairseq.models.roberta import RobertaModel, RobertaHubInterface
+from fairseq import utils, tasks
+from fairseq.data import Dictionary, encoders
 import torch
 from lama.modules.base_connector import *
+from lama.modules.flat_checkpoint import (
+    is_flat_checkpoint, save_flat_checkpoint, load_flat_config, load_flat_model
+)
 
 
 class RobertaVocab(object):
@@ -34,28 +42,69 @@ class RobertaVocab(object):
 
 
 class Roberta(Base_Connector):
-    def __init__(self, args):
+    def __init__(self, args, background_weights=False):
         super().__init__()
         roberta_model_dir = args.roberta_model_dir
-        roberta_model_name = args.roberta_model_name
         roberta_vocab_name = args.roberta_vocab_name
         self.dict_file = "{}/{}".format(roberta_model_dir, roberta_vocab_name)
-        self.model = RobertaModel.from_pretrained(
-            roberta_model_dir, checkpoint_file=roberta_model_name
-        )
-        self.bpe = self.model.bpe
-        self.task = self.model.task
+        # the dictionary and the bpe of the task of the model (masked_lm with
+        # the gpt2 bpe), built without the model
+        self.dictionary = Dictionary.load(self.dict_file)
+        self.mask_idx = self.dictionary.add_symbol(ROBERTA_MASK)
+        self.bpe = encoders.build_bpe(argparse.Namespace(bpe="gpt2"))
         self._build_vocab()
         self._init_inverse_vocab()
         self.max_sentence_length = args.max_sentence_length
+        self.max_context_tokens = getattr(args, "max_context_tokens", None)
+        self.load_weights(args, background=background_weights)
+
+    def _load_weights(self, args):
+        if is_flat_checkpoint(args.roberta_model_dir):
+            # written by lama/convert_checkpoint.py: map the weights
+            model = self.__load_flat_checkpoint(args.roberta_model_dir)
+        else:
+            model = RobertaModel.from_pretrained(
+                args.roberta_model_dir, checkpoint_file=args.roberta_model_name
+            )
+        self.model = self._quantize(model)
 
     def _cuda(self):
         self.model.cuda()
 
+    def _torch_modules(self):
+        self.wait_for_weights()
+        return [self.model]
+
+    @staticmethod
+    def __load_flat_checkpoint(path):
+        # as RobertaModel.from_pretrained, with the arguments of the
+        # checkpoint read from config.json and the weights mapped
+        model_args = argparse.Namespace(**load_flat_config(path))
+        model_args.data = path
+        if getattr(model_args, "bpe", None) is None:
+            model_args.bpe = "gpt2"
+        task = tasks.setup_task(model_args)
+        model = load_flat_model(lambda: task.build_model(model_args), path)
+        return RobertaHubInterface(model_args, task, model)
+
+    def save_flat_checkpoint(self, path):
+        self.wait_for_weights()
+        config = {}
+        for key, value in vars(self.model.args).items():
+            try:
+                json.dumps(value)
+            except TypeError:
+                continue
+            config[key] = value
+        save_flat_checkpoint(path, self.model.model.state_dict(), config)
+        # the task reads the dictionary from dict.txt in the data directory
+        for name in {"dict.txt", os.path.basename(self.dict_file)}:
+            shutil.copyfile(self.dict_file, os.path.join(path, name))
+
     def _build_vocab(self):
         self.vocab = []
         for key in range(ROBERTA_VOCAB_SIZE):
-            predicted_token_bpe = self.task.source_dictionary.string([key])
+            predicted_token_bpe = self.dictionary.string([key])
             try:
                 value = self.bpe.decode(predicted_token_bpe)
 
@@ -78,63 +127,57 @@ class Roberta(Base_Connector):
         # Roberta predicts ' London' and not 'London'
         string = " " + str(input_string).strip()
         text_spans_bpe = self.bpe.encode(string.rstrip())
-        tokens = self.task.source_dictionary.encode_line(
+        tokens = self.dictionary.encode_line(
             text_spans_bpe, append_eos=False
         )
         return [element.item() for element in tokens.long().flatten()]
 
-    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
-        if not sentences_list:
-            return None
-        if try_cuda:
-            self.try_cuda()
-
-        tensor_list = []
-        masked_indices_list = []
-        max_len = 0
-        output_tokens_list = []
-        for masked_inputs_list in sentences_list:
-
-            tokens_list = []
+    def __get_input_tokens(self, masked_inputs_list, count=True):
+        sentences_tokens = []
 
-            for idx, masked_input in enumerate(masked_inputs_list):
+        for masked_input in masked_inputs_list:
 
-                # 2. sobstitute [MASK] with <mask>
-                masked_input = masked_input.replace(MASK, ROBERTA_MASK)
+            # 2. sobstitute [MASK] with <mask>
+            masked_input = masked_input.replace(MASK, ROBERTA_MASK)
 
-                text_spans = masked_input.split(ROBERTA_MASK)
-                text_spans_bpe = (
-                    (" {0} ".format(ROBERTA_MASK))
-                    .join(
-                        [
-                            self.bpe.encode(text_span.rstrip())
-                            for text_span in text_spans
-                        ]
-                    )
-                    .strip()
+            text_spans = masked_input.split(ROBERTA_MASK)
+            text_spans_bpe = (
+                (" {0} ".format(ROBERTA_MASK))
+                .join(
+                    [
+                        self.bpe.encode(text_span.rstrip())
+                        for text_span in text_spans
+                    ]
                 )
+                .strip()
+            )
 
-                prefix = ""
-                if idx == 0:
-                    prefix = ROBERTA_START_SENTENCE
+            sentences_tokens.append(
+                self.dictionary.encode_line(
+                    text_spans_bpe, append_eos=False
+                ).tolist()
+            )
 
-                tokens_list.append(
-                    self.task.source_dictionary.encode_line(
-                        str(prefix + " " + text_spans_bpe).strip(), append_eos=True
-                    )
-                )
+        # at most max_context_tokens (or max_sentence_length) tokens around
+        # the mask, with <s> and the </s> after each sentence
+        max_tokens = self.max_context_tokens or self.max_sentence_length
+        sentences_tokens = self._truncate_around_mask(
+            sentences_tokens, lambda token: token == self.mask_idx,
+            max_tokens - 1 - len(sentences_tokens), count=count,
+        )
 
-            tokens = torch.cat(tokens_list)[: self.max_sentence_length]
-            output_tokens_list.append(tokens.long().cpu().numpy())
+        tokens = [self.dictionary.bos()]
+        for sentence_tokens in sentences_tokens:
+            tokens.extend(sentence_tokens)
+            tokens.append(self.dictionary.eos())
+        return torch.tensor(tokens, dtype=torch.int)
 
-            if len(tokens) > max_len:
-                max_len = len(tokens)
-            tensor_list.append(tokens)
-            masked_index = (tokens == self.task.mask_idx).nonzero().numpy()
-            for x in masked_index:
-                masked_indices_list.append([x[0]])
+    def __get_input_tensors_batch(self, sentences_list):
+        tensor_list = [self.__get_input_tokens(masked_inputs_list)
+                       for masked_inputs_list in sentences_list]
+        max_len = max(len(tokens) for tokens in tensor_list)
 
-        pad_id = self.task.source_dictionary.pad()
+        pad_id = self.dictionary.pad()
         tokens_list = []
         for tokens in tensor_list:
             pad_lenght = max_len - len(tokens)
@@ -143,20 +186,64 @@ class Roberta(Base_Connector):
                 tokens = torch.cat((tokens, pad_tensor))
             tokens_list.append(tokens)
 
-        batch_tokens = torch.stack(tokens_list)
+        return tensor_list, torch.stack(tokens_list).long()
+
+    def get_input_lengths(self, sentences_list):
+        return [len(self.__get_input_tokens(sentences, count=False)) for sentences in sentences_list]
+
+    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+        self.wait_for_weights()
+        if not sentences_list:
+            return None
+        if try_cuda:
+            self.try_cuda()
+
+        tensor_list, batch_tokens = self.__get_input_tensors_batch(sentences_list)
+
+        masked_indices_list = []
+        output_tokens_list = []
+        for tokens in tensor_list:
+            output_tokens_list.append(tokens.long().cpu().numpy())
+            masked_index = (tokens == self.mask_idx).nonzero().numpy()
+            for x in masked_index:
+                masked_indices_list.append([x[0]])
 
         with torch.no_grad():
             # with utils.eval(self.model.model):
             self.model.eval()
             self.model.model.eval()
             log_probs, extra = self.model.model(
-                batch_tokens.long().to(device=self._model_device),
+                batch_tokens.to(device=self._model_device),
                 features_only=False,
                 return_all_hiddens=False,
             )
 
         return log_probs.cpu(), output_tokens_list, masked_indices_list
 
-    def get_contextual_embeddings(self, sentences_list, try_cuda=True):
-        # TBA
-        return None
+    def get_contextual_embeddings(self, sentences_list, try_cuda=True, layers=None, pooling=None):
+        self.wait_for_weights()
+        if not sentences_list:
+            return None
+        if try_cuda:
+            self.try_cuda()
+
+        tensor_list, batch_tokens = self.__get_input_tensors_batch(sentences_list)
+        attention_mask = batch_tokens.ne(self.dictionary.pad()).long()
+
+        with torch.no_grad():
+            self.model.eval()
+            self.model.model.eval()
+            # the padding is masked by the model
+            all_layers = self.model.extract_features(
+                batch_tokens.to(device=self._model_device), return_all_layers=True
+            )
+            # the first one is the output of the embedding layer
+            all_layers = pool_layers(
+                all_layers[1:], attention_mask, layers=layers, pooling=pooling)
+
+        sentence_lengths = [len(tokens) for tokens in tensor_list]
+        tokenized_text_list = [
+            [self.vocab[token_id] for token_id in tokens.tolist()] for tokens in tensor_list
+        ]
+
+        return all_layers, sentence_lengths, tokenized_text_list
@@ -4,9 +4,13 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
-from pytorch_pretrained_bert import TransfoXLLMHeadModel, TransfoXLTokenizer
+import os
+from pytorch_pretrained_bert import TransfoXLLMHeadModel, TransfoXLTokenizer, TransfoXLConfig
 import numpy as np
 from lama.modules.base_connector import *
+from lama.modules.flat_checkpoint import (
+    is_flat_checkpoint, save_flat_checkpoint, load_flat_config, load_flat_model
+)
 
 
 class TransformerXL(Base_Connector):
@@ -14,7 +18,7 @@ class TransformerXL(Base_Connector):
     UNK_SYMBOL = '<unk>'
     EOS_SYMBOL = '<eos>'
 
-    def __init__(self, args):
+    def __init__(self, args, background_weights=False):
         super().__init__()
 
         if args.transformerxl_model_dir is not None:
@@ -33,14 +37,34 @@ class TransformerXL(Base_Connector):
         self.eos_id = self.inverse_vocab[self.EOS_SYMBOL]
         self.unk_symbol = self.UNK_SYMBOL
 
+        self.model_name = model_name
+        self.load_weights(args, background=background_weights)
+
+    def _load_weights(self, args):
         # Load pre-trained model (weights)
-        self.model = TransfoXLLMHeadModel.from_pretrained(model_name)
-        self.model.eval()
-        print(self.model.config)
+        if is_flat_checkpoint(args.transformerxl_model_dir):
+            # written by lama/convert_checkpoint.py: map the weights
+            config = TransfoXLConfig.from_dict(load_flat_config(args.transformerxl_model_dir))
+            model = load_flat_model(lambda: TransfoXLLMHeadModel(config), args.transformerxl_model_dir)
+        else:
+            model = TransfoXLLMHeadModel.from_pretrained(self.model_name)
+        model.eval()
+        print(model.config)
+        self.model = self._quantize(model)
 
     def _cuda(self):
         self.model.cuda()
 
+    def _torch_modules(self):
+        self.wait_for_weights()
+        return [self.model]
+
+    def save_flat_checkpoint(self, path):
+        self.wait_for_weights()
+        save_flat_checkpoint(path, self.model.state_dict(), self.model.config.to_dict())
+        # vocab.bin, as read by TransfoXLTokenizer.from_pretrained
+        torch.save(self.tokenizer.__dict__, os.path.join(path, "vocab.bin"))
+
     def get_id(self, string):
         tokenized_text = self.tokenizer.tokenize(string)
         indexed_string = self.tokenizer.convert_tokens_to_ids(tokenized_text)
@@ -85,7 +109,19 @@ class TransformerXL(Base_Connector):
 
         return src_tensor, dst_tensor, masked_indices, tokenized_text
 
+    def __tokenize(self, sentence_list):
+        # the tokens of each sentence followed by EOS, as in the training data
+        tokenized_text = []
+        for sentence in sentence_list:
+            tokenized_text.extend(self.tokenizer.tokenize(sentence))
+            tokenized_text.append(self.EOS_SYMBOL)
+        return tokenized_text
+
+    def get_input_lengths(self, sentences_list):
+        return [len(self.__tokenize(sentences)) for sentences in sentences_list]
+
     def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+        self.wait_for_weights()
         if try_cuda:
             self.try_cuda()
         src_tensor_list, dst_tensor_list, masked_indices_list, _ = zip(*[
@@ -105,27 +141,111 @@ class TransformerXL(Base_Connector):
 
         return log_probs, token_ids_list, masked_indices_list
 
-    def get_contextual_embeddings(self, batched_sentence_list):
-        batch = []
-        for sentence_list in batched_sentence_list:
-            tokenized_text = [self.eos_id]
-            for sentence in sentence_list:
-                tokenized_text.extend(self.tokenizer.tokenize(sentence))
-                tokenized_text.append(self.EOS_SYMBOL)
-
-            full_indexed_tokens = torch.tensor(self.tokenizer.convert_tokens_to_ids(tokenized_text))
-            batch.append(full_indexed_tokens)
-
-        tensor_batch = torch.nn.utils.rnn.pad_sequence(
-            batch, batch_first=True).to(self._model_device)
+    def __forward_layers(self, tensor_batch, mems=None):
+        """Run the transformer on tensor_batch [batch_size, sequence_length]
+        and return the output of each layer, [batch_size, sequence_length,
+        hidden_size], and the new mems. Must be called under no_grad."""
+        if mems is None:
+            # empty memory, rather than the mem_len zero vectors of
+            # init_mems that the model would attend to
+            param = next(self.model.parameters())
+            mems = [
+                torch.zeros(0, tensor_batch.shape[0], self.model.config.d_model,
+                            dtype=param.dtype, device=param.device)
+                for _ in range(self.model.config.n_layer)
+            ]
+        # the model only returns the last layer: collect the output of each
+        # layer, [sequence_length, batch_size, hidden_size]
+        all_layers = []
+        hooks = [
+            layer.register_forward_hook(lambda module, input, output: all_layers.append(output))
+            for layer in self.model.transformer.layers
+        ]
+        try:
+            _, new_mems = self.model.transformer(tensor_batch, mems=mems)
+        finally:
+            for hook in hooks:
+                hook.remove()
+        return [layer.transpose(0, 1) for layer in all_layers], new_mems
+
+    def get_contextual_embeddings(self, sentences_list, try_cuda=True, layers=None, pooling=None):
+        self.wait_for_weights()
+        if not sentences_list:
+            return None
+        if try_cuda:
+            self.try_cuda()
 
-        last_hidden_state, _ = self.model.transformer(tensor_batch)
+        tokenized_text_list = [self.__tokenize(sentences) for sentences in sentences_list]
+        sentence_lengths = [len(x) for x in tokenized_text_list]
 
-        last_hidden_state = last_hidden_state[:, 1:]
+        # EOS as the context of the first token, its output is dropped. The
+        # attention is causal: padding at the end does not change the
+        # representation of the tokens before it.
+        batch = [
+            torch.tensor([self.eos_id] + self.tokenizer.convert_tokens_to_ids(tokenized_text))
+            for tokenized_text in tokenized_text_list
+        ]
+        tensor_batch = torch.nn.utils.rnn.pad_sequence(batch, batch_first=True)
+        attention_mask = torch.zeros(tensor_batch.shape[0], tensor_batch.shape[1] - 1, dtype=torch.long)
+        for i, length in enumerate(sentence_lengths):
+            attention_mask[i, :length] = 1
 
-        # TODO
-        sentence_lengths = None
-        tokenized_text_list = None
+        with torch.no_grad():
+            all_layers, _ = self.__forward_layers(tensor_batch.to(self._model_device))
+            all_layers = pool_layers(
+                [layer[:, 1:] for layer in all_layers], attention_mask, layers=layers, pooling=pooling)
+
+        return all_layers, sentence_lengths, tokenized_text_list
+
+    def stream_contextual_embeddings(self, sentences, segment_length=None, try_cuda=True,
+                                     layers=None, pooling=None):
+        """Compute the contextual embeddings of a text of any length, one
+        segment at a time.
+
+        Segments of segment_length tokens (the training length of the model
+        by default) are fed in order, with the memory of the previous ones:
+        the memory used does not depend on the length of the text.
+
+        Parameters:
+        sentences (iterable[string]): the sentences of the text, e.g. the
+                                      lines of a file, read lazily
+        layers, pooling: see pool_layers, applied to each segment
+
+        Yields:
+        (encoder_layers, tokens) for each segment: the embeddings of each
+        layer [segment_length, hidden_size] (a single tensor if pooling is
+        set) and the tokens of the segment (each sentence is followed by EOS)
+        """
+        self.wait_for_weights()
+        if segment_length is None:
+            segment_length = self.model.config.tgt_len
+        if segment_length <= 0:
+            raise ValueError("segment_length should be positive, got {}".format(segment_length))
+        if try_cuda:
+            self.try_cuda()
 
-        # As we only return the last layer, wrap it into a list
-        return [last_hidden_state], sentence_lengths, tokenized_text_list
+        def segments():
+            # EOS as the context of the first token, its output is dropped
+            tokens = [self.EOS_SYMBOL]
+            for sentence in sentences:
+                tokens.extend(self.__tokenize([sentence]))
+                while len(tokens) >= segment_length:
+                    yield tokens[:segment_length]
+                    tokens = tokens[segment_length:]
+            if tokens:
+                yield tokens
+
+        mems = None
+        first = True
+        with torch.no_grad():
+            for tokens in segments():
+                tensor = torch.tensor([self.tokenizer.convert_tokens_to_ids(tokens)])
+                all_layers, mems = self.__forward_layers(tensor.to(self._model_device), mems=mems)
+                if first:
+                    all_layers = [layer[:, 1:] for layer in all_layers]
+                    tokens = tokens[1:]
+                    first = False
+                if not tokens:
+                    continue
+                all_layers = pool_layers(all_layers, layers=layers, pooling=pooling)
+                yield [layer[0] for layer in all_layers], tokens
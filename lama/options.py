@@ -43,6 +43,27 @@ def get_general_parser():
         default=100,
         help="max sentence lenght",
     )
+    parser.add_argument(
+        "--max-context-tokens",
+        dest="max_context_tokens",
+        type=int,
+        default=None,
+        help="truncate the inputs of BERT and RoBERTa to this many subword tokens around the mask, "
+        "keeping the sentences with the mask whole",
+    )
+    parser.add_argument(
+        "--max-models-memory",
+        dest="max_models_memory",
+        type=float,
+        default=None,
+        help="memory budget in GB of the models kept loaded (default: no limit)",
+    )
+    parser.add_argument(
+        "--quantize",
+        dest="quantize",
+        action="store_true",
+        help="dynamic int8 quantization of the Linear layers of the model (CPU only)",
+    )
     __add_bert_args(parser)
     __add_elmo_args(parser)
     __add_gpt_args(parser)
@@ -65,6 +86,30 @@ def get_eval_generation_parser():
     return parser
 
 
+def get_probe_server_parser():
+    parser = get_general_parser()
+    parser.add_argument("--host", default="localhost", help="address of the server")
+    parser.add_argument("--port", type=int, default=8000, help="port of the server (0: any free port)")
+    parser.add_argument(
+        "--max-batch-size",
+        dest="max_batch_size",
+        type=int,
+        default=32,
+        help="maximum number of probes in a forward of a model",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        dest="max_wait_ms",
+        type=float,
+        default=5.0,
+        help="maximum time a probe waits for others to fill its batch",
+    )
+    parser.add_argument("--topk", type=int, default=10, help="number of predictions of each masked token")
+    parser.add_argument("--cuda", action="store_true", help="try to run on GPU")
+    parser.add_argument("--verbose", action="store_true", help="log each request")
+    return parser
+
+
 def get_eval_KB_completion_parser():
     parser = get_general_parser()
     parser.add_argument(
@@ -103,6 +148,60 @@ def get_eval_KB_completion_parser():
         default=-1,
         help="number of threads for evaluation metrics computation (defaults: all available)",
     )
+    parser.add_argument(
+        "--checkpoint-interval",
+        dest="checkpoint_interval",
+        type=int,
+        default=100,
+        help="save the metrics to checkpoint.json every N batches (0 to disable)",
+    )
+    parser.add_argument(
+        "--resume",
+        dest="resume",
+        action="store_true",
+        help="resume the evaluation from the checkpoint in --full-logdir",
+    )
+    parser.add_argument(
+        "--save-samples",
+        dest="save_samples",
+        action="store_true",
+        help="write the per-sample results to samples_<split>.bin in the log directory",
+    )
+    parser.add_argument(
+        "--samples-topk",
+        dest="samples_topk",
+        type=int,
+        default=10,
+        help="number of top predictions saved for each sample",
+    )
+    parser.add_argument(
+        "--save-scores",
+        dest="save_scores",
+        action="store_true",
+        help="write the masked-position log-probs to scores_<split>.bin in the "
+        "log directory, to re-score the evaluation with scripts/rescore.py",
+    )
+    parser.add_argument(
+        "--scores-topn",
+        dest="scores_topn",
+        type=int,
+        default=1000,
+        help="number of log-probs saved for each sample (0 for the whole vocabulary)",
+    )
+    parser.add_argument(
+        "--log-format",
+        dest="log_format",
+        choices=["text", "jsonl"],
+        default="text",
+        help="text: info.log, jsonl: events.jsonl with batch and sample records",
+    )
+    parser.add_argument(
+        "--log-sample-rate",
+        dest="log_sample_rate",
+        type=float,
+        default=1.0,
+        help="fraction of the samples with a log record",
+    )
     return parser
 
 
@@ -128,6 +227,19 @@ def __add_bert_args(parser):
         default="vocab.txt",
         help="name of vocabulary used to pre-train the BERT model (default = 'vocab.txt')",
     )
+    group.add_argument(
+        "--bert-jit",
+        dest="bert_jit",
+        action="store_true",
+        help="run the masked LM forward of BERT with TorchScript-traced models, one per input shape",
+    )
+    group.add_argument(
+        "--bert-pack-length",
+        dest="bert_pack_length",
+        type=int,
+        default=None,
+        help="pack the inputs of the masked LM forward of BERT into rows of at most this many tokens",
+    )
     return group
 
 
@@ -222,6 +334,13 @@ def __add_elmo_args(parser):
     return group
 
 
+def get_models_memory(args):
+    """--max-models-memory in bytes, None if there is no limit."""
+    if args.max_models_memory is None:
+        return None
+    return int(args.max_models_memory * 1e9)
+
+
 def parse_args(parser):
     args = parser.parse_args()
     args.models_names = [x.strip().lower() for x in args.models.split(",")]
@@ -0,0 +1,286 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""A long-running HTTP server that keeps the models loaded and answers probes:
+
+    python lama/probe_server.py --lm bert --port 8000
+
+    curl -d '{"sentences": ["The capital of France is [MASK] ."]}' localhost:8000/probe
+
+The concurrent requests to a model are grouped into micro-batches of at most
+--max-batch-size inputs: a batch starts with the first waiting request and
+waits at most --max-wait-ms for more before running the model. Each answer
+has the top-k predictions of each masked token and the perplexity of the
+input, as printed by eval_generation.py.
+"""
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import torch
+from lama.modules import get_model_pool
+from lama.utils import get_sentence_perplexity, load_vocab
+import lama.options as options
+
+
+class _Request(object):
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Runs the get_batch_generation of a model in a thread of its own, on
+    batches of the inputs submitted concurrently.
+
+    A batch is made of the requests waiting when the thread is free, and of
+    the ones submitted up to max_wait seconds after its first request, up to
+    max_batch_size inputs. If the model fails on a batch, its requests are
+    run again one at a time: only the ones that fail alone get the error.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait=0.005):
+        if max_batch_size < 1:
+            raise ValueError("max_batch_size should be positive, got {}".format(max_batch_size))
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.num_batches = 0
+        self.num_requests = 0
+        self.__queue = queue.Queue()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def submit(self, sentences):
+        """The log_probs, token_ids and masked_indices of the input
+        sentences, as returned by get_generation."""
+        request = _Request(sentences)
+        self.__queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __next_batch(self):
+        """The next batch, None once closed."""
+        request = self.__queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.__queue.get(block=timeout > 0, timeout=max(timeout, 0))
+            except queue.Empty:
+                break
+            if request is None:
+                # run this batch, then stop
+                self.__queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def __generate(self, batch):
+        """Set the result of each request of the batch (one forward)."""
+        self.num_batches += 1
+        with torch.no_grad():
+            log_probs_list, token_ids_list, masked_indices_list = self.model.get_batch_generation(
+                [request.sentences for request in batch], try_cuda=False
+            )
+        for i, request in enumerate(batch):
+            request.result = (log_probs_list[i], token_ids_list[i], masked_indices_list[i])
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if batch is None:
+                return
+            try:
+                self.__generate(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].error = e
+                else:
+                    # a bad probe fails the whole batch: run the requests
+                    # one by one, so that only the bad ones fail
+                    for request in batch:
+                        try:
+                            self.__generate([request])
+                        except Exception as error:
+                            request.error = error
+            self.num_requests += len(batch)
+            for request in batch:
+                request.done.set()
+
+
+def get_probe_result(vocab, log_probs, token_ids, masked_indices, topk=10, index_list=None):
+    """The answer to a probe: the topk predictions of each masked token (over
+    the vocabulary ids of index_list if given) and the perplexity of the
+    input."""
+    filtered_log_probs = log_probs
+    if index_list is not None:
+        filtered_log_probs = log_probs[:, index_list]
+
+    predictions = []
+    for masked_index in masked_indices:
+        values, indices = torch.topk(filtered_log_probs[masked_index], k=min(topk, filtered_log_probs.shape[-1]))
+        indices = indices.tolist()
+        if index_list is not None:
+            indices = [index_list[i] for i in indices]
+        predictions.append([
+            {"token": vocab[index], "log_prob": value}
+            for index, value in zip(indices, values.tolist())
+        ])
+
+    return {
+        "masked_indices": [int(i) for i in masked_indices],
+        "predictions": predictions,
+        "perplexity": get_sentence_perplexity(log_probs, token_ids, vocab),
+    }
+
+
+class _ProbeHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.__reply(404, {"error": "unknown path {}".format(self.path)})
+            return
+        self.__reply(200, {
+            name: {"requests": batcher.num_requests, "batches": batcher.num_batches}
+            for name, batcher in self.server.batchers.items()
+        })
+
+    def do_POST(self):
+        if self.path != "/probe":
+            self.__reply(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            probe = json.loads(self.rfile.read(length).decode("utf-8"))
+            model_name = probe.get("model", self.server.default_model)
+            if model_name not in self.server.batchers:
+                raise ValueError("unknown model {}".format(model_name))
+            sentences = probe["sentences"]
+            if isinstance(sentences, str):
+                sentences = [sentences]
+            if not 1 <= len(sentences) <= 2:
+                raise ValueError("a probe has one or two sentences, got {}".format(len(sentences)))
+            topk = int(probe.get("topk", self.server.topk))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.__reply(400, {"error": "bad probe: {}".format(e)})
+            return
+
+        try:
+            batcher = self.server.batchers[model_name]
+            log_probs, token_ids, masked_indices = batcher.submit(sentences)
+            result = get_probe_result(
+                batcher.model.vocab, log_probs, token_ids, masked_indices,
+                topk=topk, index_list=self.server.index_lists.get(model_name),
+            )
+        except Exception as e:
+            self.__reply(500, {"error": "{}: {}".format(type(e).__name__, e)})
+            return
+        result["model"] = model_name
+        self.__reply(200, result)
+
+    def __reply(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+
+class ProbeServer(ThreadingHTTPServer):
+    """HTTP server of the probes of loaded models (dict of name -> connector),
+    one MicroBatcher for each model.
+
+    POST /probe {"sentences": [...], "model": name, "topk": k}: the
+    predictions (see get_probe_result), over vocab_subset if given; "model"
+    defaults to the first model.
+    GET /stats: the number of requests and batches of each model.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, models, max_batch_size=32, max_wait=0.005, topk=10,
+                 vocab_subset=None, verbose=False):
+        if not models:
+            raise ValueError("no model to serve")
+        self.batchers = {
+            name: MicroBatcher(model, max_batch_size=max_batch_size, max_wait=max_wait)
+            for name, model in models.items()
+        }
+        self.default_model = next(iter(models))
+        self.topk = topk
+        # the ids of vocab_subset in the vocabulary of each model
+        self.index_lists = {}
+        if vocab_subset is not None:
+            for name, model in models.items():
+                _, self.index_lists[name] = model.init_indices_for_filter_logprobs(vocab_subset)
+        self.verbose = verbose
+        super().__init__(address, _ProbeHandler)
+
+    def close(self):
+        """Stop serving (if serve_forever runs in another thread) and stop
+        the batchers."""
+        self.shutdown()
+        self.server_close()
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+def main(args):
+    print("Language Models: {}".format(args.models_names))
+
+    # the models stay acquired (and loaded) as long as the server runs
+    pool = get_model_pool()
+    pool.set_max_memory(options.get_models_memory(args))
+    models = {}
+    for model_name in args.models_names:
+        models[model_name] = pool.acquire(model_name, args)
+        if args.cuda:
+            models[model_name].try_cuda()
+
+    vocab_subset = None
+    if args.common_vocab_filename is not None:
+        vocab_subset = load_vocab(args.common_vocab_filename)
+        print("common vocabulary size: {}".format(len(vocab_subset)))
+
+    server = ProbeServer(
+        (args.host, args.port), models,
+        max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000.0,
+        topk=args.topk, vocab_subset=vocab_subset, verbose=args.verbose,
+    )
+    print("serving on http://{}:{}/probe".format(*server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for batcher in server.batchers.values():
+            batcher.close()
+        for model in models.values():
+            pool.release(model)
+
+
+if __name__ == '__main__':
+    parser = options.get_probe_server_parser()
+    args = options.parse_args(parser)
+    main(args)
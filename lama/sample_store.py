@@ -0,0 +1,125 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import json
+import numpy as np
+
+UUID_LENGTH = 64
+RELATION_LENGTH = 32
+
+
+def get_sample_dtype(topk):
+    """Returns the numpy dtype of a record of the sample store.
+
+    gold_rank is the 1-based rank of the object label in the (filtered)
+    vocabulary, -1 if it is not in the ranked predictions. topk_ids are ids
+    of the model vocabulary. overlap and spearman are nan without negated
+    probes.
+    """
+    return np.dtype(
+        [
+            ("uuid", "S{}".format(UUID_LENGTH)),
+            ("relation", "S{}".format(RELATION_LENGTH)),
+            ("label_id", np.int32),
+            ("gold_rank", np.int32),
+            ("gold_log_prob", np.float32),
+            ("topk_ids", np.int32, (topk,)),
+            ("topk_log_probs", np.float32, (topk,)),
+            ("overlap", np.float32),
+            ("spearman", np.float32),
+        ]
+    )
+
+
+class SampleStore(object):
+    """Append-only store of per-sample results.
+
+    Records are numpy structured arrays appended to filename as raw bytes, so
+    writing takes constant memory and a crash loses at most the current
+    batch. The dtype is in filename + ".json". Use load_samples to read the
+    store as a memory-mapped array.
+    """
+
+    def __init__(self, filename, topk=10, append=True):
+        self.filename = filename
+        self.topk = topk
+        self.dtype = get_sample_dtype(topk)
+        header_filename = filename + ".json"
+        if append and os.path.isfile(header_filename):
+            with open(header_filename, "r") as f:
+                header = json.load(f)
+            if header["topk"] != topk:
+                raise ValueError(
+                    "{} was written with topk={}".format(filename, header["topk"])
+                )
+        else:
+            with open(header_filename, "w") as f:
+                json.dump({"topk": topk, "descr": self.dtype.descr}, f)
+        self.file = open(filename, "ab" if append else "wb")
+
+    def __len__(self):
+        return self.file.tell() // self.dtype.itemsize
+
+    def truncate(self, num_records):
+        """Drop the records after the first num_records (e.g., the ones of the
+        batches evaluated after the last checkpoint)."""
+        self.file.truncate(num_records * self.dtype.itemsize)
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, elements, relation_id=None, negated_results=None):
+        """Append the elements (see evaluate_batch in
+        batch_eval_KB_completion) of a batch."""
+        records = np.zeros(len(elements), dtype=self.dtype)
+        for i, element in enumerate(elements):
+            record = records[i]
+            sample = element["sample"]
+            experiment_result = element["masked_topk"]
+            rel_id = sample.get("relation_id", relation_id)
+            record["uuid"] = str(element["uuid"]).encode("utf-8")[:UUID_LENGTH]
+            record["relation"] = str(rel_id).encode("utf-8")[:RELATION_LENGTH]
+            record["label_id"] = element["label_index"][0]
+            if element["sample_MRR"] > 0:
+                record["gold_rank"] = int(round(1.0 / element["sample_MRR"]))
+            else:
+                record["gold_rank"] = -1
+            if experiment_result["PERPLEXITY"] is not None:
+                record["gold_log_prob"] = experiment_result["PERPLEXITY"]
+            else:
+                record["gold_log_prob"] = np.nan
+            topk = experiment_result["topk"][: self.topk]
+            record["topk_ids"][: len(topk)] = [x["token_idx"] for x in topk]
+            record["topk_ids"][len(topk):] = -1
+            record["topk_log_probs"][: len(topk)] = [x["log_prob"] for x in topk]
+            record["topk_log_probs"][len(topk):] = -np.inf
+            record["overlap"] = np.nan
+            record["spearman"] = np.nan
+            if negated_results is not None and negated_results[i] is not None:
+                overlap, spearman, _ = negated_results[i]
+                record["overlap"] = overlap
+                record["spearman"] = spearman
+        self.file.write(records.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_samples(filename):
+    """Returns the records of a sample store as a read-only memory-mapped
+    numpy structured array, e.g.:
+
+        samples = load_samples("output/results/bert_base/P19/samples_test.bin")
+        p_at_1 = (samples["gold_rank"] == 1).mean()
+        errors = samples[samples["topk_ids"][:, 0] != samples["label_id"]]
+    """
+    with open(filename + ".json", "r") as f:
+        header = json.load(f)
+    dtype = get_sample_dtype(header["topk"])
+    num_records = os.path.getsize(filename) // dtype.itemsize
+    if num_records == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r", shape=(num_records,))
@@ -0,0 +1,152 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import json
+import numpy as np
+import torch
+
+UUID_LENGTH = 64
+RELATION_LENGTH = 32
+
+
+def get_score_dtype(num_scores, full_vocab):
+    """Returns the numpy dtype of a record of the score store.
+
+    log_probs are the log-probabilities over the whole model vocabulary at the
+    (first) masked position: all of them if full_vocab, otherwise only the
+    num_scores highest ones, with their vocabulary ids and the logsumexp of
+    all the others (tail).
+    """
+    fields = [
+        ("uuid", "S{}".format(UUID_LENGTH)),
+        ("relation", "S{}".format(RELATION_LENGTH)),
+        ("label_id", np.int32),
+        ("gold_log_prob", np.float32),
+        ("tail", np.float32),
+    ]
+    if not full_vocab:
+        fields.append(("ids", np.int32, (num_scores,)))
+    fields.append(("log_probs", np.float32, (num_scores,)))
+    return np.dtype(fields)
+
+
+class ScoreStore(object):
+    """Append-only, memory-mappable store of the masked-position scores of
+    each sample, to re-score an evaluation (other vocab subsets, metrics or
+    aggregations) without running the model again (see scripts/rescore.py).
+
+    The records are appended to filename, the model vocabulary and the
+    templates of the relations are in filename + ".json".
+
+    Parameters:
+    vocab (list[string]): the model vocabulary
+    topn (int): number of scores saved for each sample, 0 for the whole
+                vocabulary
+    """
+
+    def __init__(self, filename, vocab, topn=1000, templates=None, append=True):
+        self.filename = filename
+        self.full_vocab = topn <= 0 or topn >= len(vocab)
+        self.num_scores = len(vocab) if self.full_vocab else topn
+        self.dtype = get_score_dtype(self.num_scores, self.full_vocab)
+        header = {
+            "num_scores": self.num_scores,
+            "full_vocab": self.full_vocab,
+            "vocab": list(vocab),
+            "templates": templates or {},
+        }
+        header_filename = filename + ".json"
+        if append and os.path.isfile(header_filename):
+            with open(header_filename, "r") as f:
+                old_header = json.load(f)
+            if old_header != header:
+                raise ValueError(
+                    "{} was written with another model or settings".format(filename)
+                )
+        else:
+            with open(header_filename, "w") as f:
+                json.dump(header, f)
+        self.file = open(filename, "ab" if append else "wb")
+
+    def __len__(self):
+        return self.file.tell() // self.dtype.itemsize
+
+    def truncate(self, num_records):
+        self.file.truncate(num_records * self.dtype.itemsize)
+        self.file.seek(0, os.SEEK_END)
+
+    def append(self, elements, negated_results=None):
+        """Append the elements of a batch (see evaluate_batch in
+        batch_eval_KB_completion)."""
+        if not elements:
+            return
+        records = np.zeros(len(elements), dtype=self.dtype)
+        log_probs = torch.stack(
+            [element["masked_log_probs"] for element in elements]
+        ).float()
+        label_ids = torch.tensor(
+            [element["label_index"][0] for element in elements], dtype=torch.long
+        )
+        records["gold_log_prob"] = log_probs.gather(1, label_ids.unsqueeze(1)).squeeze(1).numpy()
+        records["label_id"] = label_ids.numpy()
+        if self.full_vocab:
+            records["log_probs"] = log_probs.numpy()
+            records["tail"] = -np.inf
+        else:
+            values, ids = torch.topk(log_probs, k=self.num_scores, dim=1)
+            records["log_probs"] = values.numpy()
+            records["ids"] = ids.numpy()
+            tail = log_probs.scatter(1, ids, float("-inf"))
+            records["tail"] = torch.logsumexp(tail, dim=1).numpy()
+        records["uuid"] = [
+            str(element["uuid"]).encode("utf-8")[:UUID_LENGTH] for element in elements
+        ]
+        records["relation"] = [
+            str(element["sample"].get("relation_id")).encode("utf-8")[:RELATION_LENGTH]
+            for element in elements
+        ]
+        self.file.write(records.tobytes())
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def load_scores(filename):
+    """Returns (header, records) of a score store. The records are a
+    read-only memory-mapped numpy structured array."""
+    with open(filename + ".json", "r") as f:
+        header = json.load(f)
+    dtype = get_score_dtype(header["num_scores"], header["full_vocab"])
+    num_records = os.path.getsize(filename) // dtype.itemsize
+    if num_records == 0:
+        return header, np.zeros(0, dtype=dtype)
+    return header, np.memmap(filename, dtype=dtype, mode="r", shape=(num_records,))
+
+
+def get_ranks(header, records, vocab_mask, chunk_size=1024):
+    """Rank of the gold label of each record among the words of vocab_mask.
+
+    Returns:
+    ranks (np.array): 1-based ranks
+    exact (np.array): False if the rank is only a lower bound (the gold label
+                      scored below the saved top-N scores)
+    """
+    num_records = len(records)
+    ranks = np.zeros(num_records, dtype=np.int64)
+    exact = np.ones(num_records, dtype=bool)
+    for start in range(0, num_records, chunk_size):
+        chunk = records[start : start + chunk_size]
+        gold = chunk["gold_log_prob"][:, None]
+        log_probs = np.asarray(chunk["log_probs"])
+        if header["full_vocab"]:
+            in_subset = vocab_mask[None, :]
+        else:
+            in_subset = vocab_mask[chunk["ids"]]
+            exact[start : start + chunk_size] = chunk["gold_log_prob"] >= log_probs[:, -1]
+        ranks[start : start + chunk_size] = 1 + ((log_probs > gold) & in_subset).sum(axis=1)
+    return ranks, exact
@@ -0,0 +1,293 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import json
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+RESULTS = "results"
+FAILED = "failed"
+
+
+def _write_json_atomic(filename, obj):
+    # write to a temporary file in the same directory, then rename it: readers
+    # never see a partially written file
+    tmp_filename = "{}.tmp.{}.{}".format(filename, socket.gethostname(), os.getpid())
+    with open(tmp_filename, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filename, filename)
+
+
+def _read_json(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+class TaskQueue(object):
+    """A work queue on a directory shared by several nodes (e.g., over NFS).
+
+    Each task is a json file that moves through the sub-directories
+    pending/ -> claimed/ -> done/ of queue_dir. A task is claimed by renaming
+    it from pending/ to claimed/: rename is atomic on the shared filesystem,
+    so exactly one worker gets each task. The result of a task is written to
+    results/ before the task is moved to done/.
+
+    While a worker evaluates a task it touches a heartbeat file of the task
+    in claimed/, which is never renamed. Claimed tasks without a heartbeat
+    for more than stale_timeout seconds belong to a dead worker and are moved
+    back to pending/, so nodes can be added or restarted at any time without
+    losing or repeating work. The age of a heartbeat is measured with the
+    clock of the shared filesystem (the one that sets the modification
+    times), not with the clocks of the nodes.
+
+    A task whose evaluation raises is moved back to pending/, until it has
+    failed max_attempts times: then it is moved to done/ without a result,
+    and the errors are kept in failed/.
+    """
+
+    def __init__(self, queue_dir, stale_timeout=600, heartbeat_interval=None, max_attempts=3):
+        self.queue_dir = queue_dir
+        self.stale_timeout = stale_timeout
+        if heartbeat_interval is None:
+            heartbeat_interval = stale_timeout / 4.0
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.worker_id = "{}.{}".format(socket.gethostname(), os.getpid())
+        for state in [PENDING, CLAIMED, DONE, RESULTS, FAILED]:
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def _path(self, state, task_id):
+        return os.path.join(self.queue_dir, state, "{}.json".format(task_id))
+
+    def _heartbeat_path(self, task_id):
+        return os.path.join(self.queue_dir, CLAIMED, "{}.heartbeat".format(task_id))
+
+    def _list(self, state):
+        return sorted(
+            f[: -len(".json")]
+            for f in os.listdir(os.path.join(self.queue_dir, state))
+            if f.endswith(".json")
+        )
+
+    def add_task(self, task_id, task):
+        """Add a task, unless a task with the same id is already in the queue.
+
+        Returns True if the task was added.
+        """
+        for state in [PENDING, CLAIMED, DONE]:
+            if os.path.exists(self._path(state, task_id)):
+                return False
+        _write_json_atomic(self._path(PENDING, task_id), task)
+        return True
+
+    def claim(self):
+        """Claim a pending task.
+
+        Returns:
+            A tuple (task_id, task), or None if there are no pending tasks.
+        """
+        self.requeue_stale()
+        for task_id in self._list(PENDING):
+            # beat before the task is in claimed/, so that it is never seen
+            # there with the heartbeat of a previous claim
+            self.heartbeat(task_id)
+            try:
+                os.rename(self._path(PENDING, task_id), self._path(CLAIMED, task_id))
+            except OSError:
+                # claimed by another worker
+                continue
+            return task_id, _read_json(self._path(CLAIMED, task_id))
+        return None
+
+    def heartbeat(self, task_id):
+        heartbeat = self._heartbeat_path(task_id)
+        with open(heartbeat, "a"):
+            pass
+        os.utime(heartbeat, None)
+
+    def _last_heartbeat(self, task_id, claimed):
+        try:
+            return os.path.getmtime(self._heartbeat_path(task_id))
+        except OSError:
+            # claimed without a heartbeat file
+            return os.path.getmtime(claimed)
+
+    def _clock(self):
+        """The current time of the shared filesystem: the mtime of a file of
+        this worker, touched now."""
+        probe = os.path.join(self.queue_dir, ".clock.{}".format(self.worker_id))
+        with open(probe, "a"):
+            pass
+        os.utime(probe, None)
+        return os.path.getmtime(probe)
+
+    def complete(self, task_id, result):
+        _write_json_atomic(self._path(RESULTS, task_id), result)
+        for state in [CLAIMED, PENDING]:
+            # the task may have been requeued if this worker missed heartbeats
+            try:
+                os.rename(self._path(state, task_id), self._path(DONE, task_id))
+                break
+            except OSError:
+                continue
+        self._remove_heartbeat(task_id)
+
+    def _remove_heartbeat(self, task_id):
+        try:
+            os.remove(self._heartbeat_path(task_id))
+        except OSError:
+            pass
+
+    def release(self, task_id):
+        """Give back a claimed task (e.g., after a failure)."""
+        os.rename(self._path(CLAIMED, task_id), self._path(PENDING, task_id))
+
+    def fail(self, task_id, error):
+        """Record a failed evaluation of a claimed task, and release it or,
+        after max_attempts failures, move it to done/ without a result.
+
+        Returns True if the task was given up.
+        """
+        failure = {"attempts": 0, "errors": []}
+        if os.path.exists(self._path(FAILED, task_id)):
+            failure = _read_json(self._path(FAILED, task_id))
+        failure["attempts"] += 1
+        failure["errors"].append(error)
+        _write_json_atomic(self._path(FAILED, task_id), failure)
+        given_up = failure["attempts"] >= self.max_attempts
+        try:
+            if given_up:
+                os.rename(self._path(CLAIMED, task_id), self._path(DONE, task_id))
+                self._remove_heartbeat(task_id)
+                print("Task {} failed {} times: given up".format(task_id, failure["attempts"]))
+            else:
+                self.release(task_id)
+        except OSError:
+            # requeued by another worker
+            pass
+        return given_up
+
+    def requeue_stale(self):
+        """Move back to pending/ the claimed tasks of dead workers.
+
+        A stale task is first renamed to a tombstone of this worker: from
+        then on, its completion and the other workers fail to move it. It is
+        then requeued only if it is still stale and has no result (otherwise
+        it is moved back to claimed/ or to done/). The heartbeat file is not
+        renamed, so the heartbeats during the requeue are not lost.
+        """
+        now = self._clock()
+        for task_id in self._list(CLAIMED):
+            claimed = self._path(CLAIMED, task_id)
+            tombstone = "{}.requeue.{}.{}".format(claimed, self.worker_id, uuid.uuid4().hex)
+            try:
+                if now - self._last_heartbeat(task_id, claimed) <= self.stale_timeout:
+                    continue
+                os.rename(claimed, tombstone)
+            except OSError:
+                # completed or requeued by another worker in the meantime
+                continue
+            if os.path.exists(self._path(RESULTS, task_id)):
+                # completed while its claimed file was checked
+                os.rename(tombstone, self._path(DONE, task_id))
+            elif self._clock() - self._last_heartbeat(task_id, tombstone) <= self.stale_timeout:
+                # a heartbeat since the check: the worker is alive
+                os.rename(tombstone, claimed)
+            else:
+                os.rename(tombstone, self._path(PENDING, task_id))
+                print("Task {} requeued (no heartbeat)".format(task_id))
+
+    def num_tasks(self, state):
+        return len(self._list(state))
+
+    def is_finished(self):
+        return self.num_tasks(PENDING) == 0 and self.num_tasks(CLAIMED) == 0
+
+    def results(self):
+        """Returns a dictionary task_id -> result of all completed tasks."""
+        return {
+            task_id: _read_json(self._path(RESULTS, task_id))
+            for task_id in self._list(RESULTS)
+        }
+
+    def failures(self):
+        """Returns a dictionary task_id -> {"attempts", "errors"} of all the
+        tasks whose evaluation failed at least once."""
+        return {
+            task_id: _read_json(self._path(FAILED, task_id))
+            for task_id in self._list(FAILED)
+        }
+
+    def run_worker(self, evaluate, wait_for_claimed=True, poll_interval=10):
+        """Evaluate tasks until the queue is empty. A task whose evaluation
+        raises an Exception is recorded as failed (see fail) and the worker
+        goes on with the next task.
+
+        Parameters:
+        evaluate (callable): function that gets a task and returns its result
+                             (a json serializable object)
+        wait_for_claimed (bool): if True, after the last pending task keep
+                                 polling until the tasks claimed by other
+                                 workers are done, to take over the ones of
+                                 workers that die
+
+        Returns:
+        num_tasks (int): the number of tasks completed by this worker
+        """
+        num_tasks = 0
+        while True:
+            claimed = self.claim()
+            if claimed is None:
+                if wait_for_claimed and self.num_tasks(CLAIMED) > 0:
+                    time.sleep(poll_interval)
+                    continue
+                return num_tasks
+            task_id, task = claimed
+            print("[{}] evaluating task {}".format(self.worker_id, task_id), flush=True)
+
+            stop = threading.Event()
+
+            def beat():
+                while not stop.wait(self.heartbeat_interval):
+                    try:
+                        self.heartbeat(task_id)
+                    except OSError:
+                        # e.g., the shared filesystem is not reachable: beat
+                        # again at the next interval
+                        continue
+
+            heartbeat_thread = threading.Thread(target=beat, daemon=True)
+            heartbeat_thread.start()
+            try:
+                result = evaluate(task)
+            except Exception:
+                stop.set()
+                heartbeat_thread.join()
+                traceback.print_exc()
+                self.fail(task_id, traceback.format_exc())
+                continue
+            except BaseException:
+                stop.set()
+                heartbeat_thread.join()
+                try:
+                    self.release(task_id)
+                except OSError:
+                    # requeued by another worker
+                    pass
+                raise
+            stop.set()
+            heartbeat_thread.join()
+            self.complete(task_id, result)
+            num_tasks += 1
@@ -80,6 +80,39 @@ def __get_topk(log_probs, topk):
     return value_max_probs, index_max_probs
 
 
+def __get_perplexity(log_probs, tokens, excluded_indices):
+    # get positional score of the correct token
+    token_probs = log_probs.gather(
+        dim=1,
+        index=tokens.view(-1, 1),
+    )
+    positional_scores = token_probs.squeeze(-1).detach().numpy()
+
+    score_sum = 0.
+    count = 0
+    for idx, score in enumerate(positional_scores):
+        if idx not in excluded_indices:
+            score_sum += score
+            count += 1
+
+    if count > 0:
+        avg_nll_loss = - (score_sum / count)
+    else:
+        avg_nll_loss = 0.0
+    perplexity = np.exp(avg_nll_loss)
+    return perplexity, positional_scores
+
+
+def get_sentence_perplexity(log_probs, token_ids, vocab):
+    """Perplexity of the tokens of a sentence that are not special symbols,
+    as printed by print_sentence_predictions."""
+    log_probs = log_probs[:len(token_ids)]
+    excluded_indices = __exclude_tokens(token_ids, vocab)
+    tokens = torch.from_numpy(np.asarray(token_ids))
+    perplexity, _ = __get_perplexity(log_probs, tokens.view(-1), excluded_indices)
+    return float(perplexity)
+
+
 def print_sentence_predictions(log_probs, token_ids, vocab,
                                masked_indices=None, print_generation=True,
                                topk=1000):
@@ -104,25 +137,7 @@ def print_sentence_predictions(log_probs, token_ids, vocab,
 
     rank_dict = dict(zip(*ranking_position))
 
-    # get positional score of the correct token
-    token_probs = log_probs.gather(
-        dim=1,
-        index=tokens.view(-1, 1),
-    )
-    positional_scores = token_probs.squeeze(-1).detach().numpy()
-
-    score_sum = 0.
-    count = 0
-    for idx, score in enumerate(positional_scores):
-        if idx not in excluded_indices:
-            score_sum += score
-            count += 1
-
-    if count > 0:
-        avg_nll_loss = - (score_sum / count)
-    else:
-        avg_nll_loss = 0.0
-    perplexity = np.exp(avg_nll_loss)
+    perplexity, positional_scores = __get_perplexity(log_probs, tokens, excluded_indices)
 
     # print("positional_scores: {}".format(positional_scores))
     # print("avg_nll_loss: {}".format(avg_nll_loss))
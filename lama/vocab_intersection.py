@@ -4,7 +4,7 @@
 # This source code is licensed under the license found in the
 # LICENSE file in the root directory of this source tree.
 #
-from lama.modules import build_model_by_name
+from lama.modules import ModelPool
 from tqdm import tqdm
 import argparse
 import spacy
@@ -89,15 +89,17 @@ LOWERCASED_COMMON_VOCAB_FILENAME = "pre-trained_language_models/common_vocab_low
 def __vocab_intersection(models, filename):
 
     vocabularies = []
+    # only the vocabularies are kept: a pool of its own with no budget for
+    # models not in use, each one is dropped before the next one is loaded
+    pool = ModelPool(max_memory=0)
 
     for arg_dict in models:
 
         args = argparse.Namespace(**arg_dict)
         print(args)
-        model = build_model_by_name(args.lm, args)
-
-        vocabularies.append(model.vocab)
-        print(type(model.vocab))
+        with pool.model(args.lm, args) as model:
+            vocabularies.append(model.vocab)
+            print(type(model.vocab))
 
     if len(vocabularies) > 0:
         common_vocab = set(vocabularies[0])
@@ -12,15 +12,18 @@ from tqdm import tqdm
 from random import shuffle
 import os
 import json
-import spacy
 import lama.modules.base_connector as base
 from pprint import pprint
 import logging.config
 import logging
 import pickle
+import weakref
 from multiprocessing.pool import ThreadPool
 import multiprocessing
 import lama.evaluation_metrics as metrics
+from lama.sample_store import SampleStore
+from lama.score_store import ScoreStore
+from lama.async_logging import start_async_logging, stop_async_logging, JsonlFormatter
 import time, sys
 import random
 from collections import defaultdict
@@ -65,7 +68,13 @@ def parse_template(template, subject_label, object_label, context):
         return [template]
 
 
-def init_logging(log_directory):
+def init_logging(log_directory, log_format="text"):
+    """Log to log_directory/info.log (text) or log_directory/events.jsonl
+    (jsonl, see JsonlFormatter), and warnings to stdout.
+
+    The records are written by a background thread: call close_logging to
+    flush them. The handlers of a previous call are closed first.
+    """
     logger = logging.getLogger("LAMA")
     logger.setLevel(logging.DEBUG)
 
@@ -78,23 +87,30 @@ def init_logging(log_directory):
     )
 
     # file handler
-    fh = logging.FileHandler(str(log_directory) + "/info.log")
+    if log_format == "jsonl":
+        fh = logging.FileHandler(str(log_directory) + "/events.jsonl")
+        fh.setFormatter(JsonlFormatter())
+    else:
+        fh = logging.FileHandler(str(log_directory) + "/info.log")
+        fh.setFormatter(formatter)
     fh.setLevel(logging.DEBUG)
-    fh.setFormatter(formatter)
 
     # console handler
     ch = logging.StreamHandler(sys.stdout)
     ch.setLevel(logging.WARNING)
     ch.setFormatter(formatter)
 
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    start_async_logging(logger, [fh, ch])
 
     logger.propagate = False
 
     return logger
 
 
+def close_logging(logger):
+    stop_async_logging(logger)
+
+
 def batchify(data, batch_size):
     msg = ""
     list_samples_batches = []
@@ -156,12 +172,22 @@ def batchify_negated(data, batch_size):
     return list_sentences_batches, msg
 
 
-def run_thread(arguments):
+class SampleMessage(object):
+    """The message of a sample for the text log (see run_thread), formatted
+    only if a log record of the sample is written."""
+
+    def __init__(self, experiment_result):
+        self.experiment_result = experiment_result
+        self.extra_msg = ""
+
+    def __str__(self):
+        return "\n" + metrics.format_top_k(self.experiment_result["topk"]) + self.extra_msg
 
-    msg = ""
+
+def run_thread(arguments):
 
     # 1. compute the ranking metrics on the filtered log_probs tensor
-    sample_MRR, sample_P, experiment_result, return_msg = metrics.get_ranking(
+    sample_MRR, sample_P, experiment_result, _ = metrics.get_ranking(
         arguments["filtered_log_probs"],
         arguments["masked_indices"],
         arguments["vocab"],
@@ -169,8 +195,9 @@ def run_thread(arguments):
         index_list=arguments["index_list"],
         print_generation=arguments["interactive"],
         topk=10000,
+        format_msg=False,
     )
-    msg += "\n" + return_msg
+    msg = SampleMessage(experiment_result)
 
     sample_perplexity = 0.0
     if arguments["interactive"]:
@@ -185,7 +212,7 @@ def run_thread(arguments):
             print_generation=arguments["interactive"],
         )
         input("press enter to continue...")
-        msg += "\n" + return_msg
+        msg.extra_msg += "\n" + return_msg
 
     return experiment_result, sample_MRR, sample_P, sample_perplexity, msg
 
@@ -231,15 +258,18 @@ def lowercase_samples(samples, use_negated_probes=False):
     return new_samples
 
 
-def filter_samples(model, samples, vocab_subset, max_sentence_length, template):
+def filter_samples(model, samples, vocab_subset, max_sentence_length, template, cache=None):
     msg = ""
+    get_id = model.get_id
+    if cache is not None:
+        get_id = lambda string: cache.get_id(model, string)
     new_samples = []
     samples_exluded = 0
     for sample in samples:
         excluded = False
         if "obj_label" in sample and "sub_label" in sample:
 
-            obj_label_ids = model.get_id(sample["obj_label"])
+            obj_label_ids = get_id(sample["obj_label"])
             
             # if len(obj_label_ids) > 1:
             #     samples_exluded += 1
@@ -316,21 +346,8 @@ def filter_samples(model, samples, vocab_subset, max_sentence_length, template):
     return new_samples, msg
 
 
-def main(args, rel_id, shuffle_data=True, model=None, use_ctx=False, synthetic=False):
-    # Set random seed so randomly picking context sentences is consistent across runs
-    random.seed(0)
-
-    if len(args.models_names) > 1:
-        raise ValueError('Please specify a single language model (e.g., --lm "bert").')
-
-    msg = ""
-
+def get_model_name(args):
     [model_type_name] = args.models_names
-
-    print(model)
-    if model is None:
-        model = build_model_by_name(model_type_name, args)
-
     if model_type_name == "fairseq":
         model_name = "fairseq_{}".format(args.fairseq_model_name)
     elif model_type_name == "bert":
@@ -339,59 +356,80 @@ def main(args, rel_id, shuffle_data=True, model=None, use_ctx=False, synthetic=F
         model_name = "ELMo_{}".format(args.elmo_model_name)
     else:
         model_name = model_type_name.title()
+    return model_name
 
-    # initialize logging
-    if args.full_logdir:
-        log_directory = args.full_logdir
-    else:
-        log_directory = create_logdir_with_timestamp(args.logdir, model_name)
-    logger = init_logging(log_directory)
-    msg += "model name: {}\n".format(model_name)
-
-    # deal with vocab subset
-    vocab_subset = None
-    index_list = None
-    msg += "args: {}\n".format(args)
-    if args.common_vocab_filename is not None:
-        vocab_subset = load_vocab(args.common_vocab_filename)
-        msg += "common vocabulary size: {}\n".format(len(vocab_subset))
-
-        # optimization for some LM (such as ELMo)
-        model.optimize_top_layer(vocab_subset)
 
-        filter_logprob_indices, index_list = model.init_indices_for_filter_logprobs(
-            vocab_subset, logger
-        )
+def init_vocab_subset(model, common_vocab_filename, logger=None):
+    """Load the common vocabulary and the indices used to filter the log_probs.
 
-    logger.info("\n" + msg + "\n")
+    Returns:
+        A tuple (vocab_subset, filter_logprob_indices, index_list).
+    """
+    vocab_subset = load_vocab(common_vocab_filename)
 
-    # dump arguments on file for log
-    with open("{}/args.json".format(log_directory), "w") as outfile:
-        json.dump(vars(args), outfile)
+    # optimization for some LM (such as ELMo)
+    model.optimize_top_layer(vocab_subset)
 
-    # stats
-    samples_with_negative_judgement = 0
-    samples_with_positive_judgement = 0
+    filter_logprob_indices, index_list = model.init_indices_for_filter_logprobs(
+        vocab_subset, logger
+    )
+    return vocab_subset, filter_logprob_indices, index_list
+
+
+class EvaluationCache(object):
+    """Cache shared by the evaluations of an experiment grid.
+
+    It keeps the parsed dataset files, the vocab subsets with their filtering
+    indices and the tokenization of the object labels, so that they are
+    computed once per model (or once at all for the files) instead of once
+    per relation, split and template.
+    """
+
+    def __init__(self):
+        self._files = {}
+        # model -> its vocab subsets and tokenized labels; weak keys: the
+        # entries of a model are dropped with it, the cache does not keep it
+        # loaded
+        self._model_entries = weakref.WeakKeyDictionary()
+
+    def _entries(self, model):
+        if model not in self._model_entries:
+            self._model_entries[model] = {"vocab_subsets": {}, "ids": {}}
+        return self._model_entries[model]
+
+    def load_file(self, filename):
+        if filename not in self._files:
+            self._files[filename] = load_file(filename)
+        # samples are modified in place during the evaluation (e.g., uuid)
+        return [dict(sample) for sample in self._files[filename]]
+
+    def init_vocab_subset(self, model, common_vocab_filename, logger=None):
+        vocab_subsets = self._entries(model)["vocab_subsets"]
+        if common_vocab_filename not in vocab_subsets:
+            vocab_subsets[common_vocab_filename] = init_vocab_subset(
+                model, common_vocab_filename, logger
+            )
+        vocab_subset, filter_logprob_indices, index_list = vocab_subsets[common_vocab_filename]
+        return list(vocab_subset), filter_logprob_indices, index_list
 
-    # Mean reciprocal rank
-    MRR = 0.0
-    MRR_negative = 0.0
-    MRR_positive = 0.0
+    def get_id(self, model, string):
+        ids = self._entries(model)["ids"]
+        if string not in ids:
+            ids[string] = model.get_id(string)
+        return ids[string]
 
-    # Precision at (default 10)
-    Precision = 0.0
-    Precision1 = 0.0
-    Precision_negative = 0.0
-    Precision_positivie = 0.0
+    def forget_model(self, model):
+        """Drop the entries of model (e.g., before loading the next model)."""
+        self._model_entries.pop(model, None)
 
-    # spearman rank correlation
-    # overlap at 1
-    if args.use_negated_probes:
-        Spearman = 0.0
-        Overlap = 0.0
-        num_valid_negation = 0.0
 
-    data = load_file(args.dataset_filename)
+def build_samples(args, model, vocab_subset, logger, use_ctx=False, synthetic=False, cache=None):
+    """Read, filter and (if a template is given) rewrite the samples of
+    args.dataset_filename. Returns the list of samples to evaluate."""
+    if cache is not None:
+        data = cache.load_file(args.dataset_filename)
+    else:
+        data = load_file(args.dataset_filename)
 
     print('Number of samples in raw data:', len(data))
 
@@ -406,7 +444,7 @@ def main(args, rel_id, shuffle_data=True, model=None, use_ctx=False, synthetic=F
         all_samples = data
 
     all_samples, ret_msg = filter_samples(
-        model, data, vocab_subset, args.max_sentence_length, args.template
+        model, data, vocab_subset, args.max_sentence_length, args.template, cache=cache
     )
 
     # OUT_FILENAME = "{}.jsonl".format(args.dataset_filename)
@@ -549,199 +587,686 @@ def main(args, rel_id, shuffle_data=True, model=None, use_ctx=False, synthetic=F
             sample["uuid"] = i
         i += 1
 
-    # shuffle data
-    if shuffle_data:
-        shuffle(all_samples)
+    return all_samples
+
+
+class RelationMetrics(object):
+    """Running sums of the evaluation metrics of a single relation."""
+
+    def __init__(self, use_ctx=False, use_negated_probes=False):
+        self.use_ctx = use_ctx
+        self.use_negated_probes = use_negated_probes
+        self.num_results = 0
+
+        # stats
+        self.samples_with_negative_judgement = 0
+        self.samples_with_positive_judgement = 0
+
+        # Mean reciprocal rank
+        self.MRR = 0.0
+        self.MRR_negative = 0.0
+        self.MRR_positive = 0.0
+
+        # Precision at (default 10)
+        self.Precision = 0.0
+        self.Precision1 = 0.0
+        self.Precision_negative = 0.0
+        self.Precision_positivie = 0.0
+
+        # spearman rank correlation
+        # overlap at 1
+        self.Spearman = 0.0
+        self.Overlap = 0.0
+        self.num_valid_negation = 0.0
+
+        # Keep track of each fact and its points
+        self.fact_map = defaultdict(list)
+
+    def add(self, element, negated_result=None):
+        sample = element["sample"]
+        sample_MRR = element["sample_MRR"]
+        sample_P = element["sample_Precision"]
+        result_masked_topk = element["masked_topk"]
+
+        if self.use_ctx:
+            # More like fact tuple
+            rel_pair = (sample['sub_label'], sample['obj_label'])
+            # Give model a point if it's prediction is the same as the canonical form of the object
+            self.fact_map[rel_pair].append(int(element["sample_Precision1"]))
+            # Also give model a point if it's predictiction equals the surface form of the object
+            top_pred_token = result_masked_topk['topk'][0]['token_word_form']
+            self.fact_map[rel_pair].append(int(top_pred_token.lower() == sample['obj_surface'].lower()))
+
+        if self.use_negated_probes and negated_result is not None:
+            overlap, spearman, msg = negated_result
+            # sum overlap and spearmanr if not nan
+            if spearman == spearman:
+                element["spearmanr"] = spearman
+                element["overlap"] = overlap
+                self.Overlap += overlap
+                self.Spearman += spearman
+                self.num_valid_negation += 1.0
+
+        self.MRR += sample_MRR
+        self.Precision += sample_P
+        self.Precision1 += element["sample_Precision1"]
+
+        # the judgment of the annotators recording whether they are
+        # evidence in the sentence that indicates a relation between two entities.
+        num_yes = 0
+        num_no = 0
+
+        if "judgments" in sample:
+            # only for Google-RE
+            for x in sample["judgments"]:
+                if x["judgment"] == "yes":
+                    num_yes += 1
+                else:
+                    num_no += 1
+            if num_no >= num_yes:
+                self.samples_with_negative_judgement += 1
+                element["judgement"] = "negative"
+                self.MRR_negative += sample_MRR
+                self.Precision_negative += sample_P
+            else:
+                self.samples_with_positive_judgement += 1
+                element["judgement"] = "positive"
+                self.MRR_positive += sample_MRR
+                self.Precision_positivie += sample_P
+
+        self.num_results += 1
+
+    def get_results(self):
+        """Returns the averaged (MRR, Precision, Precision1, Precision1_RE)."""
+        # For CONDITIONAL probing, make evaluation fair with RE baseline by giving the model a point if it returns the correct object for ANY masked sentence of a fact
+        Precision1_RE = 0
+        if self.use_ctx and len(self.fact_map) > 0:
+            Precision1_RE = self.__num_facts_correct() / len(self.fact_map)
+
+        num_results = max(self.num_results, 1)
+        MRR = self.MRR / num_results
+        Precision = self.Precision / num_results
+        Precision1 = self.Precision1 / num_results
+        return MRR, Precision, Precision1, Precision1_RE
+
+    def __num_facts_correct(self):
+        Precision1_RE_sum = 0
+        for key, val in self.fact_map.items():
+            score = 1 if any(x == 1 for x in val) else 0
+            Precision1_RE_sum += score
+        return Precision1_RE_sum
+
+    def get_message(self, num_all_samples):
+        MRR, Precision, Precision1, Precision1_RE = self.get_results()
+
+        msg = "all_samples: {}\n".format(num_all_samples)
+        msg += "list_of_results: {}\n".format(self.num_results)
+        msg += "global MRR: {}\n".format(MRR)
+        msg += "global Precision at 10: {}\n".format(Precision)
+        msg += "global Precision at 1: {}\n".format(Precision1)
+        if self.use_ctx:
+            msg += "total num facts: {}\n".format(len(self.fact_map))
+            msg += "num facts correct: {}\n".format(self.__num_facts_correct())
+            msg += "Precision at 1 (RE): {}\n".format(Precision1_RE)
+
+        if self.use_negated_probes:
+            num_valid_negation = max(self.num_valid_negation, 1.0)
+            msg += "\n"
+            msg += "results negation:\n"
+            msg += "all_negated_samples: {}\n".format(int(self.num_valid_negation))
+            msg += "global spearman rank affirmative/negated: {}\n".format(
+                self.Spearman / num_valid_negation
+            )
+            msg += "global overlap at 1 affirmative/negated: {}\n".format(
+                self.Overlap / num_valid_negation
+            )
 
-    samples_batches, sentences_batches, ret_msg = batchify(all_samples, args.batch_size)
-    logger.info("\n" + ret_msg + "\n")
-    if args.use_negated_probes:
-        sentences_batches_negated, ret_msg = batchify_negated(
-            all_samples, args.batch_size
+        if (
+            self.samples_with_negative_judgement > 0
+            and self.samples_with_positive_judgement > 0
+        ):
+            # Google-RE specific
+            msg += "samples_with_negative_judgement: {}\n".format(
+                self.samples_with_negative_judgement
+            )
+            msg += "samples_with_positive_judgement: {}\n".format(
+                self.samples_with_positive_judgement
+            )
+            msg += "MRR_negative: {}\n".format(
+                self.MRR_negative / self.samples_with_negative_judgement
+            )
+            msg += "MRR_positive: {}\n".format(
+                self.MRR_positive / self.samples_with_positive_judgement
+            )
+            msg += "Precision_negative: {}\n".format(
+                self.Precision_negative / self.samples_with_negative_judgement
+            )
+            msg += "Precision_positivie: {}\n".format(
+                self.Precision_positivie / self.samples_with_positive_judgement
+            )
+        return msg
+
+    def state_dict(self):
+        """Returns the accumulators as a json serializable dictionary."""
+        state = dict(vars(self))
+        # json has no tuple keys
+        state["fact_map"] = [
+            [sub_label, obj_label, points]
+            for (sub_label, obj_label), points in self.fact_map.items()
+        ]
+        return state
+
+    def load_state_dict(self, state):
+        state = dict(state)
+        fact_map = defaultdict(list)
+        for sub_label, obj_label, points in state.pop("fact_map"):
+            fact_map[(sub_label, obj_label)] = list(points)
+        vars(self).update(state)
+        self.fact_map = fact_map
+
+
+def get_split_filename(log_directory, name, dataset_filename, extension):
+    """Returns log_directory/name_<split><extension>, where split is the name
+    of the dataset file (the splits of a relation share the log directory)."""
+    if dataset_filename:
+        split = os.path.splitext(os.path.basename(dataset_filename))[0]
+        name = "{}_{}".format(name, split)
+    return os.path.join(log_directory, name + extension)
+
+
+def _file_fingerprint(filename):
+    """The path, size and modification time of a file (None if missing)."""
+    if filename is None:
+        return None
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return [filename, None, None]
+    return [filename, stat.st_size, stat.st_mtime_ns]
+
+
+# the arguments, besides the ones of the language model, that change the
+# samples, the batches or the predictions
+FINGERPRINT_ARGS = [
+    "batch_size",
+    "lowercase",
+    "max_sentence_length",
+    "max_context_tokens",
+    "quantize",
+    "use_negated_probes",
+]
+
+
+def get_evaluation_fingerprint(args_list):
+    """What the checkpoint of the evaluation of the relations of args_list
+    depends on: the language model and its files, the dataset, template and
+    common vocabulary of each relation, and the batching options. A
+    checkpoint saved with another fingerprint is not resumed."""
+    args = args_list[0]
+    [model_type_name] = args.models_names
+    model_args = {
+        key: value
+        for key, value in sorted(vars(args).items())
+        if key.startswith(model_type_name + "_")
+    }
+    # the weights and vocabulary files of the model directory
+    model_files = []
+    model_dir = model_args.get(model_type_name + "_model_dir")
+    if model_dir is not None and os.path.isdir(model_dir):
+        for name in sorted(os.listdir(model_dir)):
+            model_files.append(_file_fingerprint(os.path.join(model_dir, name)))
+    fingerprint = {
+        "models_names": list(args.models_names),
+        "model_args": model_args,
+        "model_files": model_files,
+        "common_vocab": _file_fingerprint(args.common_vocab_filename),
+        "args": {key: getattr(args, key, None) for key in FINGERPRINT_ARGS},
+        "relations": [
+            {
+                "dataset": _file_fingerprint(a.dataset_filename),
+                "template": getattr(a, "template", None),
+                "template_negated": getattr(a, "template_negated", None),
+            }
+            for a in args_list
+        ],
+    }
+    # as loaded back from json (no tuples)
+    return json.loads(json.dumps(fingerprint))
+
+
+class EvaluationCheckpoint(object):
+    """Periodic checkpoint of the metrics of an evaluation.
+
+    The accumulators of each relation and the number of completed batches are
+    saved to a json file in the log directory, one for each split (the splits
+    of a relation share the log directory). Since the samples and the batches
+    are deterministic (fixed random seed), a resumed evaluation skips the
+    completed batches and starts again from the first missing one.
+
+    The checkpoint is saved with the fingerprint of the evaluation (see
+    get_evaluation_fingerprint), if given, and a checkpoint with another
+    fingerprint is discarded: the evaluation starts from scratch.
+    """
+
+    def __init__(self, log_directory, dataset_filename=None, interval=100, resume=False, fingerprint=None):
+        self.filename = get_split_filename(
+            log_directory, "checkpoint", dataset_filename, ".json"
         )
-        logger.info("\n" + ret_msg + "\n")
-
-    # ThreadPool
-    num_threads = args.threads
-    if num_threads <= 0:
-        # use all available threads
-        num_threads = multiprocessing.cpu_count()
-    pool = ThreadPool(num_threads)
-    list_of_results = []
-    num_results = 0
-    # Keep track of each fact and its points
-    fact_map = defaultdict(list)
+        self.interval = interval
+        self.fingerprint = fingerprint
+        self.state = None
+        if resume and os.path.isfile(self.filename):
+            with open(self.filename, "r") as f:
+                self.state = json.load(f)
+            if fingerprint is not None and self.state.get("fingerprint") != fingerprint:
+                print(
+                    "WARNING: {} was saved by another evaluation (model, data or "
+                    "options changed), starting from scratch".format(self.filename)
+                )
+                self.state = None
 
-    for i in tqdm(range(len(samples_batches))):
+    def is_finished(self):
+        return (
+            self.state is not None
+            and self.state["completed_batches"] == self.state["num_batches"]
+        )
 
-        samples_b = samples_batches[i]
-        sentences_b = sentences_batches[i]
-        # print('SENT B:', sentences_b)
+    def restore(self, relation_metrics, num_batches=None):
+        """Load the saved accumulators into relation_metrics.
+
+        Returns the number of completed batches, i.e. the index of the first
+        batch to evaluate (0 if there is nothing to restore).
+        """
+        if self.state is None:
+            return 0
+        if set(self.state["relations"]) != set(str(r) for r in relation_metrics) or (
+            num_batches is not None and num_batches != self.state["num_batches"]
+        ):
+            print(
+                "WARNING: {} does not match this evaluation, starting from "
+                "scratch".format(self.filename)
+            )
+            self.state = None
+            return 0
+        for rel_id, metrics in relation_metrics.items():
+            metrics.load_state_dict(self.state["relations"][str(rel_id)])
+        return self.state["completed_batches"]
+
+    def restore_finished(self, relation_metrics):
+        """Load the accumulators of a finished evaluation.
+
+        Returns False if there is no finished evaluation matching
+        relation_metrics in the checkpoint.
+        """
+        if not self.is_finished():
+            return False
+        self.restore(relation_metrics)
+        return self.state is not None
+
+    def num_samples(self, rel_id):
+        return self.state["num_samples"][str(rel_id)]
+
+    def save(
+        self,
+        relation_metrics,
+        num_samples,
+        completed_batches,
+        num_batches,
+        num_stored_samples=None,
+    ):
+        self.state = {
+            "fingerprint": self.fingerprint,
+            "completed_batches": completed_batches,
+            "num_batches": num_batches,
+            "num_stored_samples": num_stored_samples,
+            "num_samples": {str(r): n for r, n in num_samples.items()},
+            "relations": {
+                str(r): metrics.state_dict() for r, metrics in relation_metrics.items()
+            },
+        }
+        # write and rename, so that a crash never leaves a truncated checkpoint
+        tmp_filename = "{}.tmp.{}".format(self.filename, os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+
+
+def get_checkpoint(args_list, log_directory):
+    """The checkpoint of the evaluation of the relations of args_list (the
+    interval and resume options are the ones of the first), or None."""
+    args = args_list[0]
+    interval = getattr(args, "checkpoint_interval", 0)
+    resume = getattr(args, "resume", False)
+    if interval <= 0 and not resume:
+        return None
+    return EvaluationCheckpoint(
+        log_directory,
+        dataset_filename=getattr(args, "dataset_filename", None),
+        interval=interval,
+        resume=resume,
+        fingerprint=get_evaluation_fingerprint(args_list),
+    )
 
-        (
-            original_log_probs_list,
-            token_ids_list,
-            masked_indices_list,
-        ) = model.get_batch_generation(sentences_b, logger=logger)
 
-        if vocab_subset is not None:
-            # filter log_probs
-            filtered_log_probs_list = model.filter_logprobs(
-                original_log_probs_list, filter_logprob_indices
+def get_result_stores(args, log_directory, model, templates):
+    """Returns the stores of per-sample results enabled in args: a
+    SampleStore (save_samples) and a ScoreStore (save_scores)."""
+    stores = []
+    append = getattr(args, "resume", False)
+    if getattr(args, "save_samples", False):
+        stores.append(
+            SampleStore(
+                get_split_filename(log_directory, "samples", args.dataset_filename, ".bin"),
+                topk=getattr(args, "samples_topk", 10),
+                append=append,
             )
-        else:
-            filtered_log_probs_list = original_log_probs_list
+        )
+    if getattr(args, "save_scores", False):
+        stores.append(
+            ScoreStore(
+                get_split_filename(log_directory, "scores", args.dataset_filename, ".bin"),
+                model.vocab,
+                topn=getattr(args, "scores_topn", 1000),
+                templates=templates,
+                append=append,
+            )
+        )
+    return stores
+
+
+def load_finished_results(log_directory, dataset_filename=None, fingerprint=None):
+    """Returns the metrics (dict rel_id -> RelationMetrics) saved in the
+    checkpoint of a finished evaluation in log_directory, or None (also if
+    the checkpoint was saved with another fingerprint than the given one)."""
+    checkpoint = EvaluationCheckpoint(
+        log_directory, dataset_filename, resume=True, fingerprint=fingerprint
+    )
+    if not checkpoint.is_finished():
+        return None
+    relation_metrics = {}
+    for rel_id, state in checkpoint.state["relations"].items():
+        relation_metrics[rel_id] = RelationMetrics()
+        relation_metrics[rel_id].load_state_dict(state)
+    return relation_metrics
+
+
+def evaluate_batch(
+    model,
+    samples_b,
+    sentences_b,
+    args,
+    pool,
+    logger,
+    vocab_subset=None,
+    filter_logprob_indices=None,
+    index_list=None,
+    sentences_b_negated=None,
+    cache=None,
+):
+    """Run the model on a batch and compute the per-sample metrics.
+
+    Returns:
+        A list with a tuple (element, msg, negated_result) for each sample in
+        the batch. negated_result is None if negated probes are not used.
+    """
+    (
+        original_log_probs_list,
+        token_ids_list,
+        masked_indices_list,
+    ) = model.get_batch_generation(sentences_b, logger=logger)
+
+    if vocab_subset is not None:
+        # filter log_probs
+        filtered_log_probs_list = model.filter_logprobs(
+            original_log_probs_list, filter_logprob_indices
+        )
+    else:
+        filtered_log_probs_list = original_log_probs_list
 
-        label_index_list = []
-        for sample in samples_b:
+    label_index_list = []
+    for sample in samples_b:
+        if cache is not None:
+            obj_label_id = cache.get_id(model, sample["obj_label"])
+        else:
             obj_label_id = model.get_id(sample["obj_label"])
 
-            # MAKE SURE THAT obj_label IS IN VOCABULARIES
-            if obj_label_id is None:
-                raise ValueError(
-                    "object label {} not in model vocabulary".format(
-                        sample["obj_label"]
-                    )
+        # MAKE SURE THAT obj_label IS IN VOCABULARIES
+        if obj_label_id is None:
+            raise ValueError(
+                "object label {} not in model vocabulary".format(
+                    sample["obj_label"]
                 )
-            elif model.vocab[obj_label_id[0]] != sample["obj_label"]:
-                raise ValueError(
-                    "object label {} not in model vocabulary".format(
-                        sample["obj_label"]
-                    )
+            )
+        elif model.vocab[obj_label_id[0]] != sample["obj_label"]:
+            raise ValueError(
+                "object label {} not in model vocabulary".format(
+                    sample["obj_label"]
                 )
-            elif vocab_subset is not None and sample["obj_label"] not in vocab_subset:
-                raise ValueError(
-                    "object label {} not in vocab subset".format(sample["obj_label"])
+            )
+        elif vocab_subset is not None and sample["obj_label"] not in vocab_subset:
+            raise ValueError(
+                "object label {} not in vocab subset".format(sample["obj_label"])
+            )
+
+        label_index_list.append(obj_label_id)
+
+    arguments = [
+        {
+            "original_log_probs": original_log_probs,
+            "filtered_log_probs": filtered_log_probs,
+            "token_ids": token_ids,
+            "vocab": model.vocab,
+            "label_index": label_index[0],
+            "masked_indices": masked_indices,
+            "interactive": args.interactive,
+            "index_list": index_list,
+            "sample": sample,
+        }
+        for original_log_probs, filtered_log_probs, token_ids, masked_indices, label_index, sample in zip(
+            original_log_probs_list,
+            filtered_log_probs_list,
+            token_ids_list,
+            masked_indices_list,
+            label_index_list,
+            samples_b,
+        )
+    ]
+    # single thread for debug
+    # for isx,a in enumerate(arguments):
+    #     print(samples_b[isx])
+    #     run_thread(a)
+
+    # multithread
+    res = pool.map(run_thread, arguments)
+
+    res_negated = [None] * len(res)
+    if sentences_b_negated is not None:
+        # if no negated sentences in batch
+        if all(s[0] == "" for s in sentences_b_negated):
+            res_negated = [(float("nan"), float("nan"), "")] * len(res)
+        # eval negated batch
+        else:
+            (
+                original_log_probs_list_negated,
+                token_ids_list_negated,
+                masked_indices_list_negated,
+            ) = model.get_batch_generation(sentences_b_negated, logger=logger)
+            if vocab_subset is not None:
+                # filter log_probs
+                filtered_log_probs_list_negated = model.filter_logprobs(
+                    original_log_probs_list_negated, filter_logprob_indices
+                )
+            else:
+                filtered_log_probs_list_negated = original_log_probs_list_negated
+
+            arguments = [
+                {
+                    "log_probs": filtered_log_probs,
+                    "log_probs_negated": filtered_log_probs_negated,
+                    "token_ids": token_ids,
+                    "vocab": model.vocab,
+                    "label_index": label_index[0],
+                    "masked_indices": masked_indices,
+                    "masked_indices_negated": masked_indices_negated,
+                    "index_list": index_list,
+                }
+                for filtered_log_probs, filtered_log_probs_negated, token_ids, masked_indices, masked_indices_negated, label_index in zip(
+                    filtered_log_probs_list,
+                    filtered_log_probs_list_negated,
+                    token_ids_list,
+                    masked_indices_list,
+                    masked_indices_list_negated,
+                    label_index_list,
                 )
+            ]
+            res_negated = pool.map(run_thread_negated, arguments)
+
+    results = []
+    for idx, result in enumerate(res):
+
+        result_masked_topk, sample_MRR, sample_P, sample_perplexity, msg = result
+
+        sample = samples_b[idx]
+
+        element = {}
+        element["sample"] = sample
+        element["uuid"] = sample["uuid"]
+        element["token_ids"] = token_ids_list[idx]
+        element["masked_indices"] = masked_indices_list[idx]
+        element["label_index"] = label_index_list[idx]
+        element["masked_topk"] = result_masked_topk
+        element["sample_MRR"] = sample_MRR
+        element["sample_Precision"] = sample_P
+        element["sample_perplexity"] = sample_perplexity
+        element["sample_Precision1"] = result_masked_topk["P_AT_1"]
+        # log-probs over the whole vocabulary at the first masked position
+        element["masked_log_probs"] = original_log_probs_list[idx][
+            masked_indices_list[idx][0]
+        ]
 
-            label_index_list.append(obj_label_id)
+        results.append((element, msg, res_negated[idx]))
 
-        arguments = [
-            {
-                "original_log_probs": original_log_probs,
-                "filtered_log_probs": filtered_log_probs,
-                "token_ids": token_ids,
-                "vocab": model.vocab,
-                "label_index": label_index[0],
-                "masked_indices": masked_indices,
-                "interactive": args.interactive,
-                "index_list": index_list,
-                "sample": sample,
-            }
-            for original_log_probs, filtered_log_probs, token_ids, masked_indices, label_index, sample in zip(
-                original_log_probs_list,
-                filtered_log_probs_list,
-                token_ids_list,
-                masked_indices_list,
-                label_index_list,
-                samples_b,
+    return results
+
+
+def get_thread_pool(args):
+    num_threads = args.threads
+    if num_threads <= 0:
+        # use all available threads
+        num_threads = multiprocessing.cpu_count()
+    return ThreadPool(num_threads)
+
+
+def log_sample(logger, element, msg, negated_result=None):
+    """Log the result of a sample: the message of run_thread in the text log,
+    the main fields of the element in the jsonl log. The message is only
+    formatted by the handlers that write it."""
+    sample = element["sample"]
+    data = {
+        "uuid": element["uuid"],
+        "relation": sample.get("relation_id"),
+        "sub_label": sample["sub_label"],
+        "obj_label": sample["obj_label"],
+        "MRR": element["sample_MRR"],
+        "Precision": element["sample_Precision"],
+        "Precision1": element["sample_Precision1"],
+        "top1": element["masked_topk"]["topk"][0]["token_word_form"],
+    }
+    if negated_result is not None:
+        data["overlap"], data["spearman"] = negated_result[0], negated_result[1]
+    logger.info("\n%s\n", msg, extra={"event": "sample", "data": data})
+
+
+def evaluate_samples(
+    model,
+    all_samples,
+    args,
+    logger,
+    relation_metrics,
+    num_samples,
+    vocab_subset=None,
+    filter_logprob_indices=None,
+    index_list=None,
+    cache=None,
+    checkpoint=None,
+    stores=(),
+):
+    """Evaluate all_samples in batches and add the results to
+    relation_metrics[sample["relation_id"]].
+
+    If a checkpoint is given, the metrics are saved every checkpoint.interval
+    batches and at the end, and a resumed evaluation restarts after the last
+    completed batch. The results of each sample are appended to the stores
+    (see get_result_stores).
+    """
+    samples_batches, sentences_batches, ret_msg = batchify(all_samples, args.batch_size)
+    logger.info("\n" + ret_msg + "\n")
+    if args.use_negated_probes:
+        sentences_batches_negated, ret_msg = batchify_negated(
+            all_samples, args.batch_size
+        )
+        logger.info("\n" + ret_msg + "\n")
+
+    start_batch = 0
+    num_stored_samples = [0] * len(stores)
+    if checkpoint is not None:
+        start_batch = checkpoint.restore(relation_metrics, len(samples_batches))
+        if start_batch > 0:
+            logger.info(
+                "resuming from batch {}/{}".format(start_batch, len(samples_batches))
             )
-        ]
-        # single thread for debug
-        # for isx,a in enumerate(arguments):
-        #     print(samples_b[isx])
-        #     run_thread(a)
+            num_stored_samples = checkpoint.state["num_stored_samples"] or num_stored_samples
+    for store, num_stored in zip(stores, num_stored_samples):
+        # drop the samples of the batches after the checkpoint
+        store.truncate(num_stored)
+
+    # counts the inputs truncated by the connector from here
+    model.pop_truncation_stats()
 
-        # multithread
-        # print('ARGUMENTS:', len(arguments))
-        res = pool.map(run_thread, arguments)
-        # print('RES LEN:', len(res))
+    # ThreadPool
+    pool = get_thread_pool(args)
+
+    # per-sample log records are sampled with a private generator, the global
+    # one is left untouched
+    log_sample_rate = getattr(args, "log_sample_rate", 1.0)
+    log_sampler = random.Random(start_batch)
 
+    for i in tqdm(range(start_batch, len(samples_batches))):
+
+        sentences_b_negated = None
         if args.use_negated_probes:
             sentences_b_negated = sentences_batches_negated[i]
 
-            # if no negated sentences in batch
-            if all(s[0] == "" for s in sentences_b_negated):
-                res_negated = [(float("nan"), float("nan"), "")] * args.batch_size
-            # eval negated batch
-            else:
-                (
-                    original_log_probs_list_negated,
-                    token_ids_list_negated,
-                    masked_indices_list_negated,
-                ) = model.get_batch_generation(sentences_b_negated, logger=logger)
-                if vocab_subset is not None:
-                    # filter log_probs
-                    filtered_log_probs_list_negated = model.filter_logprobs(
-                        original_log_probs_list_negated, filter_logprob_indices
-                    )
-                else:
-                    filtered_log_probs_list_negated = original_log_probs_list_negated
-
-                arguments = [
-                    {
-                        "log_probs": filtered_log_probs,
-                        "log_probs_negated": filtered_log_probs_negated,
-                        "token_ids": token_ids,
-                        "vocab": model.vocab,
-                        "label_index": label_index[0],
-                        "masked_indices": masked_indices,
-                        "masked_indices_negated": masked_indices_negated,
-                        "index_list": index_list,
-                    }
-                    for filtered_log_probs, filtered_log_probs_negated, token_ids, masked_indices, masked_indices_negated, label_index in zip(
-                        filtered_log_probs_list,
-                        filtered_log_probs_list_negated,
-                        token_ids_list,
-                        masked_indices_list,
-                        masked_indices_list_negated,
-                        label_index_list,
-                    )
-                ]
-                res_negated = pool.map(run_thread_negated, arguments)
-
-        for idx, result in enumerate(res):
-
-            result_masked_topk, sample_MRR, sample_P, sample_perplexity, msg = result
-
-            logger.info("\n" + msg + "\n")
-
-            sample = samples_b[idx]
-
-            element = {}
-            element["sample"] = sample
-            element["uuid"] = sample["uuid"]
-            element["token_ids"] = token_ids_list[idx]
-            element["masked_indices"] = masked_indices_list[idx]
-            element["label_index"] = label_index_list[idx]
-            element["masked_topk"] = result_masked_topk
-            element["sample_MRR"] = sample_MRR
-            element["sample_Precision"] = sample_P
-            element["sample_perplexity"] = sample_perplexity
-            element["sample_Precision1"] = result_masked_topk["P_AT_1"]
-
-            # print()
-            # print("idx: {}".format(idx))
-            # # print("masked_entity: {}".format(result_masked_topk['masked_entity']))
-            # for yi in range(10):
-            #     print("\t{} {}".format(yi,result_masked_topk['topk'][yi]))
-            # print("masked_indices_list: {}".format(masked_indices_list[idx]))
-            # print("sample_MRR: {}".format(sample_MRR))
-            # print("sample_P: {}".format(sample_P))
-            # print("sample: {}".format(sample))
-            # print()
+        batch_start = time.time()
+        batch_results = evaluate_batch(
+            model,
+            samples_batches[i],
+            sentences_batches[i],
+            args,
+            pool,
+            logger,
+            vocab_subset=vocab_subset,
+            filter_logprob_indices=filter_logprob_indices,
+            index_list=index_list,
+            sentences_b_negated=sentences_b_negated,
+            cache=cache,
+        )
 
-            if use_ctx:
-                # More like fact tuple
-                rel_pair = (sample['sub_label'], sample['obj_label'])
-                # Give model a point if it's prediction is the same as the canonical form of the object
-                fact_map[rel_pair].append(int(element["sample_Precision1"]))
-                # Also give model a point if it's predictiction equals the surface form of the object
-                top_pred_token = result_masked_topk['topk'][0]['token_word_form']
-                fact_map[rel_pair].append(int(top_pred_token.lower() == sample['obj_surface'].lower()))
+        batch_time = time.time() - batch_start
+
+        for element, msg, negated_result in batch_results:
+
+            if log_sample_rate >= 1.0 or log_sampler.random() < log_sample_rate:
+                log_sample(logger, element, msg, negated_result)
+
+            rel_id = element["sample"]["relation_id"]
+            relation_metrics[rel_id].add(element, negated_result)
 
-            if args.use_negated_probes:
-                overlap, spearman, msg = res_negated[idx]
-                # sum overlap and spearmanr if not nan
-                if spearman == spearman:
-                    element["spearmanr"] = spearman
-                    element["overlap"] = overlap
-                    Overlap += overlap
-                    Spearman += spearman
-                    num_valid_negation += 1.0
-                    
             ############################################ MACRO-AVERAGED ACCURACY ############################################
             """
+            sample = element['sample']
             probe_type = 'uncond'
             model_name = 'bert'
             experiment_name = 'rand_X5Y_cand10_custom'
@@ -755,106 +1280,329 @@ def main(args, rel_id, shuffle_data=True, model=None, use_ctx=False, synthetic=F
             """
             #################################################################################################################
 
-            MRR += sample_MRR
-            Precision += sample_P
-            Precision1 += element["sample_Precision1"]
-
-            # the judgment of the annotators recording whether they are
-            # evidence in the sentence that indicates a relation between two entities.
-            num_yes = 0
-            num_no = 0
+        logger.info(
+            "batch %d/%d: %d samples in %.3fs",
+            i + 1,
+            len(samples_batches),
+            len(batch_results),
+            batch_time,
+            extra={
+                "event": "batch",
+                "data": {
+                    "batch": i,
+                    "num_batches": len(samples_batches),
+                    "num_samples": len(batch_results),
+                    "batch_time": batch_time,
+                    "relations": sorted(
+                        set(str(e["sample"]["relation_id"]) for e, _, _ in batch_results)
+                    ),
+                    "MRR": sum(e["sample_MRR"] for e, _, _ in batch_results),
+                    "Precision": sum(e["sample_Precision"] for e, _, _ in batch_results),
+                    "Precision1": sum(e["sample_Precision1"] for e, _, _ in batch_results),
+                },
+            },
+        )
 
-            if "judgments" in sample:
-                # only for Google-RE
-                for x in sample["judgments"]:
-                    if x["judgment"] == "yes":
-                        num_yes += 1
-                    else:
-                        num_no += 1
-                if num_no >= num_yes:
-                    samples_with_negative_judgement += 1
-                    element["judgement"] = "negative"
-                    MRR_negative += sample_MRR
-                    Precision_negative += sample_P
-                else:
-                    samples_with_positive_judgement += 1
-                    element["judgement"] = "positive"
-                    MRR_positive += sample_MRR
-                    Precision_positivie += sample_P
+        for store in stores:
+            store.append(
+                [element for element, _, _ in batch_results],
+                negated_results=[negated_result for _, _, negated_result in batch_results],
+            )
 
-            # print('ELEMENT:', element)
-            # list_of_results.append(element)
-            num_results += 1
+        if (
+            checkpoint is not None
+            and checkpoint.interval > 0
+            and (i + 1) % checkpoint.interval == 0
+        ):
+            checkpoint.save(
+                relation_metrics,
+                num_samples,
+                i + 1,
+                len(samples_batches),
+                num_stored_samples=[len(store) for store in stores],
+            )
 
     pool.close()
     pool.join()
 
-    # For CONDITIONAL probing, make evaluation fair with RE baseline by giving the model a point if it returns the correct object for ANY masked sentence of a fact
-    # print('FACT MAP:', fact_map)
-    Precision1_RE = 0
-    if use_ctx:
-        Precision1_RE_sum = 0
-        for key, val in fact_map.items():
-            score = 1 if any(x == 1 for x in val) else 0
-            Precision1_RE_sum += score
-        Precision1_RE = Precision1_RE_sum / len(fact_map)
-
-    # stats
-    # Mean reciprocal rank
-    MRR /= num_results
-
-    # Precision
-    Precision /= num_results
-    Precision1 /= num_results
-
-    msg = "all_samples: {}\n".format(len(all_samples))
-    msg += "list_of_results: {}\n".format(num_results)
-    msg += "global MRR: {}\n".format(MRR)
-    msg += "global Precision at 10: {}\n".format(Precision)
-    msg += "global Precision at 1: {}\n".format(Precision1)
-    if use_ctx:
-        msg += "total num facts: {}\n".format(len(fact_map))
-        msg += "num facts correct: {}\n".format(Precision1_RE_sum)
-        msg += "Precision at 1 (RE): {}\n".format(Precision1_RE)
+    truncation_stats = model.pop_truncation_stats()
+    if truncation_stats["truncated_inputs"] > 0:
+        logger.info(
+            "%d/%d inputs truncated around the mask, %d tokens removed",
+            truncation_stats["truncated_inputs"],
+            truncation_stats["inputs"],
+            truncation_stats["removed_tokens"],
+            extra={"event": "truncation", "data": truncation_stats},
+        )
 
-    if args.use_negated_probes:
-        Overlap /= num_valid_negation
-        Spearman /= num_valid_negation
-        msg += "\n"
-        msg += "results negation:\n"
-        msg += "all_negated_samples: {}\n".format(int(num_valid_negation))
-        msg += "global spearman rank affirmative/negated: {}\n".format(Spearman)
-        msg += "global overlap at 1 affirmative/negated: {}\n".format(Overlap)
-
-    if samples_with_negative_judgement > 0 and samples_with_positive_judgement > 0:
-        # Google-RE specific
-        MRR_negative /= samples_with_negative_judgement
-        MRR_positive /= samples_with_positive_judgement
-        Precision_negative /= samples_with_negative_judgement
-        Precision_positivie /= samples_with_positive_judgement
-        msg += "samples_with_negative_judgement: {}\n".format(
-            samples_with_negative_judgement
+    if checkpoint is not None:
+        checkpoint.save(
+            relation_metrics,
+            num_samples,
+            len(samples_batches),
+            len(samples_batches),
+            num_stored_samples=[len(store) for store in stores],
         )
-        msg += "samples_with_positive_judgement: {}\n".format(
-            samples_with_positive_judgement
+
+
+def main(args, rel_id, shuffle_data=True, model=None, use_ctx=False, synthetic=False, cache=None):
+    # Set random seed so randomly picking context sentences is consistent across runs
+    random.seed(0)
+
+    if len(args.models_names) > 1:
+        raise ValueError('Please specify a single language model (e.g., --lm "bert").')
+
+    msg = ""
+
+    [model_type_name] = args.models_names
+
+    model_name = get_model_name(args)
+
+    # initialize logging
+    if args.full_logdir:
+        log_directory = args.full_logdir
+    else:
+        log_directory = create_logdir_with_timestamp(args.logdir, model_name)
+    logger = init_logging(log_directory, getattr(args, "log_format", "text"))
+
+    relation_metrics = {
+        rel_id: RelationMetrics(
+            use_ctx=use_ctx, use_negated_probes=args.use_negated_probes
         )
-        msg += "MRR_negative: {}\n".format(MRR_negative)
-        msg += "MRR_positive: {}\n".format(MRR_positive)
-        msg += "Precision_negative: {}\n".format(Precision_negative)
-        msg += "Precision_positivie: {}\n".format(Precision_positivie)
+    }
+    checkpoint = get_checkpoint([args], log_directory)
+    if checkpoint is not None and checkpoint.restore_finished(relation_metrics):
+        # nothing left to evaluate: skip the model and the data
+        msg = relation_metrics[rel_id].get_message(checkpoint.num_samples(rel_id))
+        logger.info("\nresumed finished evaluation\n" + msg + "\n")
+        print("\n" + msg + "\n")
+        close_logging(logger)
+        return relation_metrics[rel_id].get_results()
+
+    print(model)
+    if model is None:
+        model = build_model_by_name(model_type_name, args, background_weights=True)
+
+    msg += "model name: {}\n".format(model_name)
+
+    # deal with vocab subset
+    vocab_subset = None
+    index_list = None
+    filter_logprob_indices = None
+    msg += "args: {}\n".format(args)
+    if args.common_vocab_filename is not None:
+        if cache is not None:
+            vocab_subset, filter_logprob_indices, index_list = cache.init_vocab_subset(
+                model, args.common_vocab_filename, logger
+            )
+        else:
+            vocab_subset, filter_logprob_indices, index_list = init_vocab_subset(
+                model, args.common_vocab_filename, logger
+            )
+        msg += "common vocabulary size: {}\n".format(len(vocab_subset))
+
+    logger.info("\n" + msg + "\n")
+
+    # dump arguments on file for log
+    with open("{}/args.json".format(log_directory), "w") as outfile:
+        json.dump(vars(args), outfile)
+
+    all_samples = build_samples(
+        args,
+        model,
+        vocab_subset,
+        logger,
+        use_ctx=use_ctx,
+        synthetic=synthetic,
+        cache=cache,
+    )
+    for sample in all_samples:
+        sample["relation_id"] = rel_id
+
+    # shuffle data
+    if shuffle_data:
+        shuffle(all_samples)
+
+    stores = get_result_stores(args, log_directory, model, {rel_id: args.template})
+    evaluate_samples(
+        model,
+        all_samples,
+        args,
+        logger,
+        relation_metrics,
+        {rel_id: len(all_samples)},
+        vocab_subset=vocab_subset,
+        filter_logprob_indices=filter_logprob_indices,
+        index_list=index_list,
+        cache=cache,
+        checkpoint=checkpoint,
+        stores=stores,
+    )
+    for store in stores:
+        store.close()
 
+    msg = relation_metrics[rel_id].get_message(len(all_samples))
     logger.info("\n" + msg + "\n")
     print("\n" + msg + "\n")
+    close_logging(logger)
+
+    return relation_metrics[rel_id].get_results()
+
+
+def main_multi_relation(
+    args_list,
+    rel_ids,
+    model=None,
+    log_directory=None,
+    shuffle_data=True,
+    use_ctx=False,
+    synthetic=False,
+    cache=None,
+):
+    """Evaluate several relations in a single stream of batches.
+
+    The samples of all relations are tagged with their relation id, merged and
+    batched together by length, so that batches are full and the per-relation
+    setup (vocab subset, filtering indices, logger) is done only once. The
+    metrics are split back per relation and are the same as the ones computed
+    by main for each relation alone.
+
+    Parameters:
+    args_list (list[Namespace]): the arguments of each relation. All of them
+                                 must use the same model, common vocabulary
+                                 and batch size
+    rel_ids (list[string]): the relation ids, aligned with args_list
+    cache (EvaluationCache): optional cache shared with other evaluations
+
+    Returns:
+    relation_metrics (dict[string, RelationMetrics]): the metrics of each
+                                                      relation
+    """
+    if len(args_list) != len(rel_ids):
+        raise ValueError("args_list and rel_ids should have the same length")
+    if not args_list:
+        return {}
+
+    args = args_list[0]
+    for relation_args in args_list[1:]:
+        for key in ["models_names", "common_vocab_filename", "batch_size", "use_negated_probes"]:
+            if getattr(relation_args, key) != getattr(args, key):
+                raise ValueError(
+                    "all relations should have the same {} in multi-relation mode".format(key)
+                )
+
+    if len(args.models_names) > 1:
+        raise ValueError('Please specify a single language model (e.g., --lm "bert").')
+
+    [model_type_name] = args.models_names
+
+    model_name = get_model_name(args)
+
+    # initialize logging
+    if log_directory is None:
+        log_directory = create_logdir_with_timestamp(args.logdir, model_name)
+    logger = init_logging(log_directory, getattr(args, "log_format", "text"))
+
+    relation_metrics = {}
+    for rel_id, relation_args in zip(rel_ids, args_list):
+        relation_metrics[rel_id] = RelationMetrics(
+            use_ctx=use_ctx, use_negated_probes=relation_args.use_negated_probes
+        )
+
+    checkpoint = get_checkpoint(args_list, log_directory)
+    if checkpoint is not None and checkpoint.restore_finished(relation_metrics):
+        # nothing left to evaluate: skip the model and the data
+        for rel_id in rel_ids:
+            msg = "relation: {}\n".format(rel_id)
+            msg += relation_metrics[rel_id].get_message(checkpoint.num_samples(rel_id))
+            logger.info("\nresumed finished evaluation\n" + msg + "\n")
+            print("\n" + msg + "\n")
+        close_logging(logger)
+        return relation_metrics
+
+    if model is None:
+        model = build_model_by_name(model_type_name, args, background_weights=True)
+
+    msg = "model name: {}\n".format(model_name)
+    msg += "relations: {}\n".format(rel_ids)
+
+    # deal with vocab subset
+    vocab_subset = None
+    index_list = None
+    filter_logprob_indices = None
+    if args.common_vocab_filename is not None:
+        if cache is not None:
+            vocab_subset, filter_logprob_indices, index_list = cache.init_vocab_subset(
+                model, args.common_vocab_filename, logger
+            )
+        else:
+            vocab_subset, filter_logprob_indices, index_list = init_vocab_subset(
+                model, args.common_vocab_filename, logger
+            )
+        msg += "common vocabulary size: {}\n".format(len(vocab_subset))
+
+    logger.info("\n" + msg + "\n")
+
+    # dump arguments on file for log
+    with open("{}/args.json".format(log_directory), "w") as outfile:
+        json.dump(
+            {rel_id: vars(a) for rel_id, a in zip(rel_ids, args_list)}, outfile
+        )
+
+    num_samples = {}
+    all_samples = []
+    for rel_id, relation_args in zip(rel_ids, args_list):
+        # same seed of main, so that each relation gets the same samples
+        random.seed(0)
+        relation_samples = build_samples(
+            relation_args,
+            model,
+            vocab_subset,
+            logger,
+            use_ctx=use_ctx,
+            synthetic=synthetic,
+            cache=cache,
+        )
+        for sample in relation_samples:
+            sample["relation_id"] = rel_id
+        num_samples[rel_id] = len(relation_samples)
+        all_samples.extend(relation_samples)
+
+    # shuffle data
+    if shuffle_data:
+        shuffle(all_samples)
+
+    stores = get_result_stores(
+        args,
+        log_directory,
+        model,
+        {rel_id: a.template for rel_id, a in zip(rel_ids, args_list)},
+    )
+    evaluate_samples(
+        model,
+        all_samples,
+        args,
+        logger,
+        relation_metrics,
+        num_samples,
+        vocab_subset=vocab_subset,
+        filter_logprob_indices=filter_logprob_indices,
+        index_list=index_list,
+        cache=cache,
+        checkpoint=checkpoint,
+        stores=stores,
+    )
+    for store in stores:
+        store.close()
 
-    # dump pickle with the result of the experiment
-    # TODO: uncomment pickle stuff later
-    # all_results = dict(
-    #     list_of_results=list_of_results, global_MRR=MRR, global_P_at_10=Precision
-    # )
-    # with open("{}/result.pkl".format(log_directory), "wb") as f:
-    #     pickle.dump(all_results, f)
+    for rel_id in rel_ids:
+        msg = "relation: {}\n".format(rel_id)
+        msg += relation_metrics[rel_id].get_message(num_samples[rel_id])
+        logger.info("\n" + msg + "\n")
+        print("\n" + msg + "\n")
+    close_logging(logger)
 
-    return MRR, Precision, Precision1, Precision1_RE
+    return relation_metrics
 
 
 if __name__ == "__main__":
@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""CPU latency of Bert.get_batch_generation, eager and with the
+TorchScript-traced models of --bert-jit:
+
+    python scripts/benchmark_bert_jit.py --lm bert --bmn bert-base-cased --batch-sizes 1,8,64
+
+The inputs are random words of the vocabulary with a [MASK], the same ones
+for both modes; prints the median time of a batch and the largest difference
+between the log-probs of the two modes.
+"""
+import time
+import random
+import statistics
+import torch
+import lama.options as options
+from lama.modules import build_model_by_name
+from lama.modules.base_connector import MASK, SPECIAL_SYMBOLS
+
+
+def random_sentences(vocab, num_sentences, num_words, seed=0):
+    """num_words words of the vocabulary (one token each) with a [MASK]."""
+    rng = random.Random(seed)
+    words = [word for word in vocab if word.isalnum() and word not in SPECIAL_SYMBOLS]
+    sentences = []
+    for _ in range(num_sentences):
+        sentence = [rng.choice(words) for _ in range(num_words)]
+        sentence[rng.randrange(num_words)] = MASK
+        sentences.append([" ".join(sentence) + " ."])
+    return sentences
+
+
+def generate(model, batch, jit):
+    model.jit = jit
+    start = time.perf_counter()
+    log_probs, _, _ = model.get_batch_generation(batch, try_cuda=False)
+    return log_probs, time.perf_counter() - start
+
+
+def main(args):
+    batch_sizes = [int(x) for x in args.batch_sizes.split(",")]
+    model = build_model_by_name("bert", args)
+    sentences = random_sentences(model.vocab, args.repeats * max(batch_sizes), args.num_words)
+
+    print("{:>10} {:>12} {:>12} {:>10} {:>14}".format(
+        "batch size", "eager ms", "traced ms", "speedup", "max |delta|"))
+    for batch_size in batch_sizes:
+        batches = [sentences[i * batch_size:(i + 1) * batch_size] for i in range(args.repeats)]
+        # not timed: traces the models (and warms up both modes)
+        for batch in batches:
+            generate(model, batch, jit=True)
+        generate(model, batches[0], jit=False)
+        # the two modes alternate, so that they see the same machine load
+        eager_times, traced_times = [], []
+        max_delta = 0.0
+        for batch in batches:
+            eager_log_probs, eager_time = generate(model, batch, jit=False)
+            traced_log_probs, traced_time = generate(model, batch, jit=True)
+            eager_times.append(eager_time)
+            traced_times.append(traced_time)
+            max_delta = max(max_delta, (eager_log_probs - traced_log_probs).abs().max().item())
+        eager_time = statistics.median(eager_times)
+        traced_time = statistics.median(traced_times)
+        print("{:>10} {:>12.1f} {:>12.1f} {:>9.2f}x {:>14.2e}".format(
+            batch_size, 1000 * eager_time, 1000 * traced_time, eager_time / traced_time, max_delta))
+
+
+if __name__ == '__main__':
+    parser = options.get_general_parser()
+    parser.add_argument('--batch-sizes', default='1,8,64')
+    parser.add_argument('--num-words', type=int, default=16,
+                        help='number of words of a sentence')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='number of timed batches for each batch size')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads (default: torch default)')
+    args = options.parse_args(parser)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    main(args)
@@ -0,0 +1,92 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Latency and recall of the nearest-neighbour indexes of
+lama/embedding_index.py, on the sentences of an encoded dataset or on
+synthetic clustered vectors:
+
+    python scripts/benchmark_embedding_index.py --encoded-dataset encoded_corpus
+    python scripts/benchmark_embedding_index.py --num-vectors 200000 --dim 768
+
+The queries are indexed vectors plus noise. Recall is measured against the
+exact search: 1-recall@k is the fraction of queries whose nearest neighbour
+is in the top k, k-recall@k the fraction of the exact top k that is found.
+"""
+import argparse
+import time
+import numpy as np
+from lama.embedding_index import ExactIndex, IVFPQIndex, sentence_embeddings
+
+
+def synthetic_vectors(num_vectors, dim, num_clusters, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(num_clusters, dim)
+    clusters = rng.randint(num_clusters, size=num_vectors)
+    return (centers[clusters] + 0.5 * rng.randn(num_vectors, dim)).astype(np.float32)
+
+
+def recall(ids, exact_ids):
+    k = exact_ids.shape[1]
+    nearest = np.mean([exact[0] in found for found, exact in zip(ids, exact_ids)])
+    top_k = np.mean([len(set(found) & set(exact)) / k for found, exact in zip(ids, exact_ids)])
+    return nearest, top_k
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main(args):
+    if args.encoded_dataset is not None:
+        vectors, elapsed = timed(sentence_embeddings, args.encoded_dataset)
+        print("sentence embeddings: {} x {} in {:.2f}s".format(*vectors.shape, elapsed))
+    else:
+        vectors = synthetic_vectors(args.num_vectors, args.dim, args.num_clusters)
+    rng = np.random.RandomState(1)
+    queries = vectors[rng.choice(len(vectors), args.num_queries, replace=False)]
+    queries = queries + args.noise * queries.std() * rng.randn(*queries.shape).astype(np.float32)
+
+    print("{} vectors of dim {}, {} queries, k={}, metric={}".format(
+        len(vectors), vectors.shape[1], len(queries), args.k, args.metric))
+    print("{:<24} {:>12} {:>12} {:>12}".format("index", "ms/query", "1-recall", "k-recall"))
+
+    exact = ExactIndex(vectors, metric=args.metric)
+    (_, exact_ids), elapsed = timed(exact.search, queries, args.k)
+    print("{:<24} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+        "exact", 1000 * elapsed / len(queries), 1.0, 1.0))
+
+    index = IVFPQIndex(vectors.shape[1], num_lists=args.num_lists, m=args.m, metric=args.metric)
+    train = vectors[rng.choice(len(vectors), min(len(vectors), args.train_size), replace=False)]
+    _, train_time = timed(index.train, train)
+    _, add_time = timed(index.add, vectors)
+    for nprobe in args.nprobe:
+        (_, ids), elapsed = timed(index.search, queries, args.k, nprobe=nprobe)
+        nearest, top_k = recall(ids, exact_ids)
+        print("{:<24} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+            "ivfpq nprobe={}".format(nprobe), 1000 * elapsed / len(queries), nearest, top_k))
+    print("ivfpq: train {:.2f}s, add {:.2f}s, {} bytes per vector instead of {}".format(
+        train_time, add_time, args.m, 4 * vectors.shape[1]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the embedding indexes")
+    parser.add_argument("--encoded-dataset", default=None,
+                        help="encoded dataset directory (synthetic vectors if not set)")
+    parser.add_argument("--num-vectors", type=int, default=100000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--num-clusters", type=int, default=100)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.1,
+                        help="noise added to the queries, relative to the std of the vectors")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--metric", default="cosine", choices=["ip", "cosine", "l2"])
+    parser.add_argument("--num-lists", type=int, default=256)
+    parser.add_argument("-m", type=int, default=64, help="bytes per vector")
+    parser.add_argument("--train-size", type=int, default=50000)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    main(parser.parse_args())
@@ -0,0 +1,94 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Latency of lama/probe_server.py under concurrent clients, on localhost:
+
+    python scripts/benchmark_probe_server.py --lm bert --bmn bert-base-cased \\
+        --concurrency 16 --max-batch-sizes 1,8,32
+
+The model is loaded once; for each maximum batch size, a server is started on
+a free port and --requests probes (random words of the vocabulary with a
+[MASK]) are sent by --concurrency clients. Prints the p50/p99 latency of a
+request, the throughput and the mean size of the micro-batches (a maximum
+batch size of 1 is the one-probe-per-forward baseline).
+"""
+import json
+import threading
+import time
+import urllib.request
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import torch
+import lama.options as options
+from lama.modules import build_model_by_name
+from lama.probe_server import ProbeServer
+from benchmark_bert_jit import random_sentences
+
+
+def probe(url, sentences):
+    """Time of a request."""
+    request = urllib.request.Request(url, data=json.dumps({"sentences": sentences}).encode("utf-8"))
+    start = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        json.loads(response.read().decode("utf-8"))
+    return time.perf_counter() - start
+
+
+def run(model_name, model, probes, max_batch_size, args):
+    server = ProbeServer(
+        ("localhost", 0), {model_name: model},
+        max_batch_size=max_batch_size, max_wait=args.max_wait_ms / 1000.0, topk=args.topk,
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = "http://localhost:{}/probe".format(server.server_address[1])
+    try:
+        # not timed: warm-up
+        probe(url, probes[0])
+        batcher = server.batchers[model_name]
+        num_batches, num_requests = batcher.num_batches, batcher.num_requests
+        start = time.perf_counter()
+        with ThreadPool(args.concurrency) as pool:
+            latencies = pool.map(lambda sentences: probe(url, sentences), probes, chunksize=1)
+        elapsed = time.perf_counter() - start
+        mean_batch_size = (batcher.num_requests - num_requests) / max(batcher.num_batches - num_batches, 1)
+    finally:
+        server.close()
+    return latencies, elapsed, mean_batch_size
+
+
+def main(args):
+    max_batch_sizes = [int(x) for x in args.max_batch_sizes.split(",")]
+    [model_name] = args.models_names
+    model = build_model_by_name(model_name, args)
+    probes = random_sentences(model.vocab, args.requests, args.num_words)
+
+    print("{} requests, {} concurrent clients, max wait {} ms".format(
+        args.requests, args.concurrency, args.max_wait_ms))
+    print("{:>10} {:>10} {:>10} {:>12} {:>11}".format(
+        "max batch", "p50 ms", "p99 ms", "requests/s", "mean batch"))
+    for max_batch_size in max_batch_sizes:
+        latencies, elapsed, mean_batch_size = run(model_name, model, probes, max_batch_size, args)
+        p50, p99 = np.percentile(latencies, [50, 99])
+        print("{:>10} {:>10.1f} {:>10.1f} {:>12.1f} {:>11.1f}".format(
+            max_batch_size, 1000 * p50, 1000 * p99, len(probes) / elapsed, mean_batch_size))
+
+
+if __name__ == '__main__':
+    parser = options.get_probe_server_parser()
+    parser.add_argument('--max-batch-sizes', default='1,8,32',
+                        help='maximum batch sizes of the server to compare')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='number of clients sending requests at the same time')
+    parser.add_argument('--num-words', type=int, default=12,
+                        help='number of words of a probe')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads (default: torch default)')
+    args = options.parse_args(parser)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    main(args)
@@ -0,0 +1,98 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Accuracy drift and throughput of the dynamic int8 quantization of a model
+(--quantize), to choose the mode of an experiment:
+
+    python scripts/benchmark_quantization.py --lm bert --bmn bert-large-cased \\
+        --cvf pre-trained_language_models/common_vocab_cased.txt \\
+        --relations data/relations.jsonl --data-path-pre data/TREx
+
+The relations are evaluated with the float and with the quantized model (as in
+run_experiments.py, in a single stream of batches); prints the P@1 of each
+relation in both modes with their difference, and the throughput of each mode.
+"""
+import os
+import time
+import argparse
+import tempfile
+import statistics
+import lama.options as options
+from lama.modules import build_model_by_name
+from batch_eval_KB_completion import load_file
+from run_experiments import get_relation_parameters, evaluate_relations
+
+
+def evaluate(args, relations, quantize, log_directory):
+    """Returns relation id -> (P@1, number of samples) and the evaluation
+    time (the model loading excluded)."""
+    input_param = dict(vars(args), label="quantize" if quantize else "float", quantize=quantize)
+    relations_to_evaluate = []
+    for relation in relations:
+        PARAMETERS = get_relation_parameters(relation, args.data_path_pre, args.split, input_param)
+        PARAMETERS["full_logdir"] = os.path.join(log_directory, relation["relation"])
+        PARAMETERS["checkpoint_interval"] = 0
+        relations_to_evaluate.append((relation, argparse.Namespace(**PARAMETERS)))
+
+    [model_type_name] = args.models_names
+    model = build_model_by_name(model_type_name, relations_to_evaluate[0][1])
+    start = time.perf_counter()
+    results = evaluate_relations(model, relations_to_evaluate, True, log_directory)
+    elapsed = time.perf_counter() - start
+    return {
+        rel_id: (metrics[2], num_samples)
+        for rel_id, (metrics, num_samples) in results.items()
+    }, elapsed
+
+
+def main(args):
+    relations = [
+        relation
+        for relation in load_file(args.relations)
+        if os.path.isfile(os.path.join(args.data_path_pre, relation["relation"], args.split))
+    ][: args.max_relations]
+    if not relations:
+        raise ValueError("no relation with a {} file in {}".format(args.split, args.data_path_pre))
+
+    log_directory = tempfile.mkdtemp(prefix="benchmark_quantization_")
+    results = {}
+    elapsed = {}
+    for quantize in [False, True]:
+        results[quantize], elapsed[quantize] = evaluate(
+            args, relations, quantize, os.path.join(log_directory, str(quantize))
+        )
+
+    print("{:<12} {:>8} {:>10} {:>10} {:>10}".format("relation", "samples", "P@1 float", "P@1 int8", "delta"))
+    deltas = []
+    for relation in relations:
+        rel_id = relation["relation"]
+        (p1_float, num_samples), (p1_int8, _) = results[False][rel_id], results[True][rel_id]
+        deltas.append(p1_int8 - p1_float)
+        print("{:<12} {:>8} {:>10.2f} {:>10.2f} {:>+10.2f}".format(
+            rel_id, num_samples, 100 * p1_float, 100 * p1_int8, 100 * deltas[-1]))
+    print("mean P@1 delta: {:+.2f}, max |delta|: {:.2f}".format(
+        100 * statistics.mean(deltas), 100 * max(abs(d) for d in deltas)))
+
+    num_samples = sum(n for _, n in results[False].values())
+    for quantize in [False, True]:
+        print("{}: {} samples in {:.1f}s, {:.1f} samples/s".format(
+            "int8" if quantize else "float", num_samples, elapsed[quantize],
+            num_samples / elapsed[quantize]))
+    print("speedup: {:.2f}x".format(elapsed[False] / elapsed[True]))
+
+
+if __name__ == '__main__':
+    parser = options.get_general_parser()
+    parser.add_argument('--relations', default='data/relations.jsonl',
+                        help='jsonl file of the relations to evaluate')
+    parser.add_argument('--data-path-pre', default='data/TREx',
+                        help='directory of the relations (one subdirectory each)')
+    parser.add_argument('--split', default='test.jsonl',
+                        help='file of the samples in the directory of each relation')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--max-relations', type=int, default=None)
+    args = options.parse_args(parser)
+    main(args)
@@ -0,0 +1,134 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+"""Recompute the metrics of an evaluation from its score stores (written with
+--save-scores, see lama/score_store.py) without running the model again, e.g.
+with another common vocabulary or with macro-averaging over objects:
+
+    python scripts/rescore.py output/results/bert_base/*/scores_test.bin \
+        --common-vocab-filename pre-trained_language_models/common_vocab_cased.txt \
+        --aggregation macro
+"""
+import argparse
+from collections import defaultdict
+import numpy as np
+from lama.score_store import load_scores, get_ranks
+from lama.utils import load_vocab
+
+# topk of get_ranking in batch_eval_KB_completion: labels ranked lower get MRR 0
+MAX_RANK = 10000
+
+
+def get_vocab_mask(vocab, common_vocab_filename=None):
+    """Returns a boolean array over the model vocabulary, True for the words of
+    the common vocabulary (all of them if common_vocab_filename is None)."""
+    if common_vocab_filename is None:
+        return np.ones(len(vocab), dtype=bool)
+    vocab_subset = set(load_vocab(common_vocab_filename))
+    return np.array([word in vocab_subset for word in vocab], dtype=bool)
+
+
+def aggregate(values, objects, aggregation="micro"):
+    """Micro: mean over the samples. Macro: mean over the objects of the mean
+    over the samples of each object (as in macro_avg_acc.py)."""
+    if len(values) == 0:
+        return 0.0
+    if aggregation == "micro":
+        return float(np.mean(values))
+    object_values = defaultdict(list)
+    for value, obj in zip(values, objects):
+        object_values[obj].append(value)
+    return float(np.mean([np.mean(v) for v in object_values.values()]))
+
+
+def rescore(filename, vocab_mask_cache, common_vocab_filename=None, aggregation="micro", P_AT=10):
+    """Returns a dictionary relation -> metrics of a score store."""
+    header, records = load_scores(filename)
+    vocab = header["vocab"]
+    key = (tuple(vocab), common_vocab_filename)
+    if key not in vocab_mask_cache:
+        vocab_mask_cache[key] = get_vocab_mask(vocab, common_vocab_filename)
+    vocab_mask = vocab_mask_cache[key]
+
+    # samples whose object is not in the vocab subset are filtered out, as
+    # filter_samples does in batch_eval_KB_completion
+    valid = vocab_mask[records["label_id"]]
+    records = records[valid]
+    ranks, exact = get_ranks(header, records, vocab_mask)
+    objects = [vocab[i] for i in records["label_id"]]
+
+    MRR = np.where(ranks <= MAX_RANK, 1.0 / ranks, 0.0)
+    Precision = (ranks <= P_AT).astype(float)
+    Precision1 = (ranks == 1).astype(float)
+
+    results = {}
+    relations = records["relation"]
+    for relation in sorted(set(relations.tolist())):
+        idx = np.nonzero(relations == relation)[0]
+        rel_objects = [objects[i] for i in idx]
+        results[relation.decode("utf-8")] = {
+            "template": header["templates"].get(relation.decode("utf-8"), ""),
+            "num_samples": len(idx),
+            "num_inexact": int((~exact[idx]).sum()),
+            "mrr": aggregate(MRR[idx], rel_objects, aggregation),
+            "p10": aggregate(Precision[idx], rel_objects, aggregation),
+            "p1": aggregate(Precision1[idx], rel_objects, aggregation),
+        }
+    return results
+
+
+def main(args):
+    vocab_mask_cache = {}
+    all_results = []
+    print("{:<50s} {:<10s} {:>8s} {:>8s} {:>8s} {:>8s} {:>8s}".format(
+        "scores", "relation", "samples", "inexact", "MRR", "P@{}".format(args.P_AT), "P@1"))
+    for filename in args.score_files:
+        results = rescore(
+            filename,
+            vocab_mask_cache,
+            common_vocab_filename=args.common_vocab_filename,
+            aggregation=args.aggregation,
+            P_AT=args.P_AT,
+        )
+        for relation, r in results.items():
+            all_results.append(r)
+            print("{:<50s} {:<10s} {:>8d} {:>8d} {:>8.2f} {:>8.2f} {:>8.2f}".format(
+                filename[-50:], relation, r["num_samples"], r["num_inexact"],
+                r["mrr"] * 100.0, r["p10"] * 100.0, r["p1"] * 100.0))
+    if all_results:
+        print("{} relations ({} aggregation) - mean MRR: {:.2f} mean P@{}: {:.2f} mean P@1: {:.2f}".format(
+            len(all_results),
+            args.aggregation,
+            np.mean([r["mrr"] for r in all_results]) * 100.0,
+            args.P_AT,
+            np.mean([r["p10"] for r in all_results]) * 100.0,
+            np.mean([r["p1"] for r in all_results]) * 100.0,
+        ))
+    return all_results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recompute MRR/P@k/P@1 from the scores saved with --save-scores"
+    )
+    parser.add_argument("score_files", nargs="+", help="scores_<split>.bin files")
+    parser.add_argument(
+        "--common-vocab-filename",
+        "--cvf",
+        dest="common_vocab_filename",
+        default=None,
+        help="rank the predictions only among the words of this vocabulary",
+    )
+    parser.add_argument(
+        "--aggregation",
+        choices=["micro", "macro"],
+        default="micro",
+        help="micro: mean over samples, macro: mean over objects (per relation)",
+    )
+    parser.add_argument(
+        "--P-at", dest="P_AT", type=int, default=10, help="k of the precision at k"
+    )
+    main(parser.parse_args())
@@ -6,8 +6,13 @@
 #
 import argparse
 from batch_eval_KB_completion import main as run_evaluation
+from batch_eval_KB_completion import main_multi_relation as run_multi_relation_evaluation
 from batch_eval_KB_completion import load_file
+from batch_eval_KB_completion import EvaluationCache
+from batch_eval_KB_completion import get_evaluation_fingerprint
+from batch_eval_KB_completion import load_finished_results
 from lama.modules import build_model_by_name
+from lama.task_queue import TaskQueue
 import pprint
 import statistics
 from os import listdir
@@ -17,6 +22,10 @@ from shutil import copyfile
 from collections import defaultdict
 from operator import itemgetter
 import random
+import json
+import time
+import multiprocessing
+import csv
 import numpy as np
 
 # [CONFIGURABLE]: uncomment BERT settings if you want to evaluate with BERT and vice versa with RoBERTa
@@ -38,6 +47,331 @@ LMs = [
     }
 ]
 
+def get_relation_parameters(
+    relation, data_path_pre, data_path_post, input_param, use_negated_probes=False
+):
+    PARAMETERS = {
+        # Google RE and TREx
+        "dataset_filename": "{}/{}/{}".format(
+            data_path_pre, relation["relation"], data_path_post
+        ),
+        "common_vocab_filename": "pre-trained_language_models/common_vocab_cased_rob.txt", # [CONFIGURABLE]: BERT -> common_vocab_cased.txt,  BERT + RoBERTa -> common_vocab_cased_rob.txt
+        "template": "",
+        "bert_vocab_name": "vocab.txt",
+        "batch_size": 64, # [CONFIGURABLE]: 64 for Fact Retrieval and 32 for Relation Extraction (on a NVIDIA GeForce GTX 1080ti)
+        "logdir": "output",
+        "full_logdir": "output/results/{}/{}".format(
+            input_param["label"], relation["relation"]
+        ),
+        "lowercase": False,
+        "max_sentence_length": 50, # used to be 100
+        "max_context_tokens": None, # [CONFIGURABLE]: e.g. 128 to truncate the context of Relation Extraction around the mask
+        "threads": -1,
+        "interactive": False,
+        "use_negated_probes": use_negated_probes,
+        "use_ctx": False, # [CONFIGURABLE]: Toggle for Relation Extraction
+        "synthetic": False, # [CONFIGURABLE]: Toggle for perturbed sentence evaluation for Relation Extraction
+        "checkpoint_interval": 100, # save the metrics every N batches (0 to disable)
+        "save_samples": False, # [CONFIGURABLE]: write the per-sample results (see lama/sample_store.py)
+        "samples_topk": 10,
+        "save_scores": False, # [CONFIGURABLE]: write the masked-position scores (see scripts/rescore.py)
+        "scores_topn": 1000, # 0 to save the scores of the whole vocabulary
+        "log_format": "text", # [CONFIGURABLE]: "jsonl" for structured batch/sample records in events.jsonl
+        "log_sample_rate": 1.0, # fraction of the samples with a log record
+        "resume": False
+    }
+
+    if "template" in relation:
+        PARAMETERS["template"] = relation["template"]
+        if use_negated_probes:
+            PARAMETERS["template_negated"] = relation["template_negated"]
+
+    PARAMETERS.update(input_param)
+    return PARAMETERS
+
+
+def init_relation_metrics(metrics, relation_id):
+    # This is for easy recording of metrics across train, dev, test sets for each relation
+    if relation_id not in metrics:
+        metrics[relation_id] = {
+            'train': {
+                'mrr': 0,
+                'p10': 0,
+                'p1': 0
+            },
+            'dev': {
+                'mrr': 0,
+                'p10': 0,
+                'p1': 0
+            },
+            'test': {
+                'mrr': 0,
+                'p10': 0,
+                'p1': 0
+            }
+        }
+
+
+def get_relation_groups(relations_to_evaluate, multi_relation, log_directory):
+    """Returns the (relations, log directory) evaluated together: all the
+    relations in log_directory if multi_relation is True, otherwise each
+    relation alone in its args.full_logdir."""
+    if multi_relation:
+        return [(relations_to_evaluate, log_directory)]
+    return [([(relation, args)], args.full_logdir) for relation, args in relations_to_evaluate]
+
+
+def split_finished_relations(relations_to_evaluate, multi_relation, log_directory):
+    """Look for the relations already evaluated by a previous run (with
+    args.resume set), to skip them without loading the model.
+
+    Returns:
+    results (dict): the results of the finished relations (see
+                    evaluate_relations)
+    remaining (list): the (relation, args) pairs still to evaluate
+    """
+    results = {}
+    remaining = []
+    for group, group_log_directory in get_relation_groups(relations_to_evaluate, multi_relation, log_directory):
+        args = group[0][1]
+        finished = None
+        if getattr(args, "resume", False):
+            finished = load_finished_results(
+                group_log_directory,
+                args.dataset_filename,
+                fingerprint=get_evaluation_fingerprint([a for _, a in group]),
+            )
+        if finished is None or set(finished) != set(r["relation"] for r, _ in group):
+            remaining.extend(group)
+            continue
+        for rel_id, rel_metrics in finished.items():
+            print("Relation {} already evaluated.".format(rel_id))
+            results[rel_id] = (rel_metrics.get_results(), rel_metrics.num_results)
+    return results, remaining
+
+
+def evaluate_relations(model, relations_to_evaluate, multi_relation, log_directory, cache=None):
+    """Evaluate a list of (relation, args) pairs with a loaded model.
+
+    If multi_relation is True all the relations are evaluated in a single
+    stream of batches logged in log_directory, otherwise each relation is
+    evaluated alone and logged in its args.full_logdir.
+
+    Returns:
+    results (dict): relation id -> ((MRR, Precision, Precision1, Precision1_RE),
+                    number of evaluated samples)
+    """
+    results = {}
+    for group, group_log_directory in get_relation_groups(relations_to_evaluate, multi_relation, log_directory):
+        args = group[0][1]
+        relation_metrics = run_multi_relation_evaluation(
+            [a for _, a in group],
+            [r["relation"] for r, _ in group],
+            model=model,
+            log_directory=group_log_directory,
+            shuffle_data=False,
+            use_ctx=args.use_ctx,
+            synthetic=args.synthetic,
+            cache=cache,
+        )
+        for rel_id, rel_metrics in relation_metrics.items():
+            results[rel_id] = (rel_metrics.get_results(), rel_metrics.num_results)
+    return results
+
+
+def shard_relations(relations_to_evaluate, num_workers):
+    """Split the relations in num_workers shards with a similar number of
+    samples (greedy, largest relations first)."""
+    sizes = []
+    for relation, args in relations_to_evaluate:
+        with open(args.dataset_filename, "r") as f:
+            sizes.append(sum(1 for _ in f))
+    shards = [[] for _ in range(num_workers)]
+    shard_sizes = [0] * num_workers
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        w = shard_sizes.index(min(shard_sizes))
+        shards[w].append(relations_to_evaluate[i])
+        shard_sizes[w] += sizes[i]
+    return [shard for shard in shards if shard]
+
+
+# model loaded by the parent process and inherited by the forked workers
+# (see ShardedEvaluator with share_model=True)
+_shared_model = None
+# model of a worker process, loaded at its first shard and kept for the next
+# ones, with the build_model of its ShardedEvaluator
+_worker_model = None
+_worker_build_model = None
+
+
+def _init_worker(threads, build_model):
+    """Initializer of the worker processes of a ShardedEvaluator."""
+    import torch
+    global _worker_model, _worker_build_model
+
+    torch.set_num_threads(threads)
+    _worker_model = _shared_model
+    _worker_build_model = build_model
+
+
+def evaluate_shard(worker_id, relations_to_evaluate, threads, multi_relation, log_directory):
+    """Worker process: evaluate a shard of relations, with the model of the
+    worker (loaded by its first shard)."""
+    global _worker_model
+
+    for _, args in relations_to_evaluate:
+        # metrics ThreadPool of the same size of the torch thread pool
+        args.threads = threads
+
+    log_directory = "{}_worker{}".format(log_directory, worker_id)
+    results, relations_to_evaluate = split_finished_relations(
+        relations_to_evaluate, multi_relation, log_directory
+    )
+    load_time = 0.0
+    eval_time = 0.0
+    if relations_to_evaluate:
+        start = time.time()
+        if _worker_model is None:
+            [model_type_name] = relations_to_evaluate[0][1].models_names
+            _worker_model = _worker_build_model(model_type_name, relations_to_evaluate[0][1])
+        load_time = time.time() - start
+
+        start = time.time()
+        results.update(
+            evaluate_relations(_worker_model, relations_to_evaluate, multi_relation, log_directory)
+        )
+        eval_time = time.time() - start
+    num_samples = sum(n for _, n in results.values())
+    return worker_id, results, num_samples, load_time, eval_time
+
+
+def _build_model_in_background(model_type_name, args):
+    return build_model_by_name(model_type_name, args, background_weights=True)
+
+
+class ShardedEvaluator(object):
+    """A pool of num_workers processes, each one with a fixed number of torch
+    threads, that evaluates lists of relations of the same model.
+
+    The pool is started by the first call to evaluate and kept until close,
+    so that each worker loads the model once for all the lists (e.g., all
+    the cells of a model in an experiment grid).
+
+    By default each worker loads its own model. If share_model is True, the
+    model is loaded once by this process, its weights are moved to shared
+    memory and the workers are forked, so that all of them map the same
+    weights (CPU only). build_model(lm, args) builds the model (default:
+    build_model_by_name); with spawned workers it must be picklable.
+    """
+
+    def __init__(self, num_workers, threads_per_worker=None, share_model=False, build_model=None):
+        if threads_per_worker is None:
+            threads_per_worker = max(1, multiprocessing.cpu_count() // num_workers)
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.share_model = share_model
+        self.build_model = build_model
+        self._pool = None
+
+    def _start(self, args):
+        global _shared_model
+
+        build_model = self.build_model
+        if self.share_model:
+            [model_type_name] = args.models_names
+            _shared_model = (build_model or build_model_by_name)(model_type_name, args)
+            _shared_model.share_memory()
+            ctx = multiprocessing.get_context("fork")
+        else:
+            # spawn: the workers should not inherit the torch thread pools of the parent
+            ctx = multiprocessing.get_context("spawn")
+            if build_model is None:
+                build_model = _build_model_in_background
+        try:
+            self._pool = ctx.Pool(
+                self.num_workers,
+                initializer=_init_worker,
+                initargs=(self.threads_per_worker, build_model),
+            )
+        finally:
+            # the forked workers have their copy
+            _shared_model = None
+
+    def evaluate(self, relations_to_evaluate, multi_relation, log_directory):
+        """Evaluate the relations (see evaluate_relations), split among the
+        workers. Prints the throughput of each worker and returns the merged
+        results."""
+        if self._pool is None:
+            self._start(relations_to_evaluate[0][1])
+
+        shards = shard_relations(relations_to_evaluate, self.num_workers)
+        start = time.time()
+        worker_results = self._pool.starmap(
+            evaluate_shard,
+            [
+                (worker_id, shard, self.threads_per_worker, multi_relation, log_directory)
+                for worker_id, shard in enumerate(shards)
+            ],
+            chunksize=1,
+        )
+        total_time = time.time() - start
+
+        results = {}
+        total_samples = 0
+        for worker_id, shard_results, num_samples, load_time, eval_time in sorted(worker_results, key=lambda x: x[0]):
+            results.update(shard_results)
+            total_samples += num_samples
+            print(
+                "worker {}: {} relations, {} samples, load {:.1f}s, eval {:.1f}s, {:.1f} samples/sec".format(
+                    worker_id,
+                    len(shard_results),
+                    num_samples,
+                    load_time,
+                    eval_time,
+                    num_samples / max(eval_time, 1e-6),
+                )
+            )
+        print(
+            "{} workers x {} threads: {} samples in {:.1f}s, {:.1f} samples/sec".format(
+                len(shards),
+                self.threads_per_worker,
+                total_samples,
+                total_time,
+                total_samples / max(total_time, 1e-6),
+            ),
+            flush=True,
+        )
+        return results
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_sharded_evaluation(
+    relations_to_evaluate,
+    num_workers,
+    threads_per_worker,
+    multi_relation,
+    log_directory,
+    share_model=False,
+    build_model=None,
+):
+    """Evaluate the relations with num_workers processes (see
+    ShardedEvaluator) and return the merged results (see
+    evaluate_relations)."""
+    with ShardedEvaluator(num_workers, threads_per_worker, share_model, build_model) as evaluator:
+        return evaluator.evaluate(relations_to_evaluate, multi_relation, log_directory)
+
+
 def run_experiments(
     relations,
     data_path_pre,
@@ -52,7 +386,29 @@ def run_experiments(
         "bert_model_dir": "pre-trained_language_models/bert/cased_L-24_H-1024_A-16",
     },
     use_negated_probes=False,
+    multi_relation=False,
+    num_workers=1,
+    threads_per_worker=None,
+    share_model=False,
+    resume=False,
 ):
+    """Evaluate a language model on a list of relations.
+
+    If multi_relation is True, the samples of all relations are merged in a
+    single length-sorted stream of batches (see main_multi_relation in
+    batch_eval_KB_completion). The metrics are the same as the ones computed
+    relation by relation.
+
+    If num_workers > 1, the relations are split among num_workers processes,
+    each one using threads_per_worker torch threads (default: number of cores
+    / num_workers), and the results are merged at the end. With share_model
+    the workers share a single copy of the weights (see
+    run_sharded_evaluation).
+
+    The metrics are checkpointed every checkpoint_interval batches. With
+    resume, the relations finished by a previous run are not evaluated again
+    and a partially evaluated relation restarts from its last checkpoint.
+    """
     model = None
     pp = pprint.PrettyPrinter(width=41, compact=True)
 
@@ -66,72 +422,7 @@ def run_experiments(
 
     results_file = open("last_results.csv", "w+")
 
-    for relation in relations:
-        pp.pprint(relation)
-        PARAMETERS = {
-            # Google RE and TREx
-            "dataset_filename": "{}/{}/{}".format(
-                data_path_pre, relation["relation"], data_path_post
-            ),
-            "common_vocab_filename": "pre-trained_language_models/common_vocab_cased_rob.txt", # [CONFIGURABLE]: BERT -> common_vocab_cased.txt,  BERT + RoBERTa -> common_vocab_cased_rob.txt
-            "template": "",
-            "bert_vocab_name": "vocab.txt",
-            "batch_size": 64, # [CONFIGURABLE]: 64 for Fact Retrieval and 32 for Relation Extraction (on a NVIDIA GeForce GTX 1080ti)
-            "logdir": "output",
-            "full_logdir": "output/results/{}/{}".format(
-                input_param["label"], relation["relation"]
-            ),
-            "lowercase": False,
-            "max_sentence_length": 50, # used to be 100
-            "threads": -1,
-            "interactive": False,
-            "use_negated_probes": use_negated_probes,
-            "use_ctx": False, # [CONFIGURABLE]: Toggle for Relation Extraction
-            "synthetic": False # [CONFIGURABLE]: Toggle for perturbed sentence evaluation for Relation Extraction
-        }
-
-        if "template" in relation:
-            PARAMETERS["template"] = relation["template"]
-            if use_negated_probes:
-                PARAMETERS["template_negated"] = relation["template_negated"]
-
-        PARAMETERS.update(input_param)
-        print(PARAMETERS)
-
-        args = argparse.Namespace(**PARAMETERS)
-
-        # This is for easy recording of metrics across train, dev, test sets for each relation
-        if relation['relation'] not in metrics:
-            metrics[relation['relation']] = {
-                'train': {
-                    'mrr': 0,
-                    'p10': 0,
-                    'p1': 0
-                },
-                'dev': {
-                    'mrr': 0,
-                    'p10': 0,
-                    'p1': 0
-                },
-                'test': {
-                    'mrr': 0,
-                    'p10': 0,
-                    'p1': 0
-                }
-            }
-
-        # see if file exists
-        try:
-            data = load_file(args.dataset_filename)
-        except Exception as e:
-            print("Relation {} excluded.".format(relation["relation"]))
-            print("Exception: {}".format(e))
-            continue
-
-        if model is None:
-            [model_type_name] = args.models_names
-            model = build_model_by_name(model_type_name, args)
-        MRR, Precision, Precision1, Precision1_RE = run_evaluation(args, relation['relation'], shuffle_data=False, model=model, use_ctx=args.use_ctx, synthetic=args.synthetic)
+    def record_results(relation, args, MRR, Precision, Precision1, Precision1_RE):
         print("P@1 : {}".format(Precision1), flush=True)
         all_MRR.append(MRR)
         all_Precision.append(Precision)
@@ -153,9 +444,75 @@ def run_experiments(
 
         if "type" in relation:
             type_Precision1[relation["type"]].append(Precision1)
-            data = load_file(PARAMETERS["dataset_filename"])
+            data = load_file(args.dataset_filename)
             type_count[relation["type"]].append(len(data))
 
+    relations_to_evaluate = []
+    for relation in relations:
+        pp.pprint(relation)
+        PARAMETERS = get_relation_parameters(
+            relation, data_path_pre, data_path_post, input_param, use_negated_probes
+        )
+        PARAMETERS["resume"] = resume
+        print(PARAMETERS)
+
+        args = argparse.Namespace(**PARAMETERS)
+
+        init_relation_metrics(metrics, relation['relation'])
+
+        # see if file exists
+        try:
+            data = load_file(args.dataset_filename)
+        except Exception as e:
+            print("Relation {} excluded.".format(relation["relation"]))
+            print("Exception: {}".format(e))
+            continue
+
+        if multi_relation or num_workers > 1:
+            # evaluated all together after the loop
+            relations_to_evaluate.append((relation, args))
+            continue
+
+        finished_results, _ = split_finished_relations([(relation, args)], False, None)
+        if finished_results:
+            (MRR, Precision, Precision1, Precision1_RE), _ = finished_results[relation["relation"]]
+            record_results(relation, args, MRR, Precision, Precision1, Precision1_RE)
+            continue
+
+        if model is None:
+            [model_type_name] = args.models_names
+            model = build_model_by_name(model_type_name, args, background_weights=True)
+
+        MRR, Precision, Precision1, Precision1_RE = run_evaluation(args, relation['relation'], shuffle_data=False, model=model, use_ctx=args.use_ctx, synthetic=args.synthetic)
+        record_results(relation, args, MRR, Precision, Precision1, Precision1_RE)
+
+    if relations_to_evaluate:
+        log_directory = "output/results/{}/multi_relation_{}".format(
+            input_param["label"], dataset_type
+        )
+        if num_workers > 1:
+            results = run_sharded_evaluation(
+                relations_to_evaluate,
+                num_workers,
+                threads_per_worker,
+                multi_relation,
+                log_directory,
+                share_model=share_model,
+            )
+        else:
+            results, remaining = split_finished_relations(
+                relations_to_evaluate, multi_relation, log_directory
+            )
+            if remaining:
+                [model_type_name] = remaining[0][1].models_names
+                model = build_model_by_name(model_type_name, remaining[0][1], background_weights=True)
+                results.update(
+                    evaluate_relations(model, remaining, multi_relation, log_directory)
+                )
+        for relation, args in relations_to_evaluate:
+            relation_results, _ = results[relation["relation"]]
+            record_results(relation, args, *relation_results)
+
     mean_p1 = statistics.mean(all_Precision1)
     print("@@@ {} - mean P@1: {}".format(input_param["label"], mean_p1))
     results_file.close()
@@ -195,10 +552,23 @@ def get_TREx_parameters(data_path_post, data_path_pre="data/"):
     return relations, data_path_pre, data_path_post
 
 
-def run_all_LMs(parameters, metrics, dataset_type):
+def run_all_LMs(parameters, metrics, dataset_type, multi_relation=False, num_workers=1, threads_per_worker=None, share_model=False, resume=False):
     for ip in LMs:
         print(ip["label"])
-        run_experiments(*parameters, metrics, dataset_type, input_param=ip, use_negated_probes=False)
+        run_experiments(*parameters, metrics, dataset_type, input_param=ip, use_negated_probes=False, multi_relation=multi_relation, num_workers=num_workers, threads_per_worker=threads_per_worker, share_model=share_model, resume=resume)
+
+
+def run_train_dev_test():
+    """Evaluate the LMs on the train, dev and test splits of the relations
+    of get_TREx_parameters, one split after the other (the evaluation of
+    this script before the experiment grid)."""
+    metrics = {}
+    for dataset_type in ["train", "dev", "test"]:
+        print(('='*40) + ' {} '.format(dataset_type.upper()) + ('='*40))
+        parameters = get_TREx_parameters("{}.jsonl".format(dataset_type))
+        run_all_LMs(parameters, metrics, dataset_type)
+    print(('='*40) + ' METRICS ' + ('='*40))
+    print_all_relation_metrics(metrics)
 
 
 def print_all_relation_metrics(metrics):
@@ -229,19 +599,343 @@ def print_all_relation_metrics(metrics):
     print('Average Test P@1:', avg_p1_test / len(metrics))
 
 
+# Declarative description of an experiment grid: every model is evaluated on
+# every (template set, split, relation) cell.
+DEFAULT_GRID_SPEC = {
+    "models": LMs,
+    # relations file, also used as default template set
+    "relations_filename": "data/relations.jsonl",
+    # subset of relation ids to evaluate (None for all the relations)
+    "relations": None,
+    "splits": ["train", "dev", "test"],
+    # template set label -> relations file with the templates (None for relations_filename)
+    "templates": {"default": None},
+    "data_path_pre": "../data/relation_extraction",
+    # evaluate all the relations of a split in a single stream of batches
+    "multi_relation": True,
+    # number of worker processes for each (model, template set, split) cell group
+    "num_workers": 1,
+    # torch threads of each worker (None: number of cores / num_workers)
+    "threads_per_worker": None,
+    # load the model once and share its weights with the workers
+    "share_model": False,
+    # skip the cells finished by a previous run and restart the partial ones
+    # from their last checkpoint
+    "resume": False,
+    "results_filename": "grid_results.csv",
+}
+
+
+def get_grid_spec(spec_filename=None):
+    spec = dict(DEFAULT_GRID_SPEC)
+    if spec_filename is not None:
+        with open(spec_filename, "r") as f:
+            spec.update(json.load(f))
+    return spec
+
+
+def get_grid_relations(spec, templates_filename):
+    if templates_filename is None:
+        templates_filename = spec["relations_filename"]
+    relations = load_file(templates_filename)
+    if spec["relations"] is not None:
+        relations = [r for r in relations if r["relation"] in spec["relations"]]
+    return relations
+
+
+def run_experiment_grid(spec):
+    """Evaluate a grid of models x template sets x splits x relations.
+
+    The cells are scheduled model by model, so that each model is loaded
+    exactly once (in this process, or once in each worker with
+    spec["num_workers"] > 1). Parsed data files, vocab subset indices and the
+    tokenization of the object labels are shared across all the cells via
+    an EvaluationCache. All results are written in a single table
+    (spec["results_filename"]) with one row for each cell.
+
+    Returns:
+    grid_metrics (dict): (model label, template label) -> metrics dictionary
+                         in the format of print_all_relation_metrics
+    """
+    cache = EvaluationCache()
+    grid_metrics = {}
+    fieldnames = ["model", "template", "split", "relation", "num_samples", "mrr", "p10", "p1", "p1_re"]
+
+    with open(spec["results_filename"], "w", newline="") as results_file:
+        writer = csv.DictWriter(results_file, fieldnames=fieldnames)
+        writer.writeheader()
+
+        for input_param in spec["models"]:
+            print(input_param["label"])
+            if spec["num_workers"] > 1:
+                with ShardedEvaluator(
+                    spec["num_workers"], spec["threads_per_worker"], share_model=spec["share_model"]
+                ) as evaluator:
+                    run_grid_model(spec, input_param, grid_metrics, writer, results_file, evaluator=evaluator)
+            else:
+                run_grid_model(spec, input_param, grid_metrics, writer, results_file, cache=cache)
+
+    for (model_label, template_label), metrics in grid_metrics.items():
+        print(('='*40) + ' METRICS {} - {} '.format(model_label, template_label) + ('='*40))
+        print_all_relation_metrics(metrics)
+
+    return grid_metrics
+
+
+def run_grid_model(spec, input_param, grid_metrics, writer, results_file, cache=None, evaluator=None):
+    """Evaluate the cells of a model of the grid (see run_experiment_grid),
+    with the workers of evaluator if given, otherwise in this process. The
+    model is loaded at most once, and dropped (with its entries in cache) at
+    the end."""
+    [model_type_name] = input_param["models_names"]
+    model = None
+
+    for template_label, templates_filename in spec["templates"].items():
+        relations = get_grid_relations(spec, templates_filename)
+        metrics = grid_metrics.setdefault((input_param["label"], template_label), {})
+
+        for split in spec["splits"]:
+            print(('='*40) + ' {} - {} - {} '.format(input_param["label"], template_label, split.upper()) + ('='*40))
+            data_path_post = "{}.jsonl".format(split)
+
+            relations_to_evaluate = []
+            for relation in relations:
+                PARAMETERS = get_relation_parameters(
+                    relation, spec["data_path_pre"], data_path_post, input_param
+                )
+                PARAMETERS["resume"] = spec["resume"]
+                args = argparse.Namespace(**PARAMETERS)
+                init_relation_metrics(metrics, relation["relation"])
+                if not os.path.isfile(args.dataset_filename):
+                    print("Relation {} excluded.".format(relation["relation"]))
+                    continue
+                relations_to_evaluate.append((relation, args))
+
+            if not relations_to_evaluate:
+                continue
+
+            log_directory = "output/results/{}/{}_{}".format(input_param["label"], template_label, split)
+            results, remaining = split_finished_relations(
+                relations_to_evaluate, spec["multi_relation"], log_directory
+            )
+            if remaining and evaluator is not None:
+                results.update(evaluator.evaluate(remaining, spec["multi_relation"], log_directory))
+            elif remaining:
+                if model is None:
+                    model = build_model_by_name(model_type_name, remaining[0][1], background_weights=True)
+                results.update(evaluate_relations(
+                    model,
+                    remaining,
+                    spec["multi_relation"],
+                    log_directory,
+                    cache=cache,
+                ))
+
+            for relation, args in relations_to_evaluate:
+                (MRR, Precision, Precision1, Precision1_RE), num_samples = results[relation["relation"]]
+                rel_metrics = metrics[relation["relation"]].setdefault(split, {})
+                if args.use_ctx:
+                    rel_metrics["p1"] = round(Precision1_RE * 100.0, 2)
+                else:
+                    rel_metrics["mrr"] = round(MRR * 100.0, 2)
+                    rel_metrics["p10"] = round(Precision * 100.0, 2)
+                    rel_metrics["p1"] = round(Precision1 * 100.0, 2)
+                writer.writerow({
+                    "model": input_param["label"],
+                    "template": template_label,
+                    "split": split,
+                    "relation": relation["relation"],
+                    "num_samples": num_samples,
+                    "mrr": round(MRR * 100.0, 2),
+                    "p10": round(Precision * 100.0, 2),
+                    "p1": round(Precision1 * 100.0, 2),
+                    "p1_re": round(Precision1_RE * 100.0, 2),
+                })
+            results_file.flush()
+
+    if model is not None and cache is not None:
+        cache.forget_model(model)
+
+
+def get_grid_tasks(spec):
+    """Returns the (task_id, task) of each cell of the grid with a dataset."""
+    tasks = []
+    for input_param in spec["models"]:
+        for template_label, templates_filename in spec["templates"].items():
+            for split in spec["splits"]:
+                for relation in get_grid_relations(spec, templates_filename):
+                    dataset_filename = "{}/{}/{}.jsonl".format(
+                        spec["data_path_pre"], relation["relation"], split
+                    )
+                    if not os.path.isfile(dataset_filename):
+                        continue
+                    task_id = "{}__{}__{}__{}".format(
+                        input_param["label"], template_label, split, relation["relation"]
+                    )
+                    tasks.append((task_id, {
+                        "model": input_param,
+                        "template": template_label,
+                        "split": split,
+                        "relation": relation,
+                    }))
+    return tasks
+
+
+def init_task_queue(spec, queue_dir):
+    """Add all the cells of the grid to the work queue in queue_dir. Cells
+    already in the queue are not added again."""
+    queue = TaskQueue(queue_dir)
+    num_added = 0
+    for task_id, task in get_grid_tasks(spec):
+        if queue.add_task(task_id, task):
+            num_added += 1
+    print("{} tasks added to {}".format(num_added, queue_dir))
+    return queue
+
+
+def run_task_queue_worker(spec, queue_dir, stale_timeout=600):
+    """Evaluate (model, relation, split, template) tasks claimed from the work
+    queue in queue_dir until it is empty. Many workers, on one or several
+    nodes sharing queue_dir, can run at the same time."""
+    queue = TaskQueue(queue_dir, stale_timeout=stale_timeout)
+    loaded = {"label": None, "model": None, "cache": None}
+
+    def evaluate(task):
+        input_param = task["model"]
+        relation = task["relation"]
+        PARAMETERS = get_relation_parameters(
+            relation, spec["data_path_pre"], "{}.jsonl".format(task["split"]), input_param
+        )
+        PARAMETERS["full_logdir"] = "output/results/{}/{}_{}/{}".format(
+            input_param["label"], task["template"], task["split"], relation["relation"]
+        )
+        PARAMETERS["resume"] = spec["resume"]
+        args = argparse.Namespace(**PARAMETERS)
+
+        results, remaining = split_finished_relations([(relation, args)], False, None)
+        if remaining and loaded["label"] != input_param["label"]:
+            # tasks are sorted by model, so each worker loads few models
+            loaded["model"] = None
+            loaded["cache"] = EvaluationCache()
+            [model_type_name] = input_param["models_names"]
+            PARAMETERS = get_relation_parameters(relation, spec["data_path_pre"], "", input_param)
+            loaded["model"] = build_model_by_name(model_type_name, argparse.Namespace(**PARAMETERS), background_weights=True)
+            loaded["label"] = input_param["label"]
+        if remaining:
+            results = evaluate_relations(
+                loaded["model"], remaining, False, args.full_logdir, cache=loaded["cache"]
+            )
+        (MRR, Precision, Precision1, Precision1_RE), num_samples = results[relation["relation"]]
+        return {
+            "model": input_param["label"],
+            "template": task["template"],
+            "split": task["split"],
+            "relation": relation["relation"],
+            "use_ctx": args.use_ctx,
+            "num_samples": num_samples,
+            "MRR": MRR,
+            "Precision": Precision,
+            "Precision1": Precision1,
+            "Precision1_RE": Precision1_RE,
+        }
+
+    num_tasks = queue.run_worker(evaluate)
+    print("[{}] {} tasks evaluated".format(queue.worker_id, num_tasks))
+    return num_tasks
+
+
+def reduce_task_queue(spec, queue_dir, results_filename="last_results.csv"):
+    """Collect the per-task results of the work queue in queue_dir.
+
+    Writes results_filename (relation,P@1 for the last split of the spec, as
+    run_experiments does) and prints the train/dev/test metrics table of each
+    (model, template set).
+
+    Returns:
+    grid_metrics (dict): (model label, template label) -> metrics dictionary
+                         in the format of print_all_relation_metrics
+    """
+    queue = TaskQueue(queue_dir)
+    if not queue.is_finished():
+        print("WARNING: the queue still has pending or claimed tasks")
+    task_results = queue.results()
+
+    grid_metrics = {}
+    with open(results_filename, "w+") as results_file:
+        for task_id, task in get_grid_tasks(spec):
+            if task_id not in task_results:
+                print("Task {} has no result.".format(task_id))
+                continue
+            result = task_results[task_id]
+            metrics = grid_metrics.setdefault((result["model"], result["template"]), {})
+            init_relation_metrics(metrics, result["relation"])
+            rel_metrics = metrics[result["relation"]].setdefault(result["split"], {})
+            if result["use_ctx"]:
+                rel_metrics["p1"] = round(result["Precision1_RE"] * 100.0, 2)
+            else:
+                rel_metrics["mrr"] = round(result["MRR"] * 100.0, 2)
+                rel_metrics["p10"] = round(result["Precision"] * 100.0, 2)
+                rel_metrics["p1"] = round(result["Precision1"] * 100.0, 2)
+            if result["split"] == spec["splits"][-1]:
+                results_file.write(
+                    "{},{}\n".format(result["relation"], round(result["Precision1"] * 100, 2))
+                )
+
+    for (model_label, template_label), metrics in grid_metrics.items():
+        print(('='*40) + ' METRICS {} - {} '.format(model_label, template_label) + ('='*40))
+        print_all_relation_metrics(metrics)
+
+    return grid_metrics
+
+
 if __name__ == "__main__":
-    metrics = {}
-    print(('='*40) + ' TRAIN ' + ('='*40))
-    data_path_post = 'train.jsonl'
-    parameters = get_TREx_parameters(data_path_post)
-    run_all_LMs(parameters, metrics, 'train')
-    print(('='*40) + ' DEV ' + ('='*40))
-    data_path_post = 'dev.jsonl'
-    parameters = get_TREx_parameters(data_path_post)
-    run_all_LMs(parameters, metrics, 'dev')
-    print(('='*40) + ' TEST ' + ('='*40))
-    data_path_post = 'test.jsonl'
-    parameters = get_TREx_parameters(data_path_post)
-    run_all_LMs(parameters, metrics, 'test')
-    print(('='*40) + ' METRICS ' + ('='*40))
-    print_all_relation_metrics(metrics)
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--spec",
+        dest="spec",
+        help="json file with the experiment grid (see DEFAULT_GRID_SPEC)",
+    )
+    parser.add_argument(
+        "--queue-dir",
+        dest="queue_dir",
+        help="shared directory of the work queue. If set, run as a work queue "
+        "worker instead of evaluating the whole grid in this process",
+    )
+    parser.add_argument(
+        "--init-queue",
+        dest="init_queue",
+        action="store_true",
+        help="add the cells of the grid to the work queue before starting",
+    )
+    parser.add_argument(
+        "--reduce",
+        dest="reduce",
+        action="store_true",
+        help="only collect the results of the work queue",
+    )
+    parser.add_argument(
+        "--train-dev-test",
+        dest="train_dev_test",
+        action="store_true",
+        help="evaluate LMs on the train, dev and test splits with run_all_LMs "
+        "instead of the experiment grid",
+    )
+    parser.add_argument(
+        "--stale-timeout",
+        dest="stale_timeout",
+        type=int,
+        default=600,
+        help="seconds without heartbeat after which a claimed task is requeued",
+    )
+    cli_args = parser.parse_args()
+    spec = get_grid_spec(cli_args.spec)
+    if cli_args.train_dev_test:
+        run_train_dev_test()
+    elif cli_args.queue_dir is None:
+        run_experiment_grid(spec)
+    else:
+        if cli_args.init_queue:
+            init_task_queue(spec, cli_args.queue_dir)
+        if not cli_args.reduce:
+            run_task_queue_worker(spec, cli_args.queue_dir, cli_args.stale_timeout)
+        reduce_task_queue(spec, cli_args.queue_dir)
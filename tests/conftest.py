@@ -0,0 +1,156 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import sys
+import json
+import zlib
+import argparse
+import pytest
+import torch
+from lama.modules.base_connector import Base_Connector, MASK
+
+# the evaluation scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+STUB_SUBJECTS = ["s{}".format(i) for i in range(20)]
+STUB_OBJECTS = ["o{}".format(i) for i in range(8)]
+# the metrics rank the top 10000 predictions: the vocabularies are larger
+STUB_FILLERS = ["w{}".format(i) for i in range(10000)]
+STUB_RELATIONS = [
+    {"relation": "P1", "template": "[X] lives in [Y] ."},
+    {"relation": "P2", "template": "[X] works for the [Y] ."},
+]
+
+
+class StubConnector(Base_Connector):
+    """A masked LM whose log-probs at a position only depend on the input and
+    on the position (not on the other inputs of the batch)."""
+
+    def __init__(self):
+        super().__init__()
+        self.vocab = [MASK, "[UNK]", "lives", "in", "works", "for", "the", "."] + STUB_SUBJECTS + STUB_OBJECTS + STUB_FILLERS
+        self._init_inverse_vocab()
+
+    def get_id(self, string):
+        ids = [self.inverse_vocab.get(word) for word in string.split()]
+        return None if None in ids else ids
+
+    def _torch_modules(self):
+        return []
+
+    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+        tokens_list = [" ".join(sentences).split() for sentences in sentences_list]
+        length = max(len(tokens) for tokens in tokens_list)
+        log_probs = torch.zeros(len(tokens_list), length, len(self.vocab))
+        for i, tokens in enumerate(tokens_list):
+            # crc32: the same in all the processes (unlike hash)
+            generator = torch.Generator().manual_seed(zlib.crc32(" ".join(tokens).encode("utf-8")))
+            scores = torch.randn(len(tokens), len(self.vocab), generator=generator)
+            log_probs[i, :len(tokens)] = torch.log_softmax(scores, dim=-1)
+        token_ids_list = [[self.inverse_vocab.get(word, 1) for word in tokens] for tokens in tokens_list]
+        masked_indices_list = [[tokens.index(MASK)] for tokens in tokens_list]
+        return log_probs, token_ids_list, masked_indices_list
+
+
+def build_stub_model(lm, args):
+    """build_model for the evaluation scripts (picklable)."""
+    return StubConnector()
+
+
+@pytest.fixture
+def stub_relations(tmpdir):
+    """Writes the datasets of STUB_RELATIONS and a common vocabulary in
+    tmpdir, and returns a function of (relation, **overrides) that returns
+    the evaluation args of the relation."""
+    from run_experiments import get_relation_parameters
+
+    data_dir = os.path.join(str(tmpdir), "data")
+    for n, relation in enumerate(STUB_RELATIONS):
+        os.makedirs(os.path.join(data_dir, relation["relation"]))
+        with open(os.path.join(data_dir, relation["relation"], "test.jsonl"), "w") as f:
+            for i, sub_label in enumerate(STUB_SUBJECTS[: 11 + 4 * n]):
+                f.write(json.dumps({
+                    "sub_label": sub_label,
+                    "obj_label": STUB_OBJECTS[(3 * i + n) % len(STUB_OBJECTS)],
+                    "sub_uri": "Q{}".format(i),
+                    "obj_uri": "Q{}".format(100 + i),
+                }) + "\n")
+    vocab_filename = os.path.join(str(tmpdir), "common_vocab.txt")
+    with open(vocab_filename, "w") as f:
+        f.write("\n".join(STUB_OBJECTS[:6] + STUB_FILLERS) + "\n")
+
+    def relation_args(relation, **overrides):
+        input_param = {
+            "label": "stub",
+            "models_names": ["stub"],
+            "common_vocab_filename": vocab_filename,
+            "batch_size": 4,
+            "threads": 1,
+            "checkpoint_interval": 0,
+        }
+        input_param.update(overrides)
+        input_param.setdefault("logdir", os.path.join(str(tmpdir), "output"))
+        args = get_relation_parameters(relation, data_dir, "test.jsonl", input_param)
+        if "full_logdir" not in overrides:
+            args["full_logdir"] = os.path.join(args["logdir"], args["label"], relation["relation"])
+        return argparse.Namespace(**args)
+
+    return relation_args
+
+
+TINY_BERT_WORDS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "."] + ["w{}".format(i) for i in range(50)]
+
+
+class TinyBert(object):
+    """Factory of Bert connectors of a tiny random BERT (hidden size 16,
+    vocabulary TINY_BERT_WORDS), loaded from a flat checkpoint in directory.
+
+    tiny_bert(num_hidden_layers=2, background_weights=False, words=TINY_BERT_WORDS, **options)
+    returns the connector, with the options (e.g. bert_jit=True) as its
+    arguments; tiny_bert.original is the connector of the model before it was
+    saved.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.original = None
+        self.__num_models = 0
+
+    def __call__(self, num_hidden_layers=2, background_weights=False, words=TINY_BERT_WORDS, **options):
+        pytest.importorskip("pytorch_pretrained_bert")
+        from pytorch_pretrained_bert import BertConfig, BertForMaskedLM, BertTokenizer
+        from lama.modules.bert_connector import Bert, CustomBaseTokenizer
+
+        directory = os.path.join(self.directory, "bert{}".format(self.__num_models))
+        self.__num_models += 1
+        os.makedirs(directory)
+        vocab_file = os.path.join(directory, "vocab.txt")
+        with open(vocab_file, "w") as f:
+            f.write("\n".join(words) + "\n")
+
+        # a connector for a model without a checkpoint
+        torch.manual_seed(0)
+        self.original = Bert.__new__(Bert)
+        self.original.masked_bert_model = BertForMaskedLM(
+            BertConfig(len(words), hidden_size=16, num_hidden_layers=num_hidden_layers,
+                       num_attention_heads=2, intermediate_size=32)
+        ).eval()
+        self.original.vocab_name = "vocab.txt"
+        self.original.tokenizer = BertTokenizer(vocab_file)
+        self.original.tokenizer.basic_tokenizer = CustomBaseTokenizer(do_lower_case=True)
+
+        flat_dir = os.path.join(directory, "flat")
+        self.original.save_flat_checkpoint(flat_dir)
+        args = argparse.Namespace(
+            bert_model_dir=flat_dir, bert_model_name="bert-base-cased", bert_vocab_name="vocab.txt", **options
+        )
+        return Bert(args, background_weights=background_weights)
+
+
+@pytest.fixture
+def tiny_bert(tmpdir):
+    return TinyBert(str(tmpdir))
@@ -0,0 +1,56 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import json
+import logging
+import threading
+from lama.async_logging import start_async_logging, stop_async_logging, JsonlFormatter
+
+
+class _FormattedBy(object):
+    def __init__(self):
+        self.thread = None
+
+    def __str__(self):
+        self.thread = threading.current_thread()
+        return "formatted"
+
+
+def test_messages_are_formatted_by_the_listener(tmpdir, monkeypatch):
+    logger = logging.getLogger("test_async_logging")
+    logger.setLevel(logging.DEBUG)
+    # as init_logging: the handlers of the root logger (e.g., the log capture
+    # of pytest) would format the message in this thread
+    monkeypatch.setattr(logger, "propagate", False)
+    filename = os.path.join(str(tmpdir), "info.log")
+    start_async_logging(logger, [logging.FileHandler(filename)])
+    arg = _FormattedBy()
+    logger.info("%s", arg)
+    stop_async_logging(logger)
+
+    assert arg.thread is not None and arg.thread is not threading.current_thread()
+    assert open(filename).read() == "formatted\n"
+    assert not logger.handlers
+
+
+def test_restart_replaces_handlers(tmpdir):
+    logger = logging.getLogger("test_async_logging")
+    logger.setLevel(logging.DEBUG)
+    filenames = [os.path.join(str(tmpdir), "{}.jsonl".format(i)) for i in range(2)]
+    for i, filename in enumerate(filenames):
+        handler = logging.FileHandler(filename)
+        handler.setFormatter(JsonlFormatter())
+        start_async_logging(logger, [handler])
+        logger.info("message %d", i)
+        logger.info("batch", extra={"event": "batch", "data": {"batch": i}})
+    stop_async_logging(logger)
+
+    for i, filename in enumerate(filenames):
+        records = [json.loads(line) for line in open(filename)]
+        assert [r["event"] for r in records] == ["message", "batch"]
+        assert records[0]["message"] == "message {}".format(i)
+        assert records[1]["batch"] == i
@@ -0,0 +1,64 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import threading
+import pytest
+import torch
+from lama.modules.base_connector import Base_Connector
+
+
+class _SlowConnector(Base_Connector):
+    def __init__(self, release, fail=False, background_weights=False):
+        super().__init__()
+        self.vocab = ["a", "b", "c"]
+        self._init_inverse_vocab()
+        self.release = release
+        self.fail = fail
+        self.load_weights(None, background=background_weights)
+
+    def _load_weights(self, args):
+        if not self.release.wait(10):
+            raise RuntimeError("never released")
+        if self.fail:
+            raise ValueError("corrupted checkpoint")
+        self.model = torch.nn.Linear(2, 2)
+
+    def get_id(self, string):
+        return [self.inverse_vocab[word] for word in string.split()]
+
+    def _torch_modules(self):
+        self.wait_for_weights()
+        return [self.model]
+
+
+def test_vocabulary_before_weights():
+    release = threading.Event()
+    model = _SlowConnector(release, background_weights=True)
+    # the weights are not loaded yet: the vocabulary is usable
+    assert model.get_id("b c") == [1, 2]
+    assert not hasattr(model, "model")
+    release.set()
+    # waits for the weights
+    [module] = model._torch_modules()
+    assert isinstance(module, torch.nn.Linear)
+
+
+def test_loading_error_is_raised():
+    release = threading.Event()
+    model = _SlowConnector(release, fail=True, background_weights=True)
+    release.set()
+    with pytest.raises(ValueError):
+        model.wait_for_weights()
+    # raised once
+    model.wait_for_weights()
+    assert not hasattr(model, "model")
+
+
+def test_synchronous_loading():
+    release = threading.Event()
+    release.set()
+    model = _SlowConnector(release)
+    assert isinstance(model.__dict__["model"], torch.nn.Linear)
@@ -0,0 +1,45 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import pytest
+import torch
+
+pytest.importorskip("pytorch_pretrained_bert")
+from lama.modules.bert_connector import JIT_LENGTH_BUCKET
+
+
+def test_traced_generation(tiny_bert):
+    model = tiny_bert(bert_jit=True)
+    sentences = [
+        ["w1 w2 [MASK] ."],
+        ["w3 [MASK] w4 w5 w6 w7 w8 w9 w10 w11 .", "w12 w13 ."],
+        ["[MASK] w20 ."],
+    ]
+    for batch in [sentences[:1], sentences]:
+        model.jit = False
+        expected = model.get_batch_generation(batch, try_cuda=False)
+        model.jit = True
+        actual = model.get_batch_generation(batch, try_cuda=False)
+        assert actual[0].shape == expected[0].shape
+        assert torch.allclose(actual[0], expected[0], atol=1e-5)
+        assert actual[2] == expected[2]
+
+    # one traced model per batch size and padded length
+    def bucket(batch):
+        return -(-max(model.get_input_lengths(batch)) // JIT_LENGTH_BUCKET) * JIT_LENGTH_BUCKET
+
+    traced_models = model._Bert__traced_models
+    assert sorted(key[:2] for key in traced_models) == [(1, bucket(sentences[:1])), (3, bucket(sentences))]
+    traced = traced_models[(3, bucket(sentences), "cpu")]
+    # reused for another batch of the same bucket
+    other = [["w1 [MASK] ."], ["w2 [MASK] ."], ["w3 w4 w5 w6 w7 w8 w9 w10 w11 w12 w13 w14 w15 [MASK] ."]]
+    assert bucket(other) == bucket(sentences)
+    model.get_batch_generation(other, try_cuda=False)
+    assert len(traced_models) == 2 and traced_models[(3, bucket(sentences), "cpu")] is traced
+
+    model.trace([4], [5, 20])
+    assert (4, JIT_LENGTH_BUCKET, "cpu") in traced_models
+    assert (4, 3 * JIT_LENGTH_BUCKET, "cpu") in traced_models
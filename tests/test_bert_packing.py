@@ -0,0 +1,32 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import torch
+
+
+def test_packed_generation(tiny_bert):
+    model = tiny_bert(bert_pack_length=24)
+    sentences = [
+        ["w1 w2 [MASK] ."],
+        ["w3 [MASK] w4 w5 w6 w7 w8 w9 w10 w11 .", "w12 w13 ."],
+        ["[MASK] w20 ."],
+        ["w30 [MASK] w31 .", "[MASK] w32 ."],
+        ["w1 w2 w3 w4 w5 w6 w7 w8 w9 w10 w11 w12 w13 w14 w15 w16 w17 w18 w19 w20 w21 w22 [MASK] ."],
+    ]
+    lengths = model.get_input_lengths(sentences)
+    rows, row_length = model._Bert__pack(lengths)
+    # the last input is longer than the rows: it has its own
+    assert len(rows) == 3 and row_length == lengths[-1]
+    assert sorted(i for row in rows for i, _ in row) == list(range(len(sentences)))
+
+    packed = model.get_batch_generation(sentences, try_cuda=False)
+    model.pack_length = None
+    expected = model.get_batch_generation(sentences, try_cuda=False)
+    assert packed[0].shape == expected[0].shape
+    for i, length in enumerate(lengths):
+        assert torch.allclose(packed[0][i, :length], expected[0][i, :length], atol=1e-5)
+    assert packed[2] == expected[2]
+    assert all((a == b).all() for a, b in zip(packed[1], expected[1]))
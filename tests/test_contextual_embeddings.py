@@ -0,0 +1,158 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import pytest
+import torch
+
+pytest.importorskip("pytorch_pretrained_bert")
+from lama.modules.base_connector import Base_Connector, pool_layers
+
+WORDS = ["w{}".format(i) for i in range(30)]
+
+
+def _transformerxl(**config):
+    """TransformerXL connector of a tiny random model over WORDS."""
+    from pytorch_pretrained_bert import TransfoXLConfig, TransfoXLLMHeadModel, TransfoXLTokenizer
+    from lama.modules.transformerxl_connector import TransformerXL
+
+    # pytorch_pretrained_bert masks the attention of Transformer-XL with
+    # uint8 tensors, which recent versions of torch reject
+    try:
+        torch.zeros(1).masked_fill(torch.zeros(1, dtype=torch.uint8), 0)
+    except RuntimeError:
+        pytest.skip("Transformer-XL of pytorch_pretrained_bert needs uint8 masks")
+
+    tokenizer = TransfoXLTokenizer(special=[TransformerXL.UNK_SYMBOL, TransformerXL.EOS_SYMBOL])
+    tokenizer.counter.update(WORDS)
+    tokenizer.build_vocab()
+
+    # a connector for a model without a checkpoint
+    model = TransformerXL.__new__(TransformerXL)
+    Base_Connector.__init__(model)
+    model.tokenizer = tokenizer
+    model.vocab = list(tokenizer.idx2sym)
+    model._init_inverse_vocab()
+    model.eos_id = model.inverse_vocab[TransformerXL.EOS_SYMBOL]
+    model.unk_symbol = TransformerXL.UNK_SYMBOL
+    torch.manual_seed(0)
+    model.model = TransfoXLLMHeadModel(TransfoXLConfig(
+        len(model.vocab), cutoffs=[], d_model=16, d_embed=16, n_head=2, d_head=8, d_inner=32,
+        div_val=1, n_layer=3, **config
+    )).eval()
+    return model
+
+
+def test_transformerxl_streaming():
+    # the memory holds the whole text: streaming is exact
+    model = _transformerxl(tgt_len=4, mem_len=64, clamp_len=-1, same_length=False)
+    sentences = ["w1 w2 w3 w4 w5", "w6 w7 w8", "w9 w10 w11 w12 w13 w14 w15"]
+    expected_layers, [length], [expected_tokens] = model.get_contextual_embeddings(
+        [sentences], try_cuda=False
+    )
+    assert length == 18
+
+    for layers, pooling in [(None, None), ([0, 2], None), (2, "mean")]:
+        segments = list(model.stream_contextual_embeddings(
+            iter(sentences), try_cuda=False, layers=layers, pooling=pooling
+        ))
+        # segments of tgt_len tokens, the first one without the EOS context
+        assert [len(tokens) for _, tokens in segments] == [3, 4, 4, 4, 3]
+        assert sum((tokens for _, tokens in segments), []) == expected_tokens
+
+        streamed = [
+            torch.cat([segment_layers[i] for segment_layers, _ in segments])
+            for i in range(len(segments[0][0]))
+        ]
+        expected = pool_layers([layer[:1] for layer in expected_layers], layers=layers, pooling=pooling)
+        assert len(streamed) == len(expected)
+        for actual, layer in zip(streamed, expected):
+            assert actual.shape == layer[0].shape
+            assert torch.allclose(actual, layer[0], atol=1e-5)
+
+
+def _gpt(directory):
+    """GPT connector of a tiny random model over the letters."""
+    import json
+    import os
+    from pytorch_pretrained_bert import OpenAIGPTConfig, OpenAIGPTLMHeadModel, OpenAIGPTTokenizer
+    from lama.modules.base_connector import OPENAI_EOS, OPENAI_UNK
+    from lama.modules.gpt_connector import GPT
+
+    # one bpe token per letter, without merges
+    letters = [chr(c) for c in range(ord("a"), ord("z") + 1)]
+    encoder = {word: i for i, word in enumerate(["\n</w>", OPENAI_UNK] + [l + "</w>" for l in letters])}
+    with open(os.path.join(directory, "vocab.json"), "w") as f:
+        json.dump(encoder, f)
+    with open(os.path.join(directory, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+
+    # a connector for a model without a checkpoint
+    model = GPT.__new__(GPT)
+    Base_Connector.__init__(model)
+    model.tokenizer = OpenAIGPTTokenizer(
+        os.path.join(directory, "vocab.json"), os.path.join(directory, "merges.txt")
+    )
+    model.vocab = [OPENAI_EOS, OPENAI_UNK] + letters
+    model._init_inverse_vocab()
+    model.unk_symbol = OPENAI_UNK
+    model.eos_id = model.inverse_vocab[OPENAI_EOS]
+    model.model_vocab = model.vocab
+    torch.manual_seed(0)
+    model.gpt_model = OpenAIGPTLMHeadModel(OpenAIGPTConfig(
+        len(model.vocab), n_special=0, n_positions=16, n_ctx=16, n_embd=16, n_layer=3, n_head=2
+    )).eval()
+    return model
+
+
+def test_gpt_layers_and_pooling(tmpdir):
+    import copy
+    import math
+
+    model = _gpt(str(tmpdir))
+    sentences_list = [["a b", "c"], ["d [MASK] e f g"]]
+    _, lengths, tokenized_text_list = model.get_contextual_embeddings(sentences_list, try_cuda=False)
+    assert lengths == [5, 6]
+    assert tokenized_text_list[1] == ["<eos>", "d</w>", "<unk>", "e</w>", "f</w>", "g</w>"]
+
+    # the output of block i of each input alone, by a model cut after it
+    inputs = [["<eos>", "a", "b", "<eos>", "c"], ["<eos>", "d", "<unk>", "e", "f", "g"]]
+    reference = []
+    for i in range(3):
+        truncated = copy.deepcopy(model.gpt_model.transformer)
+        truncated.h = truncated.h[: i + 1]
+        with torch.no_grad():
+            reference.append([
+                truncated(torch.tensor([[model.inverse_vocab[word] for word in words]]))[0]
+                for words in inputs
+            ])
+
+    def check(actual, expected_layers):
+        assert len(actual) == len(expected_layers)
+        for layer, expected in zip(actual, expected_layers):
+            assert layer.shape == (2, 6, 16)
+            for j, length in enumerate(lengths):
+                assert torch.allclose(layer[j, :length], expected[j], atol=1e-5)
+
+    for layers, expected_layers in [(None, reference), (2, reference[1:]),
+                                    ([0, 2], [reference[0], reference[2]])]:
+        actual, _, _ = model.get_contextual_embeddings(sentences_list, try_cuda=False, layers=layers)
+        check(actual, expected_layers)
+
+    actual, _, _ = model.get_contextual_embeddings(
+        sentences_list, try_cuda=False, layers=[0, 2], pooling="mean")
+    check(actual, [[(x + y) / 2 for x, y in zip(reference[0], reference[2])]])
+
+    # softmax([0, log 3]) = [1/4, 3/4]
+    actual, _, _ = model.get_contextual_embeddings(
+        sentences_list, try_cuda=False, layers=2, pooling=[0.0, math.log(3)])
+    check(actual, [[x / 4 + y * 3 / 4 for x, y in zip(reference[1], reference[2])]])
+
+    # the padding of the first input is not averaged
+    [actual], _, _ = model.get_contextual_embeddings(
+        sentences_list, try_cuda=False, layers=1, pooling="mean_tokens")
+    assert actual.shape == (2, 16)
+    for j in range(2):
+        assert torch.allclose(actual[j], reference[2][j].mean(0), atol=1e-5)
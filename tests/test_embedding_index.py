@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import numpy as np
+import torch
+from lama.build_encoded_dataset import EncodedDataset, ShardedEncodedDatasetWriter
+from lama.embedding_index import ExactIndex, IVFPQIndex, sentence_embeddings, build_index
+
+
+def _vectors(num_vectors=2000, dim=16, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(20, dim)
+    return (centers[rng.randint(20, size=num_vectors)] + 0.3 * rng.randn(num_vectors, dim)).astype(np.float32)
+
+
+def test_exact_search():
+    x = _vectors()
+    queries = x[:30] + 0.01
+    for metric in ["ip", "cosine", "l2"]:
+        index = ExactIndex(x, metric=metric, chunk_size=300)
+        scores, ids = index.search(queries, k=5)
+        if metric == "cosine":
+            normalized = x / np.linalg.norm(x, axis=1, keepdims=True)
+            expected = queries @ normalized.T / np.linalg.norm(queries, axis=1, keepdims=True)
+        elif metric == "ip":
+            expected = queries @ x.T
+        else:
+            expected = -((queries[:, None, :] - x[None]) ** 2).sum(axis=2)
+        assert (ids == np.argsort(-expected, axis=1)[:, :5]).all()
+        assert np.allclose(scores, np.sort(expected, axis=1)[:, ::-1][:, :5], atol=1e-3)
+
+    # fewer vectors than k
+    scores, ids = ExactIndex(x[:3]).search(x[0], k=5)
+    assert ids[0, 0] == 0 and (ids[0, 3:] == -1).all()
+
+
+def test_ivfpq_search():
+    x = _vectors()
+    queries = x[:50]
+    for metric in ["ip", "cosine", "l2"]:
+        _, exact_ids = ExactIndex(x, metric=metric).search(queries, k=10)
+        # one sub-vector per dimension: almost no quantization error
+        index = IVFPQIndex(16, num_lists=8, m=16, nbits=6, metric=metric)
+        index.train(x)
+        index.add(x[:700])
+        index.add(x[700:])
+        assert len(index) == len(x)
+        _, ids = index.search(queries, k=10, nprobe=8)
+        assert np.mean([exact[0] in found for found, exact in zip(ids, exact_ids)]) >= 0.95
+        # probing a single list can only find its own vectors
+        _, probe_ids = index.search(queries, k=10, nprobe=1)
+        assert (probe_ids >= 0).sum() <= (ids >= 0).sum()
+
+
+def test_sentence_embeddings(tmpdir):
+    encodings = [(torch.randn(length, 4), length, ["t"] * length) for length in [3, 0, 5, 1]]
+    expected = np.stack([
+        e.mean(dim=0).numpy() if length > 0 else np.zeros(4) for e, length, _ in encodings
+    ])
+    dataset = EncodedDataset(encodings)
+    # in memory: the empty sentence is not NaN either
+    in_memory = sentence_embeddings(dataset)
+    assert in_memory.dtype == np.float32 and not np.isnan(in_memory).any()
+    assert np.allclose(in_memory, expected, atol=1e-6)
+
+    path = os.path.join(str(tmpdir), "encoded")
+    dataset.save(path)
+    assert np.allclose(sentence_embeddings(path, chunk_size=3), expected, atol=1e-6)
+
+    # shards written out of order
+    sharded_path = os.path.join(str(tmpdir), "sharded")
+    writer = ShardedEncodedDatasetWriter(sharded_path, shard_size=3)
+    for i in [2, 0, 3, 1]:
+        writer.add(*encodings[i])
+    writer.close([1, 3, 0, 2])
+    assert np.allclose(sentence_embeddings(sharded_path), expected, atol=1e-6)
+
+    index = build_index(path, kind="exact", metric="l2")
+    _, ids = index.search(expected[2], k=1)
+    assert ids[0, 0] == 2
@@ -0,0 +1,182 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import pickle
+import pytest
+import torch
+from lama.build_encoded_dataset import EncodedDataset, load_encoded_dataset
+from lama.modules.base_connector import pool_layers
+
+
+def _dataset():
+    encodings = []
+    for i, tokens in enumerate([["[CLS]", "The", "cat", "[SEP]"], ["[CLS]", "é", "[SEP]"], ["x"]]):
+        embedding = torch.arange(len(tokens) * 5, dtype=torch.float32).view(-1, 5) + i
+        encodings.append((embedding, len(tokens), tokens))
+    return EncodedDataset(encodings)
+
+
+def test_save_and_memory_map(tmpdir):
+    dataset = _dataset()
+    path = os.path.join(str(tmpdir), "encoded")
+    dataset.save(path)
+    loaded = load_encoded_dataset(path)
+    assert len(loaded) == len(dataset)
+    for i in range(len(dataset)):
+        assert torch.equal(loaded[i].embedding, dataset[i].embedding)
+        assert loaded[i].length == dataset[i].length
+        assert loaded[i].tokens == dataset[i].tokens
+    assert loaded[-1].tokens == ["x"] and loaded[-3].tokens == loaded[0].tokens
+    for idx in [3, -4]:
+        with pytest.raises(IndexError):
+            loaded[idx]
+
+    # views of the same mapped matrix, no copies
+    assert loaded[0].embedding.data_ptr() + 4 * 5 * 4 == loaded[1].embedding.data_ptr()
+
+    # pickles as the path (e.g., for DataLoader workers)
+    assert len(pickle.dumps(loaded)) < 1000
+    assert pickle.loads(pickle.dumps(loaded))[1].tokens == ["[CLS]", "é", "[SEP]"]
+
+
+def test_float16_and_pickle_format(tmpdir):
+    dataset = _dataset()
+    path = os.path.join(str(tmpdir), "encoded16")
+    dataset.save(path, dtype="float16")
+    loaded = load_encoded_dataset(path)
+    assert loaded[0].embedding.dtype == torch.float16
+    assert torch.allclose(loaded[2].embedding.float(), dataset[2].embedding)
+
+    pkl_path = os.path.join(str(tmpdir), "encoded.pkl")
+    dataset.save(pkl_path)
+    assert load_encoded_dataset(pkl_path)[1].tokens == dataset[1].tokens
+
+
+class _FakeModel(object):
+    """get_contextual_embeddings with 3 layers of dim 4 and one token per word."""
+
+    def __init__(self):
+        self.batches = []
+
+    def get_input_lengths(self, sentences_list):
+        return [len(" ".join(sentences).split()) for sentences in sentences_list]
+
+    def get_contextual_embeddings(self, sentences_list, layers=None, pooling=None):
+        self.batches.append(self.get_input_lengths(sentences_list))
+        tokenized = [" ".join(sentences).split() for sentences in sentences_list]
+        lengths = [len(tokens) for tokens in tokenized]
+        all_layers = []
+        for layer in range(3):
+            embeddings = torch.zeros(len(sentences_list), max(lengths), 4)
+            for i, tokens in enumerate(tokenized):
+                for j, token in enumerate(tokens):
+                    embeddings[i, j] = len(token) * (layer + 1) + j
+            all_layers.append(embeddings)
+        return pool_layers(all_layers, layers=layers, pooling=pooling), lengths, tokenized
+
+
+def test_pool_layers():
+    all_layers = [torch.randn(2, 3, 4) for _ in range(4)]
+    attention_mask = torch.tensor([[1, 1, 1], [1, 0, 0]])
+
+    assert [l.data_ptr() for l in pool_layers(all_layers, layers=2)] == [
+        l.data_ptr() for l in all_layers[-2:]
+    ]
+    [mean] = pool_layers(all_layers, layers=[0, 3], pooling="mean")
+    assert torch.allclose(mean, (all_layers[0] + all_layers[3]) / 2)
+    [mix] = pool_layers(all_layers, layers=[1, 2], pooling=[0.0, float("-inf")])
+    assert torch.allclose(mix, all_layers[1])
+    [tokens] = pool_layers(all_layers, attention_mask, layers=1, pooling="mean_tokens")
+    assert tokens.shape == (2, 4)
+    assert torch.allclose(tokens[0], all_layers[-1][0].mean(0))
+    assert torch.allclose(tokens[1], all_layers[-1][1, 0])
+
+
+def test_encode_to_shards(tmpdir, monkeypatch):
+    import argparse
+    import lama.build_encoded_dataset as build_encoded_dataset
+
+    monkeypatch.setattr(build_encoded_dataset, "build_model_by_name", lambda lm, args: _FakeModel())
+    args = argparse.Namespace(lm="fake", batch_size=3)
+    sentences = [["w " * (i % 5 + 1)] for i in range(11)]
+
+    in_memory = build_encoded_dataset.encode(args, sentences)
+    output_dir = os.path.join(str(tmpdir), "encoded")
+    streamed = build_encoded_dataset.encode(
+        args, iter(sentences), output_dir=output_dir, shard_size=4
+    )
+    assert sorted(d for d in os.listdir(output_dir) if d.startswith("shard_")) == [
+        "shard_00000", "shard_00001", "shard_00002"
+    ]
+    assert len(streamed) == len(in_memory) == 11
+    for i in range(11):
+        assert torch.equal(streamed[i].embedding, in_memory[i].embedding)
+        assert streamed[i].tokens == in_memory[i].tokens
+    # mean over the layers
+    assert torch.allclose(in_memory[0].embedding[0], torch.full((4,), 2.0))
+
+
+def test_sorted_encode_keeps_input_order(tmpdir, monkeypatch):
+    import argparse
+    import lama.build_encoded_dataset as build_encoded_dataset
+
+    model = _FakeModel()
+    monkeypatch.setattr(build_encoded_dataset, "build_model_by_name", lambda lm, args: model)
+    args = argparse.Namespace(lm="fake", batch_size=3)
+    sentences = [["w{} ".format(i) * (i * 7 % 5 + 1)] for i in range(11)]
+
+    in_order = build_encoded_dataset.encode(args, sentences)
+    model.batches = []
+    in_memory = build_encoded_dataset.encode(args, sentences, sort_input=True)
+    # batches of sentences of increasing length
+    lengths = [length for batch in model.batches for length in batch]
+    assert lengths == sorted(lengths)
+
+    output_dir = os.path.join(str(tmpdir), "encoded")
+    streamed = build_encoded_dataset.encode(
+        args, iter(sentences), sort_input=True, output_dir=output_dir, shard_size=4
+    )
+    for dataset in (in_memory, streamed):
+        assert len(dataset) == 11
+        for i in range(11):
+            assert dataset[i].tokens == sentences[i][0].split()
+            assert torch.equal(dataset[i].embedding, in_order[i].embedding)
+
+
+def test_bucketed_data_loader(tmpdir):
+    from lama.build_encoded_dataset import LengthBucketSampler, collate_encoded_sentences
+
+    encodings = []
+    for i in range(50):
+        length = i * 7 % 13 + 1
+        encodings.append((torch.full((length, 3), float(i)), length, [str(i)] * length))
+    path = os.path.join(str(tmpdir), "encoded")
+    EncodedDataset(encodings).save(path, dtype="float16")
+    dataset = load_encoded_dataset(path)
+    assert list(dataset.get_lengths()) == [e[1] for e in encodings]
+
+    sampler = LengthBucketSampler(dataset.get_lengths(), batch_size=4, bucket_size=20)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_sampler=sampler, collate_fn=collate_encoded_sentences, num_workers=2
+    )
+    assert len(loader) == 5 + 5 + 3
+    seen = []
+    for batch in loader:
+        assert batch.embeddings.dtype == torch.float16
+        assert batch.embeddings.shape[:2] == batch.mask.shape
+        assert (batch.mask.sum(dim=1) == batch.lengths).all()
+        for i, tokens in enumerate(batch.tokens):
+            idx = int(tokens[0])
+            seen.append(idx)
+            assert (batch.embeddings[i][batch.mask[i]] == idx).all()
+            assert (batch.embeddings[i][~batch.mask[i]] == 0).all()
+    assert sorted(seen) == list(range(50))
+
+    # within a bucket, batches are sorted by length
+    sampler = LengthBucketSampler(dataset.get_lengths(), batch_size=4, bucket_size=50, shuffle=False)
+    lengths = [encodings[i][1] for batch in sampler for i in batch]
+    assert lengths == sorted(lengths)
@@ -0,0 +1,96 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import pytest
+from conftest import STUB_RELATIONS, StubConnector
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class _CountingConnector(StubConnector):
+    """StubConnector that counts its batches and raises at batch interrupt_at."""
+
+    def __init__(self, interrupt_at=None):
+        super().__init__()
+        self.interrupt_at = interrupt_at
+        self.num_batches = 0
+
+    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+        if self.num_batches == self.interrupt_at:
+            raise _Interrupted()
+        self.num_batches += 1
+        return super().get_batch_generation(sentences_list, logger=logger, try_cuda=try_cuda)
+
+
+def _interrupted_run(main, args, rel_id, k):
+    with pytest.raises(_Interrupted):
+        main(args, rel_id, model=_CountingConnector(interrupt_at=k))
+
+
+def test_resume_equals_uninterrupted_run(stub_relations):
+    from batch_eval_KB_completion import main, load_finished_results
+
+    relation = STUB_RELATIONS[1]
+    rel_id = relation["relation"]
+    uninterrupted = _CountingConnector()
+    expected = main(stub_relations(relation, label="uninterrupted"), rel_id, model=uninterrupted)
+    num_batches = uninterrupted.num_batches
+    assert num_batches >= 3
+
+    args = stub_relations(relation, label="interrupted", checkpoint_interval=1)
+    _interrupted_run(main, args, rel_id, 2)
+    args.resume = True
+    resumed = _CountingConnector()
+    assert main(args, rel_id, model=resumed) == pytest.approx(expected)
+    # only the batches after the checkpoint were evaluated
+    assert resumed.num_batches == num_batches - 2
+
+    # finished: nothing to evaluate, the model is not used
+    assert main(args, rel_id, model=_CountingConnector(interrupt_at=0)) == pytest.approx(expected)
+    [metrics] = load_finished_results(args.full_logdir, args.dataset_filename).values()
+    assert metrics.get_results() == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("change", ["dataset", "batch_size", "common_vocab"])
+def test_resume_with_another_fingerprint(stub_relations, change):
+    from batch_eval_KB_completion import get_evaluation_fingerprint, load_finished_results, main
+
+    relation = STUB_RELATIONS[1]
+    rel_id = relation["relation"]
+    args = stub_relations(relation, checkpoint_interval=1)
+    main(args, rel_id, model=StubConnector())
+    _interrupted_run(main, stub_relations(relation, label="interrupted", checkpoint_interval=1), rel_id, 2)
+
+    if change == "dataset":
+        os.utime(args.dataset_filename, ns=(0, 0))
+    elif change == "batch_size":
+        args.batch_size = 2
+    else:
+        with open(args.common_vocab_filename, "a") as f:
+            f.write("o7\n")
+    args.resume = True
+    uninterrupted = _CountingConnector()
+    expected = main(
+        stub_relations(relation, label="uninterrupted", batch_size=args.batch_size), rel_id, model=uninterrupted
+    )
+
+    # the finished checkpoint is discarded
+    fingerprint = get_evaluation_fingerprint([args])
+    assert load_finished_results(args.full_logdir, args.dataset_filename, fingerprint=fingerprint) is None
+    model = _CountingConnector()
+    assert main(args, rel_id, model=model) == pytest.approx(expected)
+    assert model.num_batches == uninterrupted.num_batches
+
+    # the interrupted one too: the evaluation starts from scratch
+    args = stub_relations(
+        relation, label="interrupted", checkpoint_interval=1, batch_size=args.batch_size, resume=True
+    )
+    model = _CountingConnector()
+    assert main(args, rel_id, model=model) == pytest.approx(expected)
+    assert model.num_batches == uninterrupted.num_batches
@@ -0,0 +1,150 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import csv
+import json
+import argparse
+import collections
+import pytest
+from conftest import STUB_OBJECTS, STUB_RELATIONS, StubConnector
+
+TEMPLATES = {
+    "a": STUB_RELATIONS,
+    "b": [
+        {"relation": "P1", "template": "[X] lives in the [Y] ."},
+        {"relation": "P2", "template": "[X] works for [Y] ."},
+    ],
+}
+
+
+@pytest.fixture
+def grid_spec(stub_relations, tmpdir, monkeypatch):
+    """A grid of two stub models x TEMPLATES x the dev and test splits of
+    STUB_RELATIONS, run in tmpdir."""
+    stub_relations(STUB_RELATIONS[0])
+    data_dir = os.path.join(str(tmpdir), "data")
+    for relation in STUB_RELATIONS:
+        # dev: the first samples of test
+        with open(os.path.join(data_dir, relation["relation"], "test.jsonl")) as f:
+            lines = f.readlines()
+        with open(os.path.join(data_dir, relation["relation"], "dev.jsonl"), "w") as f:
+            f.writelines(lines[:8])
+
+    templates = {}
+    for label, relations in TEMPLATES.items():
+        templates[label] = os.path.join(str(tmpdir), "templates_{}.jsonl".format(label))
+        with open(templates[label], "w") as f:
+            f.writelines(json.dumps(relation) + "\n" for relation in relations)
+
+    monkeypatch.chdir(str(tmpdir))
+    return {
+        "models": [
+            {
+                "label": label,
+                "models_names": ["stub"],
+                "common_vocab_filename": os.path.join(str(tmpdir), "common_vocab.txt"),
+                "batch_size": 4,
+                "threads": 1,
+                "checkpoint_interval": 0,
+            }
+            for label in ["stub_a", "stub_b"]
+        ],
+        "relations_filename": templates["a"],
+        "relations": None,
+        "splits": ["dev", "test"],
+        "templates": templates,
+        "data_path_pre": data_dir,
+        "multi_relation": True,
+        "num_workers": 1,
+        "threads_per_worker": None,
+        "share_model": False,
+        "resume": False,
+        "results_filename": os.path.join(str(tmpdir), "grid_results.csv"),
+    }
+
+
+class _CountingCache(object):
+    """Counts the calls and the misses of the methods of an EvaluationCache."""
+
+    def __init__(self, cache_class):
+        self.calls = collections.Counter()
+        self.misses = collections.Counter()
+        counter = self
+
+        class CountingCache(cache_class):
+            def load_file(self, filename):
+                counter.count("load_file", filename not in self._files)
+                return super().load_file(filename)
+
+            def init_vocab_subset(self, model, common_vocab_filename, logger=None):
+                counter.count("init_vocab_subset", common_vocab_filename not in self._entries(model)["vocab_subsets"])
+                return super().init_vocab_subset(model, common_vocab_filename, logger)
+
+            def get_id(self, model, string):
+                counter.count("get_id", string not in self._entries(model)["ids"])
+                return super().get_id(model, string)
+
+        self.cache_class = CountingCache
+
+    def count(self, method, miss):
+        self.calls[method] += 1
+        if miss:
+            self.misses[method] += 1
+
+
+@pytest.mark.parametrize("multi_relation", [False, True])
+def test_run_experiment_grid(grid_spec, monkeypatch, multi_relation):
+    import run_experiments
+
+    loads = collections.Counter()
+
+    def build_model_by_name(lm, args, background_weights=False):
+        loads[args.label] += 1
+        return StubConnector()
+
+    counting = _CountingCache(run_experiments.EvaluationCache)
+    monkeypatch.setattr(run_experiments, "build_model_by_name", build_model_by_name)
+    monkeypatch.setattr(run_experiments, "EvaluationCache", counting.cache_class)
+
+    grid_spec["multi_relation"] = multi_relation
+    grid_metrics = run_experiments.run_experiment_grid(grid_spec)
+
+    # each model is loaded once for its 8 cells
+    assert loads == {"stub_a": 1, "stub_b": 1}
+    # each dataset file is read once for the whole grid
+    assert counting.misses["load_file"] == 4
+    assert counting.calls["load_file"] == 16
+    # the vocab subset and the labels are computed once per model
+    assert counting.misses["init_vocab_subset"] == 2
+    assert counting.calls["init_vocab_subset"] == (8 if multi_relation else 16)
+    assert counting.misses["get_id"] <= 2 * len(STUB_OBJECTS)
+    assert counting.calls["get_id"] > 4 * counting.misses["get_id"]
+
+    # a single table with a row for each cell, equal to the cell evaluated
+    # alone without cache
+    with open(grid_spec["results_filename"]) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 16
+    for row in rows:
+        [relation] = [r for r in TEMPLATES[row["template"]] if r["relation"] == row["relation"]]
+        input_param = [p for p in grid_spec["models"] if p["label"] == row["model"]][0]
+        args = run_experiments.get_relation_parameters(
+            relation, grid_spec["data_path_pre"], "{}.jsonl".format(row["split"]), input_param
+        )
+        args["full_logdir"] = os.path.join("expected", row["model"], row["template"], row["split"])
+        [((MRR, Precision, Precision1, _), num_samples)] = run_experiments.evaluate_relations(
+            StubConnector(), [(relation, argparse.Namespace(**args))], False, None
+        ).values()
+        assert int(row["num_samples"]) == num_samples
+        assert float(row["mrr"]) == round(MRR * 100.0, 2)
+        assert float(row["p1"]) == round(Precision1 * 100.0, 2)
+        metrics = grid_metrics[(row["model"], row["template"])][row["relation"]][row["split"]]
+        assert metrics == {
+            "mrr": round(MRR * 100.0, 2),
+            "p10": round(Precision * 100.0, 2),
+            "p1": round(Precision1 * 100.0, 2),
+        }
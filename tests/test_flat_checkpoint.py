@@ -0,0 +1,97 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import json
+import threading
+import pytest
+import torch
+from conftest import TINY_BERT_WORDS
+from lama.modules.flat_checkpoint import (
+    save_flat_checkpoint, load_flat_state_dict, load_flat_config, map_flat_weights, is_flat_checkpoint,
+    load_flat_model,
+)
+
+
+class _TiedModel(torch.nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.embeddings = torch.nn.Embedding(10, 4)
+        self.norm = torch.nn.BatchNorm1d(4)
+        self.output = torch.nn.Linear(4, 10, bias=False)
+        self.output.weight = self.embeddings.weight
+
+
+def test_save_and_map(tmpdir):
+    path = str(tmpdir)
+    model = _TiedModel()
+    model.norm.running_mean.fill_(0.5)
+    save_flat_checkpoint(path, model.state_dict(), {"size": 4})
+    assert is_flat_checkpoint(path) and load_flat_config(path) == {"size": 4}
+
+    state_dict = load_flat_state_dict(path)
+    assert list(state_dict) == list(model.state_dict())
+    # tied weights are stored once
+    assert state_dict["output.weight"].data_ptr() == state_dict["embeddings.weight"].data_ptr()
+    with open(os.path.join(path, "weights.json")) as f:
+        assert json.load(f)["aliases"] == {"output.weight": "embeddings.weight"}
+
+    other = map_flat_weights(_TiedModel(), path)
+    assert other.output.weight is other.embeddings.weight
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(other.state_dict()[name], tensor)
+
+    with pytest.raises(ValueError):
+        map_flat_weights(torch.nn.Linear(4, 10), path)
+
+
+def test_load_flat_model_in_background(tmpdir):
+    path = str(tmpdir)
+    model = _TiedModel()
+    save_flat_checkpoint(path, model.state_dict())
+
+    building = threading.Event()
+    built = threading.Event()
+
+    def build_model():
+        building.set()
+        built.wait()
+        return _TiedModel()
+
+    loaded = []
+    thread = threading.Thread(target=lambda: loaded.append(load_flat_model(build_model, path)))
+    thread.start()
+    building.wait()
+    try:
+        # the modules built meanwhile by this thread are initialized as usual
+        linear = torch.nn.Linear(4, 4)
+        assert linear.weight.device.type == "cpu"
+        assert linear.weight.abs().sum() > 0
+        assert torch.nn.init.ones_(torch.zeros(2)).tolist() == [1.0, 1.0]
+    finally:
+        built.set()
+        thread.join()
+
+    [other] = loaded
+    assert other.output.weight is other.embeddings.weight
+    for name, tensor in model.state_dict().items():
+        assert other.state_dict()[name].device.type == "cpu"
+        assert torch.equal(other.state_dict()[name], tensor)
+
+
+@pytest.mark.parametrize("background_weights", [False, True])
+def test_bert_from_flat_checkpoint(tiny_bert, background_weights):
+    loaded = tiny_bert(background_weights=background_weights)
+    assert loaded.tokenizer.basic_tokenizer.do_lower_case
+    assert loaded.vocab == TINY_BERT_WORDS
+    assert loaded.get_id("w0 w1") == [6, 7]
+
+    tokens = torch.tensor([[2, 6, 4, 8, 3]])
+    loaded.wait_for_weights()
+    with torch.no_grad():
+        expected = tiny_bert.original.masked_bert_model(tokens)
+        actual = loaded.masked_bert_model(tokens)
+    assert torch.allclose(expected, actual)
@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKENDS = ["pytorch_pretrained_bert", "allennlp", "fairseq", "h5py"]
+
+
+def _import_in_subprocess(statement):
+    """Run statement in a fresh interpreter, returns the time it took and
+    the backends it imported."""
+    code = (
+        "import json, sys, time\n"
+        "start = time.perf_counter()\n"
+        "{}\n"
+        "elapsed = time.perf_counter() - start\n"
+        "print(json.dumps([elapsed, [m for m in {} if m in sys.modules]]))\n"
+    ).format(statement, BACKENDS)
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT)
+    )
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("statement", [
+    "import lama.modules",
+    "from lama.modules import build_model_by_name",
+    "import lama.build_encoded_dataset",
+])
+def test_no_backend_imported(statement):
+    elapsed, backends = _import_in_subprocess(statement)
+    print("{}: {:.3f}s".format(statement, elapsed))
+    assert backends == []
+
+
+def test_connectors_are_resolved_lazily():
+    import lama.modules as modules
+
+    with pytest.raises(ValueError):
+        modules.get_connector_class("unknown")
+    with pytest.raises(AttributeError):
+        modules.Unknown
+    assert "Bert" in dir(modules)
+    pytest.importorskip("pytorch_pretrained_bert")
+    assert modules.get_connector_class("bert") is modules.Bert
+    assert modules.Bert.__module__ == "lama.modules.bert_connector"
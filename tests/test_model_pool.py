@@ -0,0 +1,98 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import argparse
+import pytest
+import torch
+from lama.modules.model_pool import ModelPool, get_model_pool, model_key, model_memory_size
+
+
+class _FakeConnector(object):
+    def __init__(self, size):
+        # size float32 weights, tied with a second module
+        self.embeddings = torch.nn.Embedding(size, 1)
+        self.output = torch.nn.Linear(1, size, bias=False)
+        self.output.weight = self.embeddings.weight
+
+    def _torch_modules(self):
+        return [self.embeddings, self.output]
+
+
+def _args(name, **kwargs):
+    return argparse.Namespace(bert_model_name=name, max_sentence_length=100, **kwargs)
+
+
+def _pool(max_memory):
+    built = []
+
+    def build_model(lm, args):
+        built.append(args.bert_model_name)
+        return _FakeConnector(int(args.bert_model_name[1:]))
+
+    return ModelPool(max_memory, build_model), built
+
+
+def test_model_key():
+    assert model_key("bert", _args("b", text="a")) == model_key("bert", _args("b", text="b"))
+    assert model_key("bert", _args("b")) != model_key("bert", _args("c"))
+    assert model_memory_size(_FakeConnector(10)) == 40
+
+
+def test_reuse_and_refcounts():
+    pool, built = _pool(max_memory=None)
+    a = pool.acquire("bert", _args("m10"))
+    with pool.model("bert", _args("m10")) as b:
+        assert b is a
+    assert built == ["m10"]
+    pool.release(a)
+    with pytest.raises(ValueError):
+        pool.release(a)
+    # no budget: idle models stay loaded
+    with pool.model("bert", _args("m20")):
+        pass
+    assert len(pool) == 2 and pool.memory_in_use == 120
+    pool.clear()
+    assert len(pool) == 0
+
+
+def test_lru_eviction():
+    # 4 bytes per weight: room for two of m10, m11 and m12
+    pool, built = _pool(max_memory=100)
+    for name in ["m10", "m11", "m10"]:
+        with pool.model("bert", _args(name)):
+            pass
+    # m11 is the least recently used: evicted before loading m12
+    with pool.model("bert", _args("m12")):
+        pass
+    assert built == ["m10", "m11", "m12"]
+    assert model_key("bert", _args("m10")) in pool
+    assert model_key("bert", _args("m11")) not in pool
+    assert pool.memory_in_use == 88
+
+    # models in use are not evicted, even over budget
+    in_use = [pool.acquire("bert", _args(name)) for name in ["m20", "m21"]]
+    assert pool.memory_in_use == 164
+    for model in in_use:
+        pool.release(model)
+    assert pool.memory_in_use <= 100
+    assert model_key("bert", _args("m21")) in pool
+
+
+def test_set_max_memory():
+    pool, built = _pool(max_memory=None)
+    for name in ["m10", "m11", "m12"]:
+        with pool.model("bert", _args(name)):
+            pass
+    assert pool.memory_in_use == 132
+    pool.set_max_memory(90)
+    assert pool.max_memory == 90
+    assert pool.memory_in_use == 48
+    assert model_key("bert", _args("m12")) in pool
+
+    # the pool of the process is not changed by getting it
+    max_memory = get_model_pool().max_memory
+    assert get_model_pool() is get_model_pool()
+    assert get_model_pool().max_memory == max_memory
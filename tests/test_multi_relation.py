@@ -0,0 +1,36 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import pytest
+from conftest import STUB_RELATIONS, StubConnector
+
+
+def test_multi_relation_equals_single_relation(stub_relations, tmpdir):
+    from batch_eval_KB_completion import main, main_multi_relation, load_finished_results
+
+    model = StubConnector()
+    single = {}
+    for relation in STUB_RELATIONS:
+        args = stub_relations(relation, checkpoint_interval=1)
+        results = main(args, relation["relation"], shuffle_data=False, model=model)
+        [metrics] = load_finished_results(args.full_logdir, args.dataset_filename).values()
+        assert metrics.get_results() == pytest.approx(results)
+        single[relation["relation"]] = (results, metrics.num_results)
+
+    args_list = [stub_relations(relation) for relation in STUB_RELATIONS]
+    relation_metrics = main_multi_relation(
+        args_list,
+        [relation["relation"] for relation in STUB_RELATIONS],
+        model=model,
+        log_directory=os.path.join(str(tmpdir), "multi"),
+        shuffle_data=False,
+    )
+    for rel_id, (results, num_samples) in single.items():
+        assert num_samples > 0
+        assert relation_metrics[rel_id].num_results == num_samples
+        # MRR, P@10, P@1, P@1 RE
+        assert relation_metrics[rel_id].get_results() == pytest.approx(results)
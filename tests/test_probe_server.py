@@ -0,0 +1,126 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from multiprocessing.pool import ThreadPool
+import pytest
+import torch
+from lama.modules.base_connector import Base_Connector, MASK
+from lama.probe_server import ProbeServer
+
+
+class _EchoConnector(Base_Connector):
+    """Predicts the first word of the sentence at the mask."""
+
+    def __init__(self):
+        super().__init__()
+        self.vocab = [MASK, "a", "b", "c", "d"]
+        self._init_inverse_vocab()
+        self.batch_sizes = []
+
+    def get_batch_generation(self, sentences_list, logger=None, try_cuda=True):
+        self.batch_sizes.append(len(sentences_list))
+        time.sleep(0.05)
+        token_ids_list = [
+            [self.inverse_vocab[word] for word in sentences[0].split()] for sentences in sentences_list
+        ]
+        length = max(len(token_ids) for token_ids in token_ids_list)
+        log_probs = torch.full([len(sentences_list), length, len(self.vocab)], -10.0)
+        masked_indices_list = []
+        for i, token_ids in enumerate(token_ids_list):
+            log_probs[i, torch.arange(len(token_ids)), token_ids] = -0.5
+            masked_index = token_ids.index(0)
+            log_probs[i, masked_index, token_ids[0]] = -0.1
+            masked_indices_list.append([masked_index])
+        return log_probs, token_ids_list, masked_indices_list
+
+
+@pytest.fixture
+def server():
+    model = _EchoConnector()
+    server = ProbeServer(("localhost", 0), {"echo": model}, max_batch_size=4, max_wait=0.02, topk=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.close()
+
+
+def _post(server, probe):
+    request = urllib.request.Request(
+        "http://localhost:{}/probe".format(server.server_address[1]),
+        data=json.dumps(probe).encode("utf-8"),
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def test_micro_batching(server):
+    words = ["a", "b", "c", "d"] * 3
+    probes = [{"sentences": ["{} b {} c".format(word, MASK)]} for word in words]
+    with ThreadPool(len(probes)) as pool:
+        results = pool.map(lambda probe: _post(server, probe), probes)
+
+    for word, result in zip(words, results):
+        assert result["model"] == "echo"
+        assert result["masked_indices"] == [2]
+        [predictions] = result["predictions"]
+        assert len(predictions) == 2
+        assert predictions[0]["token"] == word
+        assert predictions[0]["log_prob"] == pytest.approx(-0.1)
+        # [MASK] is a special symbol: the three other tokens count
+        assert result["perplexity"] == pytest.approx(float(torch.tensor(0.5).exp()))
+
+    model = server.batchers["echo"].model
+    assert sum(model.batch_sizes) == len(probes)
+    assert max(model.batch_sizes) <= 4
+    assert len(model.batch_sizes) < len(probes)
+
+    with urllib.request.urlopen(
+        "http://localhost:{}/stats".format(server.server_address[1]), timeout=10
+    ) as response:
+        stats = json.loads(response.read().decode("utf-8"))
+    assert stats == {"echo": {"requests": len(probes), "batches": len(model.batch_sizes)}}
+
+
+def test_bad_probes(server):
+    for probe in [{"sentences": ["a [MASK]"], "model": "other"}, {"text": "a [MASK]"},
+                  {"sentences": ["a", "b", "c"]}]:
+        with pytest.raises(urllib.error.HTTPError) as e:
+            _post(server, probe)
+        assert e.value.code == 400
+    # the model fails on a word out of the vocabulary
+    with pytest.raises(urllib.error.HTTPError) as e:
+        _post(server, {"sentences": "e [MASK]"})
+    assert e.value.code == 500
+    assert "KeyError" in json.loads(e.value.read().decode("utf-8"))["error"]
+
+
+def test_bad_probe_in_a_batch(server):
+    words = ["a", "e", "b", "c", "e", "d", "a", "b"]
+    probes = [{"sentences": ["{} b {} c".format(word, MASK)]} for word in words]
+
+    def post(probe):
+        try:
+            return _post(server, probe)
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    with ThreadPool(len(probes)) as pool:
+        results = pool.map(post, probes)
+
+    # only the probes with a word out of the vocabulary fail
+    for word, result in zip(words, results):
+        if word == "e":
+            assert result == 500
+        else:
+            [predictions] = result["predictions"]
+            assert predictions[0]["token"] == word
+    model = server.batchers["echo"].model
+    assert max(model.batch_sizes) > 1
@@ -0,0 +1,55 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import pytest
+import torch
+from lama.modules.base_connector import Base_Connector, quantize_linear_layers
+
+pytestmark = pytest.mark.skipif(
+    not hasattr(torch, "quantization")
+    or not {"fbgemm", "qnnpack"} & set(torch.backends.quantized.supported_engines),
+    reason="no quantized engine",
+)
+
+
+def test_quantize_linear_layers():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(16, 32), torch.nn.ReLU(), torch.nn.Linear(32, 8))
+    x = torch.randn(4, 16)
+    expected = model(x)
+    quantized = quantize_linear_layers(model)
+    assert quantized is model
+    assert type(model[0]) is not torch.nn.Linear
+    assert torch.allclose(quantized(x), expected, atol=0.05)
+
+    # a module that is a Linear layer is replaced, not changed in place
+    linear = torch.nn.Linear(16, 8)
+    assert type(quantize_linear_layers(linear)) is not torch.nn.Linear
+
+    connector = Base_Connector()
+    assert connector._quantize(linear) is linear
+    connector.quantized = True
+    connector.try_cuda()
+    assert connector._model_device == "cpu"
+
+
+def test_gpt_conv1d_to_linear():
+    pytest.importorskip("pytorch_pretrained_bert")
+    from pytorch_pretrained_bert import OpenAIGPTConfig, OpenAIGPTLMHeadModel
+    from lama.modules.gpt_connector import _conv1d_to_linear
+
+    config = OpenAIGPTConfig(
+        vocab_size_or_config_json_file=50, n_positions=16, n_ctx=16, n_embd=16, n_layer=2, n_head=2
+    )
+    model = OpenAIGPTLMHeadModel(config).eval()
+    tokens = torch.tensor([[1, 5, 7, 3]])
+    with torch.no_grad():
+        expected = model(tokens)
+        _conv1d_to_linear(model)
+        assert isinstance(model.transformer.h[0].attn.c_attn, torch.nn.Linear)
+        assert torch.allclose(model(tokens), expected, atol=1e-5)
+        quantize_linear_layers(model)
+        assert (model(tokens).argmax(-1) == expected.argmax(-1)).float().mean() >= 0.75
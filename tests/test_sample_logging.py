@@ -0,0 +1,51 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import re
+import json
+from conftest import STUB_RELATIONS, StubConnector
+
+
+def _count_formatted_messages(monkeypatch):
+    import batch_eval_KB_completion
+
+    formatted = []
+    message_str = batch_eval_KB_completion.SampleMessage.__str__
+
+    def counted_str(message):
+        formatted.append(message)
+        return message_str(message)
+
+    monkeypatch.setattr(batch_eval_KB_completion.SampleMessage, "__str__", counted_str)
+    return formatted
+
+
+def test_sample_messages_are_formatted_when_written(stub_relations, monkeypatch):
+    from batch_eval_KB_completion import main
+
+    formatted = _count_formatted_messages(monkeypatch)
+    relation = STUB_RELATIONS[1]
+    args = stub_relations(relation, log_sample_rate=0.5)
+    main(args, relation["relation"], shuffle_data=False, model=StubConnector())
+
+    # only the messages of the sampled records are formatted
+    with open(os.path.join(args.full_logdir, "info.log")) as f:
+        log = f.read()
+    num_written = log.count("| Top10 predictions")
+    num_samples = int(re.search(r"list_of_results: (\d+)", log).group(1))
+    assert 0 < len(formatted) == num_written < num_samples
+    top1 = formatted[0].experiment_result["topk"][0]
+    assert "{:<8d}{:<20s}{:<12.3f}\n".format(0, top1["token_word_form"], top1["log_prob"]) in log
+
+    # the jsonl log writes a record for each sample, without its message
+    del formatted[:]
+    args = stub_relations(relation, log_format="jsonl", full_logdir=os.path.join(args.logdir, "jsonl"))
+    main(args, relation["relation"], shuffle_data=False, model=StubConnector())
+    with open(os.path.join(args.full_logdir, "events.jsonl")) as f:
+        events = [json.loads(line)["event"] for line in f]
+    assert events.count("sample") == num_samples
+    assert formatted == []
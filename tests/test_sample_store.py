@@ -0,0 +1,55 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import numpy as np
+from lama.sample_store import SampleStore, load_samples
+
+
+def _element(uuid, label_id, rank):
+    topk = [
+        {"i": i, "token_idx": 100 + i, "log_prob": -float(i), "token_word_form": str(i)}
+        for i in range(3)
+    ]
+    return {
+        "sample": {"relation_id": "P19"},
+        "uuid": uuid,
+        "label_index": [label_id],
+        "sample_MRR": 1.0 / rank if rank > 0 else 0.0,
+        "masked_topk": {"topk": topk, "PERPLEXITY": -1.5},
+    }
+
+
+def test_append_and_load(tmpdir):
+    filename = os.path.join(str(tmpdir), "samples_test.bin")
+    store = SampleStore(filename, topk=5)
+    store.append([_element("a", 100, 1), _element("b", 7, 0)])
+    store.append([_element("c", 101, 2)], negated_results=[(1, 0.5, "")])
+    assert len(store) == 3
+    store.close()
+
+    samples = load_samples(filename)
+    assert samples["uuid"].tolist() == [b"a", b"b", b"c"]
+    assert samples["relation"].tolist() == [b"P19"] * 3
+    assert samples["gold_rank"].tolist() == [1, -1, 2]
+    assert samples["topk_ids"][0].tolist() == [100, 101, 102, -1, -1]
+    assert np.isneginf(samples["topk_log_probs"][0, 3])
+    assert np.isnan(samples["spearman"][0]) and samples["spearman"][2] == 0.5
+
+
+def test_truncate_on_reopen(tmpdir):
+    filename = os.path.join(str(tmpdir), "samples_test.bin")
+    store = SampleStore(filename, topk=2)
+    store.append([_element(str(i), 100, 1) for i in range(4)])
+    store.close()
+
+    # e.g., resume from a checkpoint taken after the first two samples
+    store = SampleStore(filename, topk=2)
+    assert len(store) == 4
+    store.truncate(2)
+    store.append([_element("x", 100, 1)])
+    store.close()
+    assert load_samples(filename)["uuid"].tolist() == [b"0", b"1", b"x"]
@@ -0,0 +1,73 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import numpy as np
+import torch
+from lama.score_store import ScoreStore, load_scores, get_ranks
+
+VOCAB_SIZE = 50
+
+
+def _elements(num_samples, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    elements = []
+    for i in range(num_samples):
+        log_probs = torch.log_softmax(torch.randn(VOCAB_SIZE, generator=generator), dim=0)
+        elements.append({
+            "sample": {"relation_id": "P{}".format(i % 2)},
+            "uuid": i,
+            "label_index": [i % VOCAB_SIZE],
+            "masked_log_probs": log_probs,
+        })
+    return elements
+
+
+def _brute_force_ranks(elements, vocab_mask):
+    ranks = []
+    for element in elements:
+        log_probs = element["masked_log_probs"].numpy()
+        gold = log_probs[element["label_index"][0]]
+        ranks.append(1 + int(((log_probs > gold) & vocab_mask).sum()))
+    return np.array(ranks)
+
+
+def test_full_vocab_ranks(tmpdir):
+    vocab = ["w{}".format(i) for i in range(VOCAB_SIZE)]
+    filename = os.path.join(str(tmpdir), "scores_test.bin")
+    elements = _elements(20)
+    store = ScoreStore(filename, vocab, topn=0)
+    store.append(elements[:7])
+    store.append(elements[7:])
+    store.close()
+
+    header, records = load_scores(filename)
+    assert header["full_vocab"] and len(records) == 20
+    vocab_mask = np.arange(VOCAB_SIZE) % 3 != 0
+    ranks, exact = get_ranks(header, records, vocab_mask, chunk_size=6)
+    assert exact.all()
+    assert (ranks == _brute_force_ranks(elements, vocab_mask)).all()
+
+
+def test_topn_ranks_and_tail(tmpdir):
+    vocab = ["w{}".format(i) for i in range(VOCAB_SIZE)]
+    filename = os.path.join(str(tmpdir), "scores_test.bin")
+    elements = _elements(20, seed=1)
+    store = ScoreStore(filename, vocab, topn=10)
+    store.append(elements)
+    store.close()
+
+    header, records = load_scores(filename)
+    # top-N and tail sum up to the whole probability mass
+    total = np.logaddexp(np.logaddexp.reduce(records["log_probs"], axis=1), records["tail"])
+    assert np.allclose(total, 0.0, atol=1e-4)
+
+    vocab_mask = np.ones(VOCAB_SIZE, dtype=bool)
+    ranks, exact = get_ranks(header, records, vocab_mask)
+    expected = _brute_force_ranks(elements, vocab_mask)
+    assert (ranks[exact] == expected[exact]).all()
+    assert (ranks[~exact] <= expected[~exact]).all()
+    assert (expected[exact] <= 10).all() and (expected[~exact] > 10).all()
@@ -0,0 +1,131 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import json
+import uuid
+import argparse
+import pytest
+from conftest import STUB_RELATIONS, TINY_BERT_WORDS, StubConnector, build_stub_model
+
+
+def build_counted_stub_model(lm, args):
+    # one file for each model loaded
+    loads_directory = os.path.join(args.logdir, "loads")
+    os.makedirs(loads_directory, exist_ok=True)
+    open(os.path.join(loads_directory, uuid.uuid4().hex), "w").close()
+    return StubConnector()
+
+
+def _assert_same_results(results, expected):
+    assert sorted(results) == sorted(expected)
+    for rel_id, (metrics, num_samples) in expected.items():
+        assert results[rel_id][1] == num_samples
+        assert results[rel_id][0] == pytest.approx(metrics)
+
+
+@pytest.mark.parametrize("multi_relation", [False, True])
+@pytest.mark.parametrize("share_model", [False, True])
+def test_run_sharded_evaluation(stub_relations, tmpdir, share_model, multi_relation):
+    from run_experiments import evaluate_relations, run_sharded_evaluation
+
+    relations_to_evaluate = [(relation, stub_relations(relation)) for relation in STUB_RELATIONS]
+    expected = evaluate_relations(
+        StubConnector(), relations_to_evaluate, multi_relation, os.path.join(str(tmpdir), "single")
+    )
+    results = run_sharded_evaluation(
+        relations_to_evaluate, 2, 1, multi_relation, os.path.join(str(tmpdir), "sharded"),
+        share_model=share_model, build_model=build_stub_model,
+    )
+    _assert_same_results(results, expected)
+
+
+@pytest.mark.parametrize("share_model", [False, True])
+def test_sharded_evaluator_loads_model_once(stub_relations, tmpdir, share_model):
+    from run_experiments import ShardedEvaluator, evaluate_relations
+
+    relations_to_evaluate = [(relation, stub_relations(relation)) for relation in STUB_RELATIONS]
+    expected = evaluate_relations(
+        StubConnector(), relations_to_evaluate, False, os.path.join(str(tmpdir), "single")
+    )
+
+    with ShardedEvaluator(2, 1, share_model=share_model, build_model=build_counted_stub_model) as evaluator:
+        for cell in ["a", "b"]:
+            relations_to_evaluate = [
+                (relation, stub_relations(relation, label=cell)) for relation in STUB_RELATIONS
+            ]
+            results = evaluator.evaluate(relations_to_evaluate, False, os.path.join(str(tmpdir), cell))
+            _assert_same_results(results, expected)
+
+    # once for all the cells: by each worker, or by this process if shared
+    num_loads = len(os.listdir(os.path.join(str(tmpdir), "output", "loads")))
+    assert num_loads == 1 if share_model else 1 <= num_loads <= 2
+
+
+def test_shared_bert_weights(tiny_bert, tmpdir):
+    from run_experiments import ShardedEvaluator, evaluate_relations, get_relation_parameters
+
+    # relations over the words of the tiny BERT; the metrics rank the top
+    # 10000 predictions: the vocabularies are larger
+    fillers = ["f{}".format(i) for i in range(10000)]
+    data_dir = os.path.join(str(tmpdir), "data")
+    relations = [
+        {"relation": "P1", "template": "[X] w1 [Y] ."},
+        {"relation": "P2", "template": "[X] w2 w3 [Y] ."},
+    ]
+    for n, relation in enumerate(relations):
+        os.makedirs(os.path.join(data_dir, relation["relation"]))
+        with open(os.path.join(data_dir, relation["relation"], "test.jsonl"), "w") as f:
+            for i in range(12):
+                f.write(json.dumps({
+                    "sub_label": "w{}".format(10 + i),
+                    "obj_label": "w{}".format(30 + (3 * i + n) % 8),
+                    "sub_uri": "Q{}".format(i),
+                    "obj_uri": "Q{}".format(100 + i),
+                }) + "\n")
+    vocab_filename = os.path.join(str(tmpdir), "common_vocab.txt")
+    with open(vocab_filename, "w") as f:
+        f.write("\n".join(TINY_BERT_WORDS[-20:] + fillers) + "\n")
+
+    def relation_args(relation, label):
+        args = get_relation_parameters(relation, data_dir, "test.jsonl", {
+            "label": label,
+            "models_names": ["bert"],
+            "bert_model_name": "bert-base-cased",
+            "bert_model_dir": None,
+            "common_vocab_filename": vocab_filename,
+            "batch_size": 4,
+            "threads": 1,
+            "checkpoint_interval": 0,
+            "logdir": os.path.join(str(tmpdir), "output"),
+        })
+        args["full_logdir"] = os.path.join(str(tmpdir), "output", label, relation["relation"])
+        return argparse.Namespace(**args)
+
+    models = []
+
+    def build_model(lm, args):
+        # only called in this process: the forked workers use its model
+        models.append(tiny_bert(words=TINY_BERT_WORDS + fillers))
+        return models[-1]
+
+    relations_to_evaluate = [(relation, relation_args(relation, "sharded")) for relation in relations]
+    with ShardedEvaluator(2, 1, share_model=True, build_model=build_model) as evaluator:
+        results = evaluator.evaluate(relations_to_evaluate, False, os.path.join(str(tmpdir), "sharded"))
+        [model] = models
+        parameters = list(model.masked_bert_model.parameters())
+        assert parameters and all(parameter.is_shared() for parameter in parameters)
+        # a second cell runs on the same workers, without loading the model
+        again = evaluator.evaluate(relations_to_evaluate, False, os.path.join(str(tmpdir), "again"))
+    assert len(models) == 1
+
+    relations_to_evaluate = [(relation, relation_args(relation, "single")) for relation in relations]
+    expected = evaluate_relations(
+        tiny_bert(words=TINY_BERT_WORDS + fillers), relations_to_evaluate, False, os.path.join(str(tmpdir), "single")
+    )
+    assert all(num_samples > 0 for _, num_samples in expected.values())
+    _assert_same_results(results, expected)
+    _assert_same_results(again, expected)
@@ -0,0 +1,166 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import os
+import time
+import multiprocessing
+import pytest
+from lama.task_queue import TaskQueue, PENDING, CLAIMED, DONE
+
+NUM_TASKS = 40
+
+
+def _evaluate(task):
+    time.sleep(0.01)
+    return {"value": task["value"] * 2, "pid": os.getpid()}
+
+
+def _worker(queue_dir):
+    queue = TaskQueue(queue_dir, stale_timeout=60, heartbeat_interval=0.1)
+    return queue.run_worker(_evaluate, poll_interval=0.1)
+
+
+def test_each_task_is_evaluated_once(tmpdir):
+    queue_dir = str(tmpdir)
+    queue = TaskQueue(queue_dir)
+    for i in range(NUM_TASKS):
+        assert queue.add_task("task_{:03d}".format(i), {"value": i})
+    # tasks already in the queue are not added again
+    assert not queue.add_task("task_000", {"value": 0})
+
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        num_tasks = pool.map(_worker, [queue_dir] * 4)
+
+    assert sum(num_tasks) == NUM_TASKS
+    assert queue.is_finished()
+    results = queue.results()
+    assert len(results) == NUM_TASKS
+    for i in range(NUM_TASKS):
+        assert results["task_{:03d}".format(i)]["value"] == i * 2
+
+
+def test_stale_tasks_are_requeued(tmpdir):
+    queue_dir = str(tmpdir)
+    queue = TaskQueue(queue_dir, stale_timeout=0.5)
+    queue.add_task("task", {"value": 1})
+
+    # a worker claims the task and dies without completing it
+    task_id, task = queue.claim()
+    assert task_id == "task" and queue.claim() is None
+
+    time.sleep(1.0)
+    assert queue.run_worker(_evaluate, poll_interval=0.1) == 1
+    assert queue.results()["task"]["value"] == 2
+    assert queue.is_finished()
+
+
+def test_stale_tasks_use_the_filesystem_clock(tmpdir, monkeypatch):
+    queue = TaskQueue(str(tmpdir), stale_timeout=60)
+    queue.add_task("task", {"value": 1})
+    assert queue.claim()[0] == "task"
+
+    # the clock of this node is an hour ahead of the one of the filesystem:
+    # the task is fresh
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 3600)
+    queue.requeue_stale()
+    assert queue.num_tasks(CLAIMED) == 1 and queue.num_tasks(PENDING) == 0
+
+
+def test_completed_stale_tasks_are_not_requeued(tmpdir):
+    queue = TaskQueue(str(tmpdir), stale_timeout=60)
+    queue.add_task("task", {"value": 1})
+    assert queue.claim()[0] == "task"
+
+    # the result is written but the task is not moved to done/ (the worker
+    # dies or its rename fails while the task is being requeued)
+    with open(queue._path("results", "task"), "w") as f:
+        f.write('{"value": 2}')
+    os.utime(queue._path(CLAIMED, "task"), (0, 0))
+    os.utime(queue._heartbeat_path("task"), (0, 0))
+    queue.requeue_stale()
+    assert os.path.exists(queue._path(DONE, "task"))
+    assert queue.num_tasks(CLAIMED) == 0 and queue.num_tasks(PENDING) == 0
+
+
+def test_task_requeued_while_claimed(tmpdir):
+    queue_dir = str(tmpdir)
+    queue = TaskQueue(queue_dir, stale_timeout=60)
+    queue.add_task("task", {"value": 1})
+    # a task pending for long: claimed/ gets the old mtime of the file
+    os.utime(queue._path(PENDING, "task"), (0, 0))
+
+    class _SlowClaimQueue(TaskQueue):
+        def heartbeat(self, task_id):
+            # another worker checks the stale tasks during the claim
+            TaskQueue(queue_dir, stale_timeout=60).requeue_stale()
+            super().heartbeat(task_id)
+            TaskQueue(queue_dir, stale_timeout=60).requeue_stale()
+
+    # the claimed task is not seen as stale
+    assert _SlowClaimQueue(queue_dir, stale_timeout=60).claim()[0] == "task"
+    queue.requeue_stale()
+    assert queue.num_tasks(CLAIMED) == 1 and queue.num_tasks(PENDING) == 0
+    assert queue.claim() is None
+
+
+@pytest.mark.parametrize("heartbeat_after_rename", [False, True])
+def test_heartbeat_during_requeue(tmpdir, monkeypatch, heartbeat_after_rename):
+    queue = TaskQueue(str(tmpdir), stale_timeout=60)
+    queue.add_task("task", {"value": 1})
+    assert queue.claim()[0] == "task"
+    # the worker missed heartbeats, but is alive
+    os.utime(queue._path(CLAIMED, "task"), (0, 0))
+    os.utime(queue._heartbeat_path("task"), (0, 0))
+
+    rename = os.rename
+
+    def beat():
+        try:
+            queue.heartbeat("task")
+        except OSError:
+            pass
+
+    def rename_with_heartbeat(src, dst):
+        # the worker beats between the check of the task and its requeue
+        if ".requeue." in dst and not heartbeat_after_rename:
+            beat()
+        rename(src, dst)
+        if ".requeue." in dst and heartbeat_after_rename:
+            beat()
+
+    monkeypatch.setattr(os, "rename", rename_with_heartbeat)
+    TaskQueue(str(tmpdir), stale_timeout=60).requeue_stale()
+    monkeypatch.setattr(os, "rename", rename)
+    assert queue.num_tasks(CLAIMED) == 1 and queue.num_tasks(PENDING) == 0
+    queue.complete("task", {"value": 2})
+    assert queue.is_finished() and queue.results() == {"task": {"value": 2}}
+
+
+def _fail_on_odd(task):
+    if task["value"] % 2:
+        raise ValueError("bad task {}".format(task["value"]))
+    return {"value": task["value"] * 2}
+
+
+def test_failing_tasks_are_given_up(tmpdir):
+    queue = TaskQueue(str(tmpdir), max_attempts=3)
+    for i in range(4):
+        queue.add_task("task_{}".format(i), {"value": i})
+
+    # the worker survives the failures and retries each failing task
+    # max_attempts times
+    assert queue.run_worker(_fail_on_odd, poll_interval=0.1) == 2
+    assert queue.is_finished()
+    assert sorted(queue.results()) == ["task_0", "task_2"]
+    failures = queue.failures()
+    assert sorted(failures) == ["task_1", "task_3"]
+    assert failures["task_1"]["attempts"] == 3
+    assert "bad task 1" in failures["task_1"]["errors"][-1]
+
+    # the next workers do not claim them again
+    assert TaskQueue(str(tmpdir)).run_worker(_fail_on_odd, poll_interval=0.1) == 0
+    assert not queue.add_task("task_1", {"value": 1})
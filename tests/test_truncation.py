@@ -0,0 +1,112 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the
+# LICENSE file in the root directory of this source tree.
+#
+import pytest
+import torch
+from lama.modules.base_connector import MASK, truncate_around_mask
+
+
+def _is_mask(token):
+    return token == MASK
+
+
+def test_truncate_around_mask():
+    context = ["c{}".format(i) for i in range(20)]
+    template = ["x", "born", "in", MASK, "."]
+
+    # short enough: unchanged
+    assert truncate_around_mask([context, template], _is_mask, 25) == ([context, template], 0)
+    assert truncate_around_mask([context, template], _is_mask, None) == ([context, template], 0)
+
+    # the template ends the input: the end of the context is kept
+    (truncated_context, truncated_template), removed = truncate_around_mask(
+        [context, template], _is_mask, 12
+    )
+    assert truncated_template == template
+    assert truncated_context == context[-7:]
+    assert removed == 13
+
+    # the template is kept whole even if it is longer than max_tokens
+    assert truncate_around_mask([context, template], _is_mask, 3) == ([[], template], 20)
+
+    # a context after the template: its beginning is kept
+    assert truncate_around_mask([["x", MASK], context], _is_mask, 6) == ([["x", MASK], context[:4]], 16)
+
+    # no mask: the beginning is kept
+    assert truncate_around_mask([context], _is_mask, 4) == ([context[:4]], 16)
+
+
+def test_bert_max_context_tokens(tiny_bert):
+    model = tiny_bert(num_hidden_layers=1, max_context_tokens=10)
+
+    context = " ".join("w{}".format(i) for i in range(20)) + " ."
+    sentences_list = [[context, "w40 w41 [MASK] ."], ["w1 [MASK] ."]]
+    assert model.get_input_lengths(sentences_list) == [10, 5]
+    log_probs, token_ids, masked_indices = model.get_batch_generation(sentences_list, try_cuda=False)
+    assert log_probs.shape[1] == 10
+    # [CLS] w18 w19 . [SEP] w40 w41 [MASK] . [SEP]
+    assert list(token_ids[0]) == model.tokenizer.convert_tokens_to_ids(
+        ["[CLS]", "w18", "w19", ".", "[SEP]", "w40", "w41", "[MASK]", ".", "[SEP]"]
+    )
+    assert masked_indices == [[7], [2]]
+    assert model.pop_truncation_stats() == {"inputs": 2, "truncated_inputs": 1, "removed_tokens": 18}
+    assert model.truncation_stats["inputs"] == 0
+
+
+class _WordDictionary(object):
+    """fairseq Dictionary of whitespace separated words."""
+
+    def __init__(self, words):
+        self.symbols = ["<s>", "<pad>", "</s>", "<unk>"] + words
+
+    def bos(self):
+        return 0
+
+    def pad(self):
+        return 1
+
+    def eos(self):
+        return 2
+
+    def encode_line(self, line, append_eos=False):
+        return torch.IntTensor([self.symbols.index(word) for word in line.split()])
+
+
+class _IdentityBPE(object):
+
+    def encode(self, text):
+        return text.strip()
+
+
+def test_roberta_max_sentence_length():
+    pytest.importorskip("fairseq")
+    from lama.modules.base_connector import Base_Connector, ROBERTA_MASK
+    from lama.modules.roberta_connector import Roberta
+
+    # a connector with a word dictionary, without a model
+    model = Roberta.__new__(Roberta)
+    Base_Connector.__init__(model)
+    words = ["c{}".format(i) for i in range(30)] + ["x", "born", "in", "."]
+    model.dictionary = _WordDictionary(words + [ROBERTA_MASK])
+    model.mask_idx = model.dictionary.symbols.index(ROBERTA_MASK)
+    model.bpe = _IdentityBPE()
+    model.max_sentence_length = 10
+    model.max_context_tokens = None
+
+    context = " ".join(words[:30])
+    tokens = model._Roberta__get_input_tokens([context, "x born in [MASK] ."])
+    # the mask of the template survives the long context: the end of the
+    # context is kept, 10 tokens with <s> and the </s> of each sentence
+    assert [model.dictionary.symbols[token] for token in tokens.tolist()] == [
+        "<s>", "c28", "c29", "</s>", "x", "born", "in", ROBERTA_MASK, ".", "</s>"
+    ]
+    assert model.get_input_lengths([[context, "x born in [MASK] ."], ["x [MASK] ."]]) == [10, 5]
+    assert model.pop_truncation_stats() == {"inputs": 1, "truncated_inputs": 1, "removed_tokens": 28}
+
+    # max_context_tokens replaces max_sentence_length
+    model.max_context_tokens = 12
+    tokens = model._Roberta__get_input_tokens([context, "x born in [MASK] ."])
+    assert len(tokens) == 12 and model.mask_idx in tokens.tolist()